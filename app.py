@@ -1,35 +1,55 @@
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g #g is just a container to hold things temporarily
+import click
+from flask import Flask, Blueprint, current_app, render_template, abort, request, flash, redirect, session, g, jsonify, Response, stream_with_context, get_flashed_messages #g is just a container to hold things temporarily
 #to prevent errors if the value we're looking for that we would store in g doesnt exist yet 
-from flask_debugtoolbar import DebugToolbarExtension
+from jinja2 import FileSystemBytecodeCache
 from sqlalchemy.exc import IntegrityError
 
+from config import PROFILES
 from forms import UserAddForm, LoginForm, MessageForm,UserDetailForm
-from models import Likes, db, connect_db, User, Message
+from models import Likes, Follows, db, bcrypt, connect_db, User, Message, insert_ignoring_duplicates
+from jobs import enqueue, init_jobs
+from messagestore import init_message_store
+from trending import init_trending, forget_messages
+from livefeed import init_live, publish_message, stream_response, channel
+from writebehind import init_write_behind, write_buffer
+from cache import init_cache, bump_versions
+import export
+import bulkimport
+import tagindex
+import imageproxy
+import viewcounts
+import readmodels
 
 CURR_USER_KEY = "curr_user" #this is the value our session will hold to see if a user is logged in or not
 #it starts with a dummy value as to not break our code that relies on the token existing
 
-app = Flask(__name__)
+#all the routes live on this blueprint, create_app() at the bottom builds an app around it
+bp = Blueprint('warbler', __name__)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+def render_streamed(template_name, **context):
+    """Render a template as a streamed response when STREAM_TEMPLATES is on.
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret") #pls change this if this goes into prod
-toolbar = DebugToolbarExtension(app)
+    The page goes out in chunks as Jinja produces it, so everything above
+    the list is sent right away and the rows follow as they come off the
+    cursor. Pass generators (readmodels with stream=True, Query.yield_per)
+    as the list so nothing is loaded up front.
 
-connect_db(app)
+    Flashed messages are popped here, before the headers go out, because
+    changing the session once the body has started streaming is too late
+    for the cookie.
+    """
+
+    if not current_app.config['STREAM_TEMPLATES']:
+        return render_template(template_name, **context)
 
-def find_like(likes,id): #small methods to sort through likes 
-    for l in likes:
-        if l.id == id:
-             return l 
+    get_flashed_messages(with_categories=True)
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(current_app.config['STREAM_BUFFER_SIZE'])
+    return Response(stream_with_context(stream), mimetype='text/html')
 
        
 
@@ -39,7 +59,7 @@ def find_like(likes,id): #small methods to sort through likes
 # User signup/login/logout
 
 
-@app.before_request #this is a decorator that will force the function below to run before each request is made
+@bp.before_app_request #this is a decorator that will force the function below to run before each request is made
 #so if I make a get or a post add_user_to_g will run 
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
@@ -75,7 +95,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"]) #TODO add functionality to add bio loc and pic 
+@bp.route('/signup', methods=["GET", "POST"]) #TODO add functionality to add bio loc and pic 
 def signup():
     """Handle user signup.
 
@@ -112,7 +132,7 @@ def signup():
         return render_template('users/signup.html', form=form) #if no form is sent then serve them the form 
 
 
-@app.route('/login', methods=["GET", "POST"]) #the route we will need to log our user in 
+@bp.route('/login', methods=["GET", "POST"]) #the route we will need to log our user in 
 def login():
     """Handle user login."""
 
@@ -133,7 +153,7 @@ def login():
     return render_template('users/login.html', form=form) #if neither then send them the form they need to log in 
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout(): #
     """Handle logout of user."""
     
@@ -146,7 +166,7 @@ def logout(): #
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -155,36 +175,35 @@ def list_users():
 
     search = request.args.get('q') #if you pass in a username as a query string it will return the user you searched for
     
-    likes_messages_id = [m.id for m in g.user.likes]
+    likes_messages_id = readmodels.liked_ids(g.user.id) if g.user else set()
 
     if not search: #if we didnt specify a user then get all of them 
-        users = User.query.all() 
+        users = User.query
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all() #if we did search return taht particular user 
+        users = User.query.filter(User.username.like(f"%{search}%")) #if we did search return taht particular user 
+    users = users.order_by(User.id).yield_per(readmodels.STREAM_CHUNK_SIZE) #fetched in chunks while the page streams 
 
-    return render_template('users/index.html', users=users,likes=likes_messages_id)#then either way render either one user or all of them on this template
+    return render_streamed('users/index.html', users=users,likes=likes_messages_id)#then either way render either one user or all of them on this template
 
 
-@app.route('/users/<int:user_id>') #shows the user's page by using anchortags
+@bp.route('/users/<int:user_id>') #shows the user's page by using anchortags
 def users_show(user_id): #from the anchor tag we get a user_id
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id) #find that user or give me a 404 
+    user = readmodels.profile(user_id) #just what the page shows, out of the cache while it's current 
+    if user is None:
+        abort(404) #find that user or give me a 404 
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all()) #filter the messages the user wrote and sorts them by descending order 
-    likes_messages_id = [m.id for m in g.user.likes]
+    messages = readmodels.profile_messages(user) #only the columns the template shows, newest first 
+    messages = viewcounts.count_impressions(messages) #counted in memory, written in batches 
+    likes_messages_id = readmodels.liked_ids(g.user.id) if g.user else set()
     return render_template('users/show.html', user=user, messages=messages, likes=likes_messages_id) #then show the template users being the folder its in
     #this is done because the user folder uses a different base template to extend from  
 
 
-@app.route('/users/<int:user_id>/following')
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id): #once again a user_id is passed in from our html 
     """Show list of people this user is following."""
 
@@ -196,7 +215,7 @@ def show_following(user_id): #once again a user_id is passed in from our html
     return render_template('users/following.html', user=user) #we load an html that grabs all the followed users
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     #this function does the same thing as above but based on the user's followers 
     """Show list of followers of this user."""
@@ -211,7 +230,7 @@ def users_followers(user_id):
 
 
 ################################################################
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id): #this function lets a logged in user follow another user 
     """Add a follow for the currently-logged-in user."""
 
@@ -221,8 +240,14 @@ def add_follow(follow_id): #this function lets a logged in user follow another u
 
 #**Don explain 
     followed_user = User.query.get_or_404(follow_id) #grab the id of the user we want to follow 
-    g.user.following.append(followed_user)#add that id to our follows table using the relationship in User
-    db.session.commit() #add it to our db 
+    if current_app.config['WRITE_BEHIND']: #the follow gets written with the next batch, see writebehind.py 
+        write_buffer().follow(g.user.id, follow_id)
+        return redirect(f"/users/{g.user.id}/following")
+
+    #straight into the follows table instead of through g.user.following, which loads everyone they already follow 
+    #and a second click on follow is skipped instead of blowing up on the primary key 
+    insert_ignoring_duplicates(Follows.__table__, [{'user_being_followed_id': followed_user.id, 'user_following_id': g.user.id}])
+    enqueue('refresh_counts', user_ids=[g.user.id, follow_id]) #add it to our db, the follow counts get redone in the background 
     #this will add both the user who is following and the user getting followed to our follows table 
     #this is where the extra joins at the bottom come into play those dictate the data going into follows 
     #** Don 
@@ -235,7 +260,7 @@ def add_follow(follow_id): #this function lets a logged in user follow another u
     return redirect(f"/users/{g.user.id}/following") #then redirect to the follow page 
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id): #this route uses the same logic as above but to remove followers 
     """Have currently-logged-in-user stop following this user."""
 
@@ -243,16 +268,21 @@ def stop_following(follow_id): #this route uses the same logic as above but to r
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    if current_app.config['WRITE_BEHIND']:
+        write_buffer().unfollow(g.user.id, follow_id)
+        return redirect(f"/users/{g.user.id}/following")
+
+    (Follows.query
+     .filter_by(user_following_id=g.user.id, user_being_followed_id=follow_id)
+     .delete(synchronize_session=False)) #same as above, no need to load who they follow to drop one of them 
+    enqueue('refresh_counts', user_ids=[g.user.id, follow_id])
 
     return redirect(f"/users/{g.user.id}/following")
 
 ################################################################
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
     if not g.user:
@@ -261,7 +291,7 @@ def profile():
 
     form = UserDetailForm()
 
-    likes_messages_id = [m.id for m in g.user.likes]
+    likes_messages_id = readmodels.liked_ids(g.user.id)
     
 
     if form.validate_on_submit():
@@ -280,10 +310,11 @@ def profile():
             user.username = new_username
             user.email = email
             user.image_url = pfp
+            user.version = User.version + 1 #cached copies of their profile and messages are out of date now 
 
             db.session.add(user)
             db.session.commit()
-            return redirect(f"/users/{g.user.id}",likes_messages_id)
+            return redirect(f"/users/{g.user.id}")
         else: 
             flash("Access unauthorized.", "danger")
         return redirect("/")
@@ -299,7 +330,7 @@ def profile():
     
 
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/delete', methods=["POST"])
 def delete_user(): #removes a user from our system 
     """Delete user."""
 
@@ -307,18 +338,65 @@ def delete_user(): #removes a user from our system
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    user_id = g.user.id
     do_logout() #log them out 
 
-    db.session.delete(g.user) #remove them from our db 
-    db.session.commit()
+    enqueue('delete_user', user_id=user_id) #removing all their messages likes and follows is slow so a job does it 
 
     return redirect("/signup") #send them back to sign in 
 
 
+@bp.route('/users/export')
+def export_data():
+    """Download everything of the logged in user's as NDJSON (or one kind of it as CSV).
+
+    ?format=ndjson|csv, ?kind=messages (repeat for several), ?gzip=1
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fmt = request.args.get('format', 'ndjson')
+    kinds = request.args.getlist('kind')
+    compress = request.args.get('gzip') == '1'
+    try:
+        body = export.export(fmt, kinds, g.user.id, compress)
+    except ValueError as error:
+        abort(400, str(error))
+
+    #streamed straight off the cursor, the whole export is never in memory 
+    name = export.filename(fmt, kinds, compress, prefix=f"warbler-{g.user.id}")
+    return Response(stream_with_context(body), mimetype=export.mimetype(fmt, compress),
+                    headers={'Content-Disposition': f'attachment; filename="{name}"'})
+
+
+@bp.route('/users/import/<kind>', methods=["POST"])
+def import_data(kind):
+    """Bulk import follows or messages for the logged in user, see bulkimport.py for the formats.
+
+    Answers with what was inserted, what was already there and why any rows failed.
+    """
+
+    if not g.user:
+        abort(401)
+    if kind not in bulkimport.KINDS:
+        abort(404)
+
+    user_id = g.user.id #the session gets committed (and g.user expired) batch by batch 
+    try:
+        records = bulkimport.uploaded_records(kind, request)
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+
+    report = bulkimport.import_rows(kind, records, owner_id=user_id)
+    return jsonify(report.as_dict())
+
+
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -332,26 +410,36 @@ def messages_add():
     form = MessageForm() #instanciates our message form 
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data) #McGrab the McData and McPutIt into an Object 
-        g.user.messages.append(msg) #append the new message object to user.messages using the relationship in models.py 
-        db.session.commit()#commit the changes to our database 
+        msg = Message(text=form.text.data, user_id=g.user.id) #McGrab the McData and McPutIt into an Object 
+        db.session.add(msg) #adding it directly instead of through g.user.messages so we dont load every message they ever wrote 
+        db.session.flush() #gives us the id and timestamp now so we dont have to reload them after the commit 
+        tagindex.index_messages([(msg.id, msg.text, msg.timestamp)]) #file it under its #tags and @mentions 
+        row = readmodels.MessageRow(msg.id, msg.text, msg.timestamp, g.user.id, g.user.username,
+                                     imageproxy.proxied(g.user.image_url, 'thumb')) #the live feed builds its img tag from this 
+        bump_versions([g.user.id]) #their cached profile page goes stale with this commit, not whenever the job gets to it 
+        enqueue('refresh_counts', user_ids=[g.user.id]) #commits the message and queues the message count update 
+        publish_message(row) #followers with the home page open get it pushed to them 
 
         return redirect(f"/users/{g.user.id}") #back to the user's page now with the new message 
 
     return render_template('messages/new.html', form=form) #if no form is sent then present form 
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id): #if I click on the message then it gets its own html page where I can delete it 
     """Show a message."""
 
-    msg = Message.query.get(message_id) #query for the right message with its unique id 
-    likes_messages_id = [m.id for m in g.user.likes]
+    found = readmodels.message_with_author(message_id) #query for the right message with its unique id, cached 
+    if found is None:
+        abort(404)
+    msg, author, views = found #views came along in the same query 
+    viewcounts.count_view(msg.id) #just a bump in this process's buffer, the flusher writes it later 
+    likes_messages_id = readmodels.liked_ids(g.user.id) if g.user else set()
     
-    return render_template('messages/show.html', message=msg,likes=likes_messages_id) #load up an html with that message 
+    return render_template('messages/show.html', message=msg, author=author, views=views, likes=likes_messages_id) #load up an html with that message 
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id): #this route is to delete a message 
     """Delete a message."""
 
@@ -359,9 +447,18 @@ def messages_destroy(message_id): #this route is to delete a message
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id) #query for the message object 
+    msg = Message.query.get_or_404(message_id) #query for the message object 
+    if msg.user_id != g.user.id:
+        abort(403) #only the author gets to delete it 
+    liked_by = [u for (u,) in db.session.query(Likes.user_id).filter(Likes.message_id == message_id)]
+    #likes go first by hand, a partitioned messages table cant have the foreign key that would cascade them 
+    Likes.query.filter(Likes.message_id == message_id).delete(synchronize_session=False)
+    forget_messages([message_id]) #and it comes off the trending and top boards 
+    tagindex.forget_messages([message_id]) #and out of the tag pages 
+    viewcounts.forget_messages([message_id]) #its view counts go with it 
     db.session.delete(msg) #McDelete it
-    db.session.commit() #Commit the change 
+    bump_versions([msg.user_id]) #and out of every process's cached copies of the author's profile and message pages 
+    enqueue('refresh_counts', user_ids=[msg.user_id] + liked_by) #Commit the change, the author's message count and the likers' like counts get redone 
 
     return redirect(f"/users/{g.user.id}") #send the user back to his timeline/page / whatever 
 
@@ -370,27 +467,25 @@ def messages_destroy(message_id): #this route is to delete a message
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
     - logged in: 100 most recent messages of followed_users
     """
-    user = User.query.get_or_404(g.user.id)
-    likes_messages_id = [m.id for m in user.likes]
-
-    
     if g.user: #**Don
+        likes_messages_id = readmodels.liked_ids(g.user.id)
 
-        following_ids = [f.id for f in g.user.following] + [g.user.id] #this here grabs all the id of people you follow
+        following_ids = readmodels.following_ids(g.user.id) + [g.user.id] #this here grabs all the id of people you follow
         #and puts them in a list and then adds your id on top so you can see your messages as well
 
-        messages = (Message.query.filter(Message.user_id.in_(following_ids)).order_by(Message.timestamp.desc()).all())
+        messages = viewcounts.count_impressions(readmodels.timeline(following_ids, stream=True)) #counts each row as it goes out 
         #then here we check through all messsages using .in_ to see if they have any of our following id if they do we want them
+        #we only pull the author name, avatar, text and date since thats all home.html shows
                     
 
-        return render_template('home.html', messages=messages,likes=likes_messages_id) #render that home template brooooo 
+        return render_streamed('home.html', messages=messages,likes=likes_messages_id) #render that home template brooooo 
 
     else:
         return render_template('home-anon.html') #otherwise send them to the unlogged in user homepage
@@ -399,12 +494,23 @@ def homepage():
 
 
 
+@bp.route('/timeline/stream')
+def timeline_stream():
+    """Server-Sent Events feed of new messages from g.user and the people they follow."""
+
+    if not g.user:
+        abort(401) #not a redirect, EventSource would just keep retrying the login page 
+
+    channels = [channel(user_id) for user_id in readmodels.following_ids(g.user.id) + [g.user.id]]
+    return stream_response(channels) #from here on the stream holds no db connection, just a spot in the broker 
+
+
 #############################
 #like routes 
 
 
 
-@app.route('/users/add_like/<int:message_id>', methods=["POST"])
+@bp.route('/users/add_like/<int:message_id>', methods=["POST"])
 def add_like(message_id):
 
     #for this to work we need to create a new like which needs two pieces 
@@ -421,6 +527,13 @@ def add_like(message_id):
 
 
     msg = Message.query.get_or_404(message_id) #we grab the message that was liked to make sure it exists 
+
+    if current_app.config['WRITE_BEHIND']: #like storms get written in batches instead of a commit per click, see writebehind.py 
+        if g.user.id == msg.user_id:
+            flash("You cannot favorite your own Warble")
+            return redirect("/")
+        write_buffer().toggle_like(g.user.id, message_id)
+        return redirect(f"/users/{g.user.id}/Likes")
     
     user_id = g.user.id #we dont need this but helps my brain understand whats going on
     user = User.query.get_or_404(g.user.id) 
@@ -428,10 +541,12 @@ def add_like(message_id):
         if g.user.id == msg.user.id:
             flash("You cannot favorite your own Warble")
             return redirect("/")
-        new_like = Likes(user_id=user_id,message_id=message_id) #to create the new like need g.user's id and also the id of the message they like which 
+        liked_at = datetime.utcnow()
+        new_like = Likes(user_id=user_id,message_id=message_id,timestamp=liked_at) #to create the new like need g.user's id and also the id of the message they like which 
     #we grabbed using the like button 
         db.session.add(new_like)
-        db.session.commit()
+        #one job bumps the like count and the trending / top boards 
+        enqueue('record_like', user_id=user_id, message_id=message_id, author_id=msg.user_id, liked_at=liked_at.isoformat())
     except IntegrityError:
         if g.user.id == msg.user.id:
             flash("You cannot favorite your own Warble")
@@ -439,13 +554,16 @@ def add_like(message_id):
         db.session.rollback()
         
 
-        delete_warble = find_like(user.likes,message_id)
+        #the like row itself, not the message (user.likes is the liked messages), we need its timestamp too 
+        delete_warble = Likes.query.filter_by(user_id=user_id, message_id=message_id).first_or_404()
 
         # liked_messages = [m.message_id for m in user.likes]
 
         # delete_warble = Likes.query.filter(Likes.message_id.in_
         db.session.delete(delete_warble)
-        db.session.commit()
+        enqueue('record_like', user_id=user_id, message_id=message_id, author_id=msg.user_id,
+                liked_at=delete_warble.timestamp.isoformat(), delta=-1) #the like comes back out of the hour it went into 
+
         return redirect(f"/users/{g.user.id}/Likes")
         
 
@@ -454,22 +572,89 @@ def add_like(message_id):
     return  redirect(f"/users/{g.user.id}/Likes")
 
 
-@app.route('/users/<int:user_id>/Likes') 
+@bp.route('/users/<int:user_id>/Likes') 
 def show_warbles(user_id):
 
     
 
     user = User.query.get_or_404(user_id) #we need to grab the User object based on the id to get the logic below to work 
-    users = User.query.all()
 
-    likes_messages_id = [m.id for m in user.likes] #grabs all the message id that are liked by g.user
+    likes_messages_id = readmodels.liked_ids(user.id) #grabs all the message id that are liked by g.user
 
-    liked_messsages = Message.query.filter(Message.id.in_(likes_messages_id)).order_by(Message.id.desc()).all()
+    liked_messsages = viewcounts.count_impressions(readmodels.liked_timeline(user.id, stream=True))
 
     
 
     
-    return render_template("users/show_warbles.html", messages=liked_messsages , users=users,user=user,likes=likes_messages_id) #TODO make the template pretty 
+    return render_streamed("users/show_warbles.html", messages=liked_messsages ,user=user,likes=likes_messages_id) #TODO make the template pretty 
+
+
+@bp.route('/trending')
+def trending():
+    """The messages with the most recent likes, newest likes counting the most."""
+
+    messages = viewcounts.count_impressions(readmodels.trending_timeline(current_app.config['TRENDING_SIZE']))
+    likes = readmodels.liked_ids(g.user.id) if g.user else set()
+
+    return render_template('messages/trending.html', messages=messages, likes=likes)
+
+
+@bp.route('/tags/<tag>')
+def tag_timeline(tag):
+    """Messages with #tag in them, newest first, a page at a time."""
+
+    return render_term_page(tagindex.tag_term(tag), f"#{tag.lower()}")
+
+
+@bp.route('/mentions')
+def mentions():
+    """Messages that mention the logged in user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return render_term_page(tagindex.mention_term(g.user.id), f"Mentions of @{g.user.username}")
+
+
+def render_term_page(term, title):
+    """One page of a tag index timeline, ?before=<cursor> picks up where the last one stopped."""
+
+    before = request.args.get('before')
+    if before is not None:
+        try:
+            before = tagindex.decode_cursor(before)
+        except ValueError:
+            abort(400)
+
+    messages, cursor = readmodels.term_page(term, current_app.config['TAGS_PAGE_SIZE'], before)
+    viewcounts.count_impressions(messages)
+    likes = readmodels.liked_ids(g.user.id) if g.user else set()
+
+    return render_template('messages/tag.html', title=title, messages=messages, likes=likes,
+                           next_page=cursor and f"{request.path}?before={cursor}")
+
+
+@bp.route('/users/<int:user_id>/top')
+def users_top(user_id):
+    """A user's most liked messages of all time."""
+
+    user = User.query.get_or_404(user_id)
+    messages = viewcounts.count_impressions(readmodels.top_timeline(user.id, current_app.config['TRENDING_SIZE']))
+    likes = readmodels.liked_ids(g.user.id) if g.user else set()
+
+    return render_template('users/show_warbles.html', messages=messages, user=user, likes=likes) #same list as the likes page 
+
+
+##############################################################################
+# Image proxy
+
+
+@bp.route('/images/<size>/<token>')
+def image_proxy(size, token):
+    """A resized avatar or header image, fetched once and then served from the disk cache."""
+
+    return imageproxy.image_response(size, token) #templates make these URLs with the `proxied` filter
 
 
 ##############################################################################
@@ -479,10 +664,13 @@ def show_warbles(user_id):
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request #is run after each request 
+@bp.after_app_request #is run after each request 
 def add_header(req):
     """Add non-caching headers on every request.""" #**Don 
 
+    if req.cache_control.max_age: #the image proxy already said how long its responses keep 
+        return req
+
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
@@ -490,4 +678,66 @@ def add_header(req):
     return req
 
 
+##############################################################################
+# Application factory
+
+
+def precompile_templates(app):
+    """Load every template once so they are compiled (and in the bytecode cache) before the first request."""
+
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+
+def create_app(config=None):
+    """Build the Warbler app.
+
+    `config` is a profile name from config.PROFILES, a config class, or None
+    to pick the profile from FLASK_ENV (development if unset). Importing this
+    module no longer connects to anything; that all happens here.
+    """
 
+    if config is None:
+        config = os.environ.get('FLASK_ENV') or 'development'
+    if isinstance(config, str):
+        config = PROFILES[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    if app.config['TEMPLATE_CACHE_DIR']:
+        #has to be set before anything touches app.jinja_env, thats when the environment gets built
+        os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+        app.jinja_options = dict(app.jinja_options,
+                                 bytecode_cache=FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR']))
+
+    if app.config['DEBUG_TB_ENABLED']:
+        #imported here so production never loads it, let alone instruments requests with it
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    bcrypt.init_app(app)
+    init_jobs(app)
+    init_message_store(app)
+    init_trending(app)
+    init_live(app)
+    init_write_behind(app)
+    init_cache(app)
+    export.init_export(app)
+    bulkimport.init_import(app)
+    tagindex.init_tags(app)
+    imageproxy.init_image_proxy(app)
+    viewcounts.init_views(app)
+    app.register_blueprint(bp)
+
+    @app.cli.command('compile-templates')
+    def compile_templates_command():
+        """Compile every template into the bytecode cache."""
+        precompile_templates(app)
+        click.echo(f"Compiled templates into {app.config['TEMPLATE_CACHE_DIR']}")
+
+    if app.config['PRELOAD_TEMPLATES']:
+        precompile_templates(app)
+
+    return app
@@ -0,0 +1,127 @@
+"""Measure how many idle /timeline/stream connections one worker process holds.
+
+Serves the app from a threaded werkzeug server in this process (one thread per
+connection, like gunicorn's gthread worker), opens CONNECTIONS streams as a
+logged in user, then reports the memory and threads they cost while idle and
+how long one new message takes to reach all of them.
+
+run it from the repo root like:
+
+    python benchmarks/bench_live.py [connections]
+
+Raise `ulimit -n` first for more than a few hundred connections.
+"""
+
+import os
+import selectors
+import socket
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f"sqlite:///{DB_PATH}"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from app import create_app, CURR_USER_KEY
+from models import db, User, Follows
+import livefeed
+import readmodels
+
+CONNECTIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+app = create_app('production')
+app.config['LIVE_HEARTBEAT'] = 600 #idle means idle, no keepalives during the run
+app.config['LIVE_MAX_SECONDS'] = 3600
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def rss_kb():
+    """Resident memory of this process in KB (Linux)."""
+
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def setup():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=author.id, user_following_id=reader.id))
+        db.session.commit()
+        return reader.id, author.id
+
+
+def session_cookie(user_id):
+    return app.session_interface.get_signing_serializer(app).dumps({CURR_USER_KEY: user_id})
+
+
+def open_stream(port, cookie):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall((f"GET /timeline/stream HTTP/1.1\r\nHost: localhost\r\n"
+                  f"Cookie: session={cookie}\r\nAccept: text/event-stream\r\n\r\n").encode())
+    received = b''
+    while b'retry:' not in received: #the subscription exists once the first event is out
+        received += sock.recv(4096)
+    return sock
+
+
+def main():
+    reader_id, author_id = setup()
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    cookie = session_cookie(reader_id)
+
+    open_stream(server.server_port, cookie).close() #warm up the first request path
+    time.sleep(0.2)
+    before_rss, before_threads = rss_kb(), threading.active_count()
+
+    start = time.perf_counter()
+    streams = [open_stream(server.server_port, cookie) for _ in range(CONNECTIONS)]
+    opened = time.perf_counter() - start
+    time.sleep(0.5)
+    after_rss, after_threads = rss_kb(), threading.active_count()
+
+    selector = selectors.DefaultSelector()
+    for sock in streams:
+        selector.register(sock, selectors.EVENT_READ)
+
+    with app.app_context():
+        row = readmodels.MessageRow(1, "hello", datetime.utcnow(), author_id, "author", "")
+        start = time.perf_counter()
+        livefeed.publish_message(row)
+
+    waiting = set(streams)
+    while waiting:
+        for key, _ in selector.select(timeout=10):
+            if b'data:' in key.fileobj.recv(4096):
+                waiting.discard(key.fileobj)
+                selector.unregister(key.fileobj)
+    fan_out = time.perf_counter() - start
+
+    per_connection = (after_rss - before_rss) / CONNECTIONS
+    print(f"{CONNECTIONS} idle streams opened in {opened:.2f} s")
+    print(f"memory      {after_rss - before_rss:8d} KB total, {per_connection:6.1f} KB per stream")
+    print(f"threads     {after_threads - before_threads:8d} extra")
+    print(f"fan out     {fan_out * 1000:8.1f} ms for one message to reach every stream")
+
+    for sock in streams:
+        sock.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
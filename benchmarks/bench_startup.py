@@ -0,0 +1,85 @@
+"""Measure how long Warbler takes to import, build and serve its first page.
+
+Every case runs in a fresh interpreter (like a new worker or test process):
+
+    import            `import app` on its own, which no longer builds anything
+    create (dev)      import + create_app('development'), roughly what importing
+                      app.py used to cost (config, debug toolbar, db setup)
+    create (prod)     import + create_app('production') with a cold template cache,
+                      templates get compiled up front (PRELOAD_TEMPLATES)
+    first request     create_app + GET /login, cold and then warm bytecode cache
+
+run it from the repo root like:
+
+    python benchmarks/bench_startup.py
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+RUNS = 7
+
+CASES = {
+    'import': "import app",
+    'create (dev)': "from app import create_app; create_app('development')",
+    'create (prod)': "from app import create_app; create_app('production')",
+    'first request': "from app import create_app; create_app('{profile}').test_client().get('/login')",
+}
+
+TIMER = """
+import time
+start = time.perf_counter()
+{code}
+print(time.perf_counter() - start)
+"""
+
+
+def run(code, cache_dir):
+    env = dict(os.environ,
+               DATABASE_URL="sqlite://",
+               TEMPLATE_CACHE_DIR=cache_dir)
+    out = subprocess.run([sys.executable, "-c", TIMER.format(code=code)],
+                         cwd=ROOT, env=env, check=True, capture_output=True, text=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def time_case(code, cold):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        times = []
+        for _ in range(RUNS):
+            if cold:
+                shutil.rmtree(cache_dir)
+                os.makedirs(cache_dir)
+            times.append(run(code, cache_dir))
+        return median(times)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def main():
+    #one throwaway run so .pyc files exist and every case starts from the same place
+    run(CASES['create (dev)'], tempfile.mkdtemp())
+
+    print(f"median of {RUNS} fresh processes")
+    print(f"{'import':34} {time_case(CASES['import'], cold=True) * 1000:8.1f} ms")
+    print(f"{'create (dev)':34} {time_case(CASES['create (dev)'], cold=True) * 1000:8.1f} ms")
+    print(f"{'create (prod), cold template cache':34} {time_case(CASES['create (prod)'], cold=True) * 1000:8.1f} ms")
+    print(f"{'create (prod), warm template cache':34} {time_case(CASES['create (prod)'], cold=False) * 1000:8.1f} ms")
+    for profile in ('development', 'production'):
+        code = CASES['first request'].format(profile=profile)
+        print(f"{'first request (' + profile + '), cold':34} {time_case(code, cold=True) * 1000:8.1f} ms")
+        print(f"{'first request (' + profile + '), warm':34} {time_case(code, cold=False) * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Compare rendering a timeline from full ORM objects against readmodels rows.
+
+Builds a throwaway SQLite database with 1000 messages spread over 50 users
+that one reader follows, then times loading + rendering the list both ways
+and records the peak memory allocated during each request with tracemalloc.
+
+run it from the repo root like:
+
+    python benchmarks/bench_timeline.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f"sqlite:///{DB_PATH}"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import render_template_string
+
+from app import create_app
+from models import db, User, Message, Follows
+import readmodels
+
+app = create_app('production')
+
+NUM_USERS = 50
+NUM_MESSAGES = 1000
+ROUNDS = 20
+
+#the message list markup from home.html, once reading through the ORM relationships and once from MessageRows
+ORM_ROWS = """{% for msg in messages %}<li class="list-group-item">
+<a href="/messages/{{ msg.id }}" class="message-link"/><a href="/users/{{ msg.user.id }}">
+<img src="{{ msg.user.image_url }}" alt="" class="timeline-image"></a><div class="message-area">
+<a href="/users/{{ msg.user.id }}">@{{ msg.user.username }}</a>
+<span class="text-muted">{{ msg.timestamp.strftime('%d %B %Y') }}</span><p>{{ msg.text }}</p></div>
+<button class="btn btn-sm {{'btn-primary' if msg.id in likes else 'btn-secondary'}}"></button></li>{% endfor %}"""
+
+ROW_ROWS = """{% for msg in messages %}<li class="list-group-item">
+<a href="/messages/{{ msg.id }}" class="message-link"/><a href="/users/{{ msg.user_id }}">
+<img src="{{ msg.image_url }}" alt="" class="timeline-image"></a><div class="message-area">
+<a href="/users/{{ msg.user_id }}">@{{ msg.username }}</a>
+<span class="text-muted">{{ msg.timestamp.strftime('%d %B %Y') }}</span><p>{{ msg.text }}</p></div>
+<button class="btn btn-sm {{'btn-primary' if msg.id in likes else 'btn-secondary'}}"></button></li>{% endfor %}"""
+
+
+def seed():
+    db.create_all()
+    users = [User(username=f"user{i}", email=f"user{i}@test.com", password="x" * 60,
+                  bio="b" * 140, header_image_url="/static/images/warbler-hero.jpg")
+             for i in range(NUM_USERS + 1)]
+    db.session.add_all(users)
+    db.session.flush()
+
+    reader = users[0]
+    db.session.add_all(Follows(user_being_followed_id=u.id, user_following_id=reader.id) for u in users[1:])
+
+    start = datetime(2020, 1, 1)
+    db.session.bulk_insert_mappings(Message, [
+        {'text': f"warble number {n} " * 5, 'timestamp': start + timedelta(minutes=n),
+         'user_id': users[1 + n % NUM_USERS].id}
+        for n in range(NUM_MESSAGES)])
+    db.session.commit()
+    return reader.id
+
+
+def orm_request(reader_id):
+    """What homepage() did before: full objects, relationships resolved lazily while rendering."""
+
+    reader = User.query.get(reader_id)
+    likes = [m.id for m in reader.likes]
+    following = [f.id for f in reader.following] + [reader.id]
+    messages = Message.query.filter(Message.user_id.in_(following)).order_by(Message.timestamp.desc()).all()
+    return render_template_string(ORM_ROWS, messages=messages, likes=likes)
+
+
+def rows_request(reader_id):
+    """What homepage() does now."""
+
+    likes = readmodels.liked_ids(reader_id)
+    following = readmodels.following_ids(reader_id) + [reader_id]
+    messages = readmodels.timeline(following)
+    return render_template_string(ROW_ROWS, messages=messages, likes=likes)
+
+
+def measure(fn, reader_id):
+    times = []
+    peaks = []
+    for _ in range(ROUNDS):
+        with app.test_request_context():
+            tracemalloc.start()
+            start = time.perf_counter()
+            html = fn(reader_id)
+            times.append(time.perf_counter() - start)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            db.session.remove()
+    times.sort()
+    return times[len(times) // 2], max(peaks), len(html)
+
+
+def main():
+    with app.app_context():
+        reader_id = seed()
+
+        #warm up template compilation and the connection pool so neither side pays for it
+        measure(orm_request, reader_id)
+        measure(rows_request, reader_id)
+
+        print(f"{NUM_MESSAGES} message timeline, median of {ROUNDS} requests")
+        print(f"{'':10} {'time (ms)':>10} {'peak mem (KiB)':>15} {'html bytes':>11}")
+        for name, fn in [('orm', orm_request), ('readmodel', rows_request)]:
+            took, peak, size = measure(fn, reader_id)
+            print(f"{name:10} {took * 1000:10.1f} {peak / 1024:15.0f} {size:11}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""Bulk import of follows and messages.
+
+Takes the CSV formats generator/create_csvs.py writes (which export.py
+produces too):
+
+    follows     user_being_followed_id, user_following_id
+    messages    text, timestamp, user_id   (an id column, as in exports, is ignored)
+
+Rows are read IMPORT_BATCH_SIZE at a time. Each batch is validated with one
+query for the users it names, rows that fail are reported by row number, and
+the rest are written with multi-row INSERTs that skip whatever is already
+there: follows with ON CONFLICT DO NOTHING on their primary key, messages
+(which have no natural key) by first dropping the (user_id, timestamp, text)
+rows that are already stored. Imported messages are filed in the tag index
+(tagindex.py) like posted ones. Every batch commits on its own together with
+the recount of the users it touched, so a huge import never holds one long
+transaction open and a bad row costs nothing but its line in the report.
+
+POST /users/import/follows and /users/import/messages take an uploaded CSV
+(or a JSON list of the same fields) for the logged in user: the user column
+may be left out and rows naming anybody else are rejected. `flask import
+follows|messages FILE` imports for everyone.
+"""
+
+import csv
+import io
+from datetime import datetime
+from itertools import islice
+
+import click
+from flask import current_app
+from sqlalchemy import tuple_
+
+from models import db, User, Message, Follows, insert_ignoring_duplicates
+from jobs import refresh_counts
+import tagindex
+
+#the generator's CSV headers, the last column of each is the one a logged in user's import may leave out
+FOLLOWS_FIELDS = ['user_being_followed_id', 'user_following_id']
+MESSAGES_FIELDS = ['text', 'timestamp', 'user_id']
+
+MAX_MESSAGE_LENGTH = 140
+
+
+class ImportReport:
+    """What an import did: rows inserted, rows that were already there, and rows that failed."""
+
+    def __init__(self, max_errors=100):
+        self.inserted = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.errors = [] #(row number, why), the first max_errors of them
+        self.max_errors = max_errors
+
+    def error(self, row, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((row, message))
+
+    def as_dict(self):
+        return {
+            'inserted': self.inserted,
+            'duplicates': self.duplicates,
+            'failed': self.failed,
+            'errors': [{'row': row, 'error': message} for row, message in self.errors],
+        }
+
+
+def _user_id(record, field, owner_id):
+    value = record.get(field)
+    if value in (None, '') and owner_id is not None:
+        return owner_id
+    try:
+        user_id = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be a user id, got {value!r}")
+    if owner_id is not None and user_id != owner_id:
+        raise ValueError(f"{field} must be your own id")
+    return user_id
+
+
+def parse_follow(record, owner_id=None):
+    """(followed_id, follower_id) from a follows row. Raises ValueError for a bad one."""
+
+    try:
+        followed_id = int(record.get('user_being_followed_id'))
+    except (TypeError, ValueError):
+        raise ValueError(f"user_being_followed_id must be a user id, got {record.get('user_being_followed_id')!r}")
+    follower_id = _user_id(record, 'user_following_id', owner_id)
+    if followed_id == follower_id:
+        raise ValueError("users can't follow themselves")
+    return followed_id, follower_id
+
+
+def parse_message(record, owner_id=None):
+    """(user_id, timestamp, text) from a messages row. Raises ValueError for a bad one."""
+
+    text = record.get('text')
+    if text is None:
+        text = ''
+    if not isinstance(text, str): #json uploads can send anything
+        raise ValueError(f"text must be a string, got {text!r}")
+    if not text.strip():
+        raise ValueError("text is empty")
+    if len(text) > MAX_MESSAGE_LENGTH:
+        raise ValueError(f"text is longer than {MAX_MESSAGE_LENGTH} characters")
+
+    timestamp = record.get('timestamp')
+    if timestamp in (None, ''):
+        timestamp = datetime.utcnow()
+    else:
+        try:
+            timestamp = datetime.fromisoformat(str(timestamp))
+        except ValueError:
+            raise ValueError(f"timestamp must look like 2017-01-21 11:04:53, got {timestamp!r}")
+
+    return _user_id(record, 'user_id', owner_id), timestamp, text
+
+
+def _existing_users(user_ids):
+    return {user_id for (user_id,) in db.session.query(User.id).filter(User.id.in_(user_ids))}
+
+
+def write_follows(parsed, report):
+    """Stage a batch of (row, (followed_id, follower_id)). Returns the users whose counts changed."""
+
+    users = _existing_users({user_id for _, pair in parsed for user_id in pair})
+    pairs = {}
+    for row, (followed_id, follower_id) in parsed:
+        missing = [user_id for user_id in (followed_id, follower_id) if user_id not in users]
+        if missing:
+            report.error(row, f"no user with id {missing[0]}")
+        elif (followed_id, follower_id) in pairs:
+            report.duplicates += 1
+        else:
+            pairs[followed_id, follower_id] = row
+
+    inserted = insert_ignoring_duplicates(Follows.__table__, [
+        {'user_being_followed_id': followed_id, 'user_following_id': follower_id}
+        for followed_id, follower_id in pairs])
+    report.inserted += inserted
+    report.duplicates += len(pairs) - inserted
+    return {user_id for pair in pairs for user_id in pair} if inserted else set()
+
+
+def write_messages(parsed, report):
+    """Stage a batch of (row, (user_id, timestamp, text)). Returns the users whose counts changed."""
+
+    users = _existing_users({user_id for _, (user_id, _, _) in parsed})
+    messages = {}
+    for row, message in parsed:
+        if message[0] not in users:
+            report.error(row, f"no user with id {message[0]}")
+        elif message in messages:
+            report.duplicates += 1
+        else:
+            messages[message] = row
+
+    if messages:
+        stored = set(db.session.query(Message.user_id, Message.timestamp, Message.text)
+                     .filter(tuple_(Message.user_id, Message.timestamp, Message.text).in_(list(messages))))
+        report.duplicates += len(stored)
+        new = [message for message in messages if message not in stored]
+        if new:
+            db.session.execute(Message.__table__.insert(), [
+                {'user_id': user_id, 'timestamp': timestamp, 'text': text} for user_id, timestamp, text in new])
+            #read back the ids the inserts got so the new messages go into the tag index too
+            tagindex.index_messages(
+                db.session.query(Message.id, Message.text, Message.timestamp)
+                .filter(tuple_(Message.user_id, Message.timestamp, Message.text).in_(new)).all())
+        report.inserted += len(new)
+        return {user_id for user_id, _, _ in new}
+    return set()
+
+
+#kind -> (fields, parse, write)
+KINDS = {
+    'follows': (FOLLOWS_FIELDS, parse_follow, write_follows),
+    'messages': (MESSAGES_FIELDS, parse_message, write_messages),
+}
+
+
+def import_rows(kind, records, owner_id=None, batch_size=None, max_errors=None):
+    """Import an iterable of dicts (DictReader rows, parsed JSON) of `kind` and return an ImportReport.
+
+    With `owner_id` every row has to belong to that user (and may leave the
+    user column out). Reads and commits `batch_size` rows at a time.
+    """
+
+    fields, parse, write = KINDS[kind]
+    config = current_app.config
+    batch_size = batch_size or config['IMPORT_BATCH_SIZE']
+    report = ImportReport(max_errors or config['IMPORT_MAX_ERRORS'])
+    numbered = enumerate(records, 1)
+
+    while True:
+        batch = list(islice(numbered, batch_size))
+        if not batch:
+            return report
+
+        parsed = []
+        for row, record in batch:
+            try:
+                if not isinstance(record, dict):
+                    raise ValueError(f"expected an object with {', '.join(fields)}")
+                parsed.append((row, parse(record, owner_id)))
+            except ValueError as error:
+                report.error(row, str(error))
+
+        if not parsed:
+            continue
+        before = report.inserted, report.duplicates, report.failed, len(report.errors)
+        try:
+            refresh_counts(sorted(write(parsed, report)))
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            current_app.logger.exception("Import of %s rows %s-%s failed", kind, batch[0][0], batch[-1][0])
+            #nothing from this batch was written, report every row in it as failed instead
+            report.inserted, report.duplicates, report.failed = before[:3]
+            del report.errors[before[3]:]
+            for row, _ in parsed:
+                report.error(row, f"batch failed: {error}")
+
+
+def csv_records(kind, text_stream):
+    """DictReader over `text_stream`, after checking its header has the columns `kind` needs."""
+
+    fields, _, _ = KINDS[kind]
+    reader = csv.DictReader(text_stream)
+    required = fields[:-1] #the user column can be filled in for the logged in user
+    missing = [field for field in required if field not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError(f"CSV header is missing {', '.join(missing)}, expected {','.join(fields)}")
+    return reader
+
+
+def uploaded_records(kind, request):
+    """The rows of an import request: an uploaded CSV in the `file` field, or a JSON list as the body."""
+
+    upload = request.files.get('file')
+    if upload is not None:
+        return csv_records(kind, io.TextIOWrapper(upload.stream, encoding='utf-8', newline=''))
+
+    records = request.get_json(silent=True)
+    if not isinstance(records, list):
+        raise ValueError("Send a CSV as the 'file' field or a JSON list of rows")
+    return records
+
+
+##############################################################################
+# Setup and CLI
+
+
+def init_import(app):
+    """Set the import defaults on `app` and add the `flask import` commands.
+
+    IMPORT_BATCH_SIZE   rows validated, written and committed together
+    IMPORT_MAX_ERRORS   failed rows listed in a report, the rest are only counted
+    """
+
+    app.config.setdefault('IMPORT_BATCH_SIZE', 1000)
+    app.config.setdefault('IMPORT_MAX_ERRORS', 100)
+
+    @app.cli.group('import')
+    def import_group():
+        """Bulk import follows and messages from CSV."""
+
+    def run(kind, csv_file, batch_size):
+        try:
+            records = csv_records(kind, csv_file)
+        except ValueError as error:
+            raise click.UsageError(str(error))
+        report = import_rows(kind, records, batch_size=batch_size)
+
+        click.echo(f"Inserted {report.inserted}, already there {report.duplicates}, failed {report.failed}")
+        for row, message in report.errors:
+            click.echo(f"  row {row}: {message}", err=True)
+        if report.failed > len(report.errors):
+            click.echo(f"  ... and {report.failed - len(report.errors)} more", err=True)
+
+    batch_option = click.option('--batch-size', default=None, type=int, help="Rows per transaction.")
+
+    @import_group.command('follows')
+    @click.argument('csv_file', type=click.File('r', encoding='utf-8'))
+    @batch_option
+    def follows_command(csv_file, batch_size):
+        """Import follows from a CSV like generator/follows.csv (- for stdin)."""
+        run('follows', csv_file, batch_size)
+
+    @import_group.command('messages')
+    @click.argument('csv_file', type=click.File('r', encoding='utf-8'))
+    @batch_option
+    def messages_command(csv_file, batch_size):
+        """Import messages from a CSV like generator/messages.csv (- for stdin)."""
+        run('messages', csv_file, batch_size)
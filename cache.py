@@ -0,0 +1,190 @@
+"""In-process cache for the data behind profile and message pages.
+
+Every worker process keeps its own SingleFlightCache (LRU, at most
+CACHE_SIZE entries). Three things protect the database from it:
+
+Single flight
+    When several requests miss the same entry at once, one of them loads it
+    and the rest wait for its result instead of all running the same queries.
+
+Early probabilistic refresh
+    An entry isn't kept until it expires and then reloaded by everyone at
+    once. Each read may refresh it a little early, with a chance that rises
+    as the expiry gets closer and as the entry gets slower to load (the
+    "XFetch" rule: refresh when now - cost * CACHE_BETA * log(random) passes
+    the expiry). Requests that arrive while the refresh runs get the old
+    value.
+
+Versions
+    users.version goes up whenever something shown on a user's profile or
+    with their messages changes: the profile edit form, posting or deleting
+    a message, and refresh_counts (follows, likes, ...). Entries remember
+    the version they were loaded at and a different version is a miss, so
+    every process sees a change on its next read without anything having to
+    be broadcast. Reading the version is one primary key lookup.
+
+CACHE_TTL bounds how stale anything not covered by a version can get.
+"""
+
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from models import User
+
+_cache_lock = threading.Lock()
+
+
+class _Entry:
+    __slots__ = ('value', 'version', 'expires_at', 'cost')
+
+    def __init__(self, value, version, expires_at, cost):
+        self.value = value
+        self.version = version
+        self.expires_at = expires_at
+        self.cost = cost
+
+
+class _Flight:
+    """One load in progress that other requests for the same entry wait on."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def finish(self, value=None, error=None):
+        self.value, self.error = value, error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class SingleFlightCache:
+    """A thread safe LRU cache whose loads are coalesced and refreshed early."""
+
+    def __init__(self, maxsize=1000, ttl=60.0, beta=1.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.beta = beta
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'early_refreshes': 0, 'coalesced': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _refresh_early(self, entry, now):
+        #1 - random() is in (0, 1], log() of it is <= 0
+        return now - entry.cost * self.beta * math.log(1.0 - random.random()) >= entry.expires_at
+
+    def get(self, key, load, version=None):
+        """The value for `key` at `version`, calling load() to get it if the cache can't answer.
+
+        Loads that return None are passed through but not cached, so a
+        missing row is looked up again next time.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version != version:
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if not self._refresh_early(entry, now):
+                    self.stats['hits'] += 1
+                    return entry.value
+
+            flight = self._flights.get((key, version))
+            leader = flight is None
+            if leader:
+                flight = self._flights[key, version] = _Flight()
+                self.stats['early_refreshes' if entry is not None else 'misses'] += 1
+            elif entry is not None:
+                self.stats['hits'] += 1
+                return entry.value #somebody is already refreshing it, the current value will do meanwhile
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            started = time.monotonic()
+            value = load()
+            finished = time.monotonic()
+        except Exception as error:
+            with self._lock:
+                del self._flights[key, version]
+            flight.finish(error=error)
+            raise
+
+        with self._lock:
+            if value is not None:
+                self._entries[key] = _Entry(value, version, finished + self.ttl, finished - started)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.stats['evictions'] += 1
+            del self._flights[key, version]
+        flight.finish(value)
+        return value
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def get_cache(app=None):
+    """This process's cache for `app`, or None when CACHE_ENABLED is off."""
+
+    app = app or current_app._get_current_object()
+    if not app.config['CACHE_ENABLED']:
+        return None
+
+    with _cache_lock:
+        cache = app.extensions.get('warbler_cache')
+        if cache is None or cache[0] != os.getpid():
+            cache = (os.getpid(), SingleFlightCache(app.config['CACHE_SIZE'],
+                                                    app.config['CACHE_TTL'],
+                                                    app.config['CACHE_BETA']))
+            app.extensions['warbler_cache'] = cache
+    return cache[1]
+
+
+def bump_versions(user_ids):
+    """Stage a version bump for `user_ids`: from the commit on, every process reloads what it cached for them."""
+
+    (User.query
+     .filter(User.id.in_(user_ids))
+     .update({User.version: User.version + 1}, synchronize_session=False))
+
+
+def init_cache(app):
+    """Set the cache defaults on `app`.
+
+    CACHE_ENABLED   cache profile and message page data in each process
+    CACHE_SIZE      entries kept per process before the least recently used go
+    CACHE_TTL       seconds an entry lives (refreshed a bit before that, see above)
+    CACHE_BETA      how eagerly entries get refreshed early, 0 turns it off
+    """
+
+    app.config.setdefault('CACHE_ENABLED', True)
+    app.config.setdefault('CACHE_SIZE', 1000)
+    app.config.setdefault('CACHE_TTL', 60.0)
+    app.config.setdefault('CACHE_BETA', 1.0)
@@ -0,0 +1,80 @@
+"""Configuration profiles for create_app().
+
+Pick one with the FLASK_ENV environment variable (development, production or
+testing) or pass a name/class straight to create_app(). Anything that differs
+between machines (database, secret key, worker count) comes from environment
+variables.
+"""
+
+import os
+import tempfile
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgres:///warbler')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret") #pls change this if this goes into prod
+
+    # how many background job threads each process runs, see jobs.py for the rest of the JOBS_* settings
+    JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', 2))
+
+    # redis://host:port of the pub/sub broker live timeline updates go through, unset keeps them in-process (see livefeed.py)
+    LIVE_BROKER_URL = os.environ.get('LIVE_BROKER_URL')
+
+    # batch likes and follows in memory and write them every WRITE_BEHIND_INTERVAL seconds, see writebehind.py first
+    WRITE_BEHIND = os.environ.get('WRITE_BEHIND') == '1'
+
+    # keep profile and message page data in each process, see cache.py for the CACHE_* settings
+    CACHE_ENABLED = os.environ.get('CACHE_ENABLED', '1') == '1'
+
+    # avatars and headers are fetched once, resized and served from this directory, see imageproxy.py for the rest
+    IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'warbler-images'))
+
+    # long lists (home timeline, user search, liked warbles) are streamed out as they render instead of built up front
+    STREAM_TEMPLATES = True
+    STREAM_BUFFER_SIZE = 20 #template chunks to collect before each write
+
+    # the debug toolbar is imported and hooked up only when this is on
+    DEBUG_TB_ENABLED = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+    # compiled templates are cached here between processes, None turns the cache off
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR',
+                                        os.path.join(tempfile.gettempdir(), 'warbler-jinja-cache'))
+    # compile every template while the app is built, so a pre-fork server does it once in the master
+    PRELOAD_TEMPLATES = False
+
+
+class DevelopmentConfig(Config):
+    DEBUG_TB_ENABLED = True
+    TEMPLATES_AUTO_RELOAD = True
+
+
+class ProductionConfig(Config):
+    PRELOAD_TEMPLATES = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL', 'sqlite://') #testing.py picks the real one per worker
+    WTF_CSRF_ENABLED = False #Don't have WTForms use CSRF at all, since it's a pain to test
+    JOBS_EAGER = True #run background jobs inline so tests see their effects straight away
+    JOBS_WORKERS = 0
+    WRITE_BEHIND = False
+    CACHE_ENABLED = False #ids get reused between rolled back tests, a cached row could outlive its test
+    VIEWS_ENABLED = False #same for buffered view counts, test_viewcounts.py turns them on itself
+    VIEWS_FLUSH_INTERVAL = 0 #and flushes them by hand
+    BCRYPT_LOG_ROUNDS = 4 #hashing at full strength is most of the suite's runtime otherwise
+    TEMPLATE_CACHE_DIR = None
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'testing': TestingConfig,
+}
@@ -0,0 +1,243 @@
+"""Streaming exports of Warbler data as NDJSON or CSV.
+
+An export is a sequence of sections, one per kind of record:
+
+    users       id, email, username, image_url, bio, header_image_url, location
+    messages    id, text, timestamp, user_id (live messages, then the archive)
+    likes       user_id, message_id, timestamp
+    follows     user_being_followed_id, user_following_id
+
+The messages and follows columns are the ones generator/create_csvs.py writes
+(messages add their id), so an export can be fed back in where those CSVs are
+read. Password hashes never leave the database.
+
+NDJSON puts every section in one stream, each line tagged with its "type".
+CSV has a single header so it holds one kind per export.
+
+Nothing is built up in memory. Each section is read with Query.yield_per
+(a server side cursor on Postgres) EXPORT_CHUNK_ROWS rows at a time, lines
+are collected into pieces of about EXPORT_CHUNK_BYTES and handed out as soon
+as they are full, and gzip, when asked for, compresses each piece on the way
+out. Memory stays the same for ten warbles or ten million.
+
+/users/export streams the logged in user's own data. `flask export user` and
+`flask export dump` write one user's data or everybody's to a file or stdout.
+"""
+
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+
+import click
+from flask import current_app
+from sqlalchemy import or_
+
+from models import db, User, Message, Likes, Follows
+import messagestore
+
+FORMATS = ('ndjson', 'csv')
+
+#one row of each section, in column order
+USERS_HEADERS = ['id', 'email', 'username', 'image_url', 'bio', 'header_image_url', 'location']
+MESSAGES_HEADERS = ['id', 'text', 'timestamp', 'user_id']
+LIKES_HEADERS = ['user_id', 'message_id', 'timestamp']
+FOLLOWS_HEADERS = ['user_being_followed_id', 'user_following_id']
+
+
+def _users(user_id, chunk_rows):
+    query = db.session.query(*(getattr(User, column) for column in USERS_HEADERS)).order_by(User.id)
+    if user_id is not None:
+        query = query.filter(User.id == user_id)
+    return query.yield_per(chunk_rows)
+
+
+def _messages(user_id, chunk_rows):
+    query = (db.session.query(Message.id, Message.text, Message.timestamp, Message.user_id)
+             .order_by(Message.id))
+    if user_id is not None:
+        query = query.filter(Message.user_id == user_id)
+    yield from query.yield_per(chunk_rows)
+    yield from messagestore.iter_archived(user_id)
+
+
+def _likes(user_id, chunk_rows):
+    query = db.session.query(Likes.user_id, Likes.message_id, Likes.timestamp).order_by(Likes.id)
+    if user_id is not None:
+        query = query.filter(Likes.user_id == user_id)
+    return query.yield_per(chunk_rows)
+
+
+def _follows(user_id, chunk_rows):
+    query = (db.session.query(Follows.user_being_followed_id, Follows.user_following_id)
+             .order_by(Follows.user_being_followed_id, Follows.user_following_id))
+    if user_id is not None:
+        #both directions, who they follow and who follows them
+        query = query.filter(or_(Follows.user_being_followed_id == user_id,
+                                 Follows.user_following_id == user_id))
+    return query.yield_per(chunk_rows)
+
+
+#kind -> (headers, rows(user_id, chunk_rows)), in the order an NDJSON export writes them
+SECTIONS = {
+    'users': (USERS_HEADERS, _users),
+    'messages': (MESSAGES_HEADERS, _messages),
+    'likes': (LIKES_HEADERS, _likes),
+    'follows': (FOLLOWS_HEADERS, _follows),
+}
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def ndjson_lines(kinds, user_id, chunk_rows):
+    """One JSON object per line for every row of every section in `kinds`."""
+
+    for kind in kinds:
+        headers, rows = SECTIONS[kind]
+        for row in rows(user_id, chunk_rows):
+            record = {'type': kind}
+            record.update(zip(headers, map(_value, row)))
+            yield json.dumps(record) + '\n'
+
+
+def csv_lines(kind, user_id, chunk_rows):
+    """The header and then one CSV line per row of the `kind` section."""
+
+    headers, rows = SECTIONS[kind]
+    out = io.StringIO()
+    writer = csv.writer(out)
+
+    writer.writerow(headers)
+    for row in rows(user_id, chunk_rows):
+        writer.writerow([_value(value) for value in row])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue() #just the header when there were no rows
+
+
+def chunked(lines, chunk_bytes):
+    """Join `lines` into utf-8 pieces of at least `chunk_bytes`, so the response isn't one write per row."""
+
+    piece, size = [], 0
+    for line in lines:
+        piece.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            yield ''.join(piece).encode('utf-8')
+            piece, size = [], 0
+    if piece:
+        yield ''.join(piece).encode('utf-8')
+
+
+def gzipped(chunks, level=6):
+    """Compress `chunks` into one gzip stream as they come."""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31) #31 = gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export(fmt='ndjson', kinds=None, user_id=None, compress=False):
+    """Stream an export as bytes.
+
+    `kinds` defaults to every section for NDJSON and must name exactly one
+    for CSV. `user_id` limits it to that user's data, None exports everyone.
+    Read it inside an app context (stream_with_context for a response), the
+    queries only run as the generator is consumed.
+    """
+
+    config = current_app.config
+    kinds = list(kinds or SECTIONS)
+    unknown = [kind for kind in kinds if kind not in SECTIONS]
+    if unknown:
+        raise ValueError(f"Unknown export kind {unknown[0]!r}, pick from {', '.join(SECTIONS)}")
+
+    if fmt == 'ndjson':
+        lines = ndjson_lines(kinds, user_id, config['EXPORT_CHUNK_ROWS'])
+    elif fmt == 'csv':
+        if len(kinds) != 1:
+            raise ValueError("A CSV export holds one kind, pick one of " + ', '.join(SECTIONS))
+        lines = csv_lines(kinds[0], user_id, config['EXPORT_CHUNK_ROWS'])
+    else:
+        raise ValueError(f"Unknown export format {fmt!r}, pick from {', '.join(FORMATS)}")
+
+    chunks = chunked(lines, config['EXPORT_CHUNK_BYTES'])
+    return gzipped(chunks, config['EXPORT_GZIP_LEVEL']) if compress else chunks
+
+
+def filename(fmt, kinds, compress, prefix='warbler'):
+    """A download name like warbler-messages.csv.gz."""
+
+    kinds = list(kinds or [])
+    name = f"{prefix}-{kinds[0]}" if len(kinds) == 1 else prefix
+    return f"{name}.{fmt}" + ('.gz' if compress else '')
+
+
+def mimetype(fmt, compress):
+    if compress:
+        return 'application/gzip'
+    return 'application/x-ndjson' if fmt == 'ndjson' else 'text/csv'
+
+
+##############################################################################
+# Setup and CLI
+
+
+def _write_export(output, fmt, kinds, user_id, compress):
+    try:
+        chunks = export(fmt, kinds or None, user_id, compress)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+
+    with click.open_file(output, 'wb') as stream:
+        for chunk in chunks:
+            stream.write(chunk)
+
+
+def init_export(app):
+    """Set the export defaults on `app` and add the `flask export` commands.
+
+    EXPORT_CHUNK_ROWS   rows fetched from the cursor at a time
+    EXPORT_CHUNK_BYTES  roughly how much output is collected before each write
+    EXPORT_GZIP_LEVEL   zlib level for gzipped exports, 1 (fast) to 9 (small)
+    """
+
+    app.config.setdefault('EXPORT_CHUNK_ROWS', 1000)
+    app.config.setdefault('EXPORT_CHUNK_BYTES', 64 * 1024)
+    app.config.setdefault('EXPORT_GZIP_LEVEL', 6)
+
+    format_option = click.option('--format', 'fmt', type=click.Choice(FORMATS), default='ndjson')
+    kind_option = click.option('--kind', 'kinds', multiple=True, type=click.Choice(list(SECTIONS)),
+                               help="Section to export, repeat for several (NDJSON). Default: all.")
+    gzip_option = click.option('--gzip', 'compress', is_flag=True, help="Gzip the output.")
+    output_option = click.option('--output', '-o', default='-', help="File to write, - for stdout.")
+
+    @app.cli.group('export')
+    def export_group():
+        """Export users, messages, likes and follows."""
+
+    @export_group.command('user')
+    @click.argument('user_id', type=int)
+    @format_option
+    @kind_option
+    @gzip_option
+    @output_option
+    def user_command(user_id, fmt, kinds, compress, output):
+        """Export one user's data."""
+        _write_export(output, fmt, kinds, user_id, compress)
+
+    @export_group.command('dump')
+    @format_option
+    @kind_option
+    @gzip_option
+    @output_option
+    def dump_command(fmt, kinds, compress, output):
+        """Export everybody's data."""
+        _write_export(output, fmt, kinds, None, compress)
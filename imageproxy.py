@@ -0,0 +1,423 @@
+"""Image proxy for avatars and header images, with a thumbnail cache on disk.
+
+image_url and header_image_url can point anywhere (randomuser.me,
+splashbase...). Instead of every page making browsers hotlink the full size
+originals, templates run them through the `proxied` filter:
+
+    <img src="{{ user.image_url | proxied('thumb') }}">
+
+which turns an external URL into /images/<size>/<token>. The token is the
+URL signed with SECRET_KEY, so the proxy only ever fetches URLs the app
+itself rendered, never whatever someone types into the address bar. Local
+paths (/static/images/default-pic.png) are left alone.
+
+The first request for a (URL, size) fetches the original, resizes it to
+that size (see SIZES) and stores the result under the sha256 of the pair in
+IMAGE_CACHE_DIR. Every request after that is a file read, sent with a year
+long immutable Cache-Control, so browsers and CDNs stop asking too. Changing
+an avatar changes its URL and so its token, nothing needs invalidating.
+
+The cache is bounded to IMAGE_CACHE_MAX_BYTES. Hits bump a file's mtime,
+and once a write takes the directory past the limit the least recently used
+files are deleted until it is back under 90% of it. Processes sharing the
+directory each keep their own estimate of its size and rescan it when they
+evict, so the bound holds up to one image per process; `flask images prune`
+trims it from cron or after lowering the limit.
+
+Fetches are limited to IMAGE_PROXY_TIMEOUT seconds and
+IMAGE_PROXY_MAX_SOURCE_BYTES, follow up to MAX_REDIRECTS redirects, and
+refuse hosts that resolve to private, loopback or link-local addresses
+(unless IMAGE_PROXY_ALLOW_PRIVATE is on, as the tests need) so a profile
+picture can't be pointed at the internal network. Each hop is resolved
+once and the connection goes to the address that was checked. Concurrent requests for the same
+missing image wait for one fetch. If the fetch fails the browser is sent to
+the default image for a few minutes instead.
+
+Resizing needs Pillow. Without it the originals are proxied and cached as
+they are. Originals over MAX_SOURCE_PIXELS are refused from their header,
+before anything is decoded, and JPEGs are decoded at the smallest scale
+that still covers the size they are going to.
+"""
+
+import hashlib
+import http.client
+import ipaddress
+import os
+import socket
+import ssl
+import tempfile
+import threading
+from io import BytesIO
+from urllib.parse import urlsplit, urljoin
+
+import click
+from flask import current_app, abort, redirect, send_file, url_for
+from itsdangerous import URLSafeSerializer, BadSignature
+
+_cache_lock = threading.Lock()
+
+#name -> (width, height, crop to fill it), at twice the size the stylesheet shows them for high dpi screens
+SIZES = {
+    'thumb': (96, 96, True), #timelines (48px), user cards (70px) and the nav bar (32px)
+    'avatar': (400, 400, True), #the 200px picture on a profile
+    'header': (1200, 1200, False), #full width heroes, scaled down to fit and never cropped
+}
+
+#where a browser goes when there is no image or it couldn't be fetched
+FALLBACKS = {
+    'thumb': '/static/images/default-pic.png',
+    'avatar': '/static/images/default-pic.png',
+    'header': '/static/images/warbler-hero.jpg',
+}
+
+#hops fetch() follows before giving up on a source
+MAX_REDIRECTS = 5
+
+#biggest original resize() will decode (5000x5000, 75 MB as RGB), far past what a 1200px header needs
+MAX_SOURCE_PIXELS = 25 * 1000 * 1000
+
+#how to recognise what came back, whatever the origin claimed it was
+SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+
+def sniff(data):
+    """The image mimetype of `data` by its first bytes, or None if it isn't an image we serve."""
+
+    for signature, mimetype in SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='image-proxy')
+
+
+def proxied(url, size='thumb'):
+    """Jinja filter: where the browser should load `url` from at `size`."""
+
+    if not url:
+        return FALLBACKS[size]
+    if not current_app.config['IMAGE_PROXY_ENABLED'] or not url.startswith(('http://', 'https://')):
+        return url
+    return url_for('warbler.image_proxy', size=size, token=_serializer().dumps(url))
+
+
+##############################################################################
+# Fetching and resizing
+
+
+def check_url(url, allow_private=False):
+    """The address to connect to for `url`. Raises ValueError unless it is http(s) on a host with only public addresses.
+
+    fetch() connects to exactly this address, so a host can't pass the check
+    with a public address and then resolve to an internal one (DNS
+    rebinding) when the connection is made.
+    """
+
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError(f"Not an http(s) URL: {url!r}")
+
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    addresses = [address[0] for *_, address in socket.getaddrinfo(parts.hostname, port, proto=socket.IPPROTO_TCP)]
+    if not allow_private:
+        for address in addresses:
+            if not ipaddress.ip_address(address).is_global:
+                raise ValueError(f"{parts.hostname} resolves to a non public address")
+    return addresses[0]
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """An HTTPConnection to `address` that still says it is talking to `host`."""
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout, self.source_address)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """Same for https, the certificate is still checked against `host`."""
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, context=ssl.create_default_context(), **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout, self.source_address)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def fetch(url, config):
+    """The bytes at `url`. Raises OSError (network, HTTP errors) or ValueError (refused, too big, not an image).
+
+    Redirects are followed here rather than by urllib, so every hop goes
+    through check_url() and connects to the address it checked.
+    """
+
+    allow_private = config['IMAGE_PROXY_ALLOW_PRIVATE']
+    limit = config['IMAGE_PROXY_MAX_SOURCE_BYTES']
+
+    for _ in range(MAX_REDIRECTS + 1):
+        address = check_url(url, allow_private)
+        parts = urlsplit(url)
+        connection_class = _PinnedHTTPSConnection if parts.scheme == 'https' else _PinnedHTTPConnection
+        connection = connection_class(parts.hostname, address, port=parts.port, timeout=config['IMAGE_PROXY_TIMEOUT'])
+        try:
+            path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+            connection.request('GET', path, headers={'User-Agent': 'warbler-image-proxy'})
+            response = connection.getresponse()
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            if response.status != 200:
+                raise OSError(f"{url} answered {response.status}")
+            data = response.read(limit + 1)
+        except http.client.HTTPException as error: #a broken response, not an OSError by itself
+            raise OSError(f"{url}: {error!r}")
+        finally:
+            connection.close()
+
+        if len(data) > limit:
+            raise ValueError(f"{url} is bigger than {limit} bytes")
+        if sniff(data) is None:
+            raise ValueError(f"{url} isn't a png, jpeg, gif or webp image")
+        return data
+
+    raise ValueError(f"{url} redirected more than {MAX_REDIRECTS} times")
+
+
+def resize(data, size):
+    """`data` scaled to `size`, as PNG if it has transparency and JPEG otherwise.
+
+    Returns `data` untouched when Pillow isn't installed. Raises OSError for
+    an image Pillow can't read and ValueError for one over MAX_SOURCE_PIXELS.
+    """
+
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return data
+    Image.MAX_IMAGE_PIXELS = MAX_SOURCE_PIXELS #Pillow's own limit, it refuses to open twice this
+
+    width, height, crop = SIZES[size]
+    try:
+        image = Image.open(BytesIO(data))
+    except Image.DecompressionBombError as error: #not an OSError, would be a 500
+        raise ValueError(str(error))
+
+    with image:
+        #the header says how big it is, nothing has been decoded yet
+        if image.size[0] * image.size[1] > MAX_SOURCE_PIXELS:
+            raise ValueError(f"{image.size[0]}x{image.size[1]} is more pixels than an avatar or header needs")
+        image.draft(None, (width, height)) #jpegs decode straight at 1/2, 1/4 or 1/8 scale, the rest ignore it
+        image = ImageOps.exif_transpose(image) #phone photos come sideways otherwise
+        if crop:
+            image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+        else:
+            image.thumbnail((width, height), Image.LANCZOS)
+
+        out = BytesIO()
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image.save(out, 'PNG', optimize=True)
+        else:
+            image.convert('RGB').save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+##############################################################################
+# Disk cache
+
+
+def cache_key(url, size):
+    return hashlib.sha256(f"{size}:{url}".encode('utf-8')).hexdigest()
+
+
+class ImageCache:
+    """Resized images on disk under their cache_key(), least recently used deleted past `max_bytes`."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.pid = os.getpid()
+        self._size = None #bytes on disk as far as this process knows, None until the first scan
+        self._lock = threading.Lock()
+        self._fills = [threading.Lock() for _ in range(64)] #one fetch per key at a time, striped to stay bounded
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """The file for `key` if it is cached, marking it as just used."""
+
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def fill(self, key, load):
+        """The file for `key`, calling load() for its bytes if nobody has cached it yet."""
+
+        with self._fills[int(key[:4], 16) % len(self._fills)]:
+            path = self.get(key) #whoever held the lock before us may have just written it
+            if path is None:
+                path = self.put(key, load())
+        return path
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #write and rename so a reader never sees half an image
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        os.replace(temporary, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict(keep=path)
+        return path
+
+    def _scan(self):
+        """([(mtime, bytes, path)] of every cached file, total bytes)."""
+
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError: #another process evicted it
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files, sum(size for _, size, _ in files)
+
+    def prune(self):
+        """Evict down to the limit now, whatever this process thinks the size is. Returns the bytes left."""
+
+        with self._lock:
+            self._evict()
+            return self._size
+
+    def _evict(self, keep=None):
+        files, total = self._scan()
+        if total <= self.max_bytes:
+            self._size = total
+            return
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(files):
+            if total <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+
+def get_image_cache(app=None):
+    """This process's ImageCache for `app`."""
+
+    app = app or current_app._get_current_object()
+    with _cache_lock:
+        cache = app.extensions.get('warbler_image_cache')
+        if cache is None or cache.pid != os.getpid() or cache.directory != app.config['IMAGE_CACHE_DIR']:
+            cache = ImageCache(app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'])
+            app.extensions['warbler_image_cache'] = cache
+    return cache
+
+
+##############################################################################
+# Serving
+
+
+def image_response(size, token):
+    """The response for /images/<size>/<token>: the cached image, fetching it first if needed."""
+
+    if size not in SIZES:
+        abort(404)
+    try:
+        url = _serializer().loads(token)
+    except BadSignature:
+        abort(404)
+
+    config = current_app.config
+    key = cache_key(url, size)
+    cache = get_image_cache()
+    path = cache.get(key)
+    if path is None:
+        try:
+            path = cache.fill(key, lambda: resize(fetch(url, config), size))
+        except (OSError, ValueError) as error: #network errors are OSErrors, so are Pillow's, oversized images are ValueErrors
+            current_app.logger.warning("Image proxy couldn't get %s: %s", url, error)
+            response = redirect(FALLBACKS[size])
+            response.cache_control.max_age = config['IMAGE_PROXY_FAILURE_MAX_AGE']
+            return response
+
+    with open(path, 'rb') as cached:
+        mimetype = sniff(cached.read(12))
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=key, max_age=config['IMAGE_PROXY_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+##############################################################################
+# Setup
+
+
+def init_image_proxy(app):
+    """Set the image proxy defaults on `app` and add the `proxied` template filter.
+
+    IMAGE_PROXY_ENABLED             rewrite external image URLs to go through the proxy
+    IMAGE_CACHE_DIR                 where resized images are kept
+    IMAGE_CACHE_MAX_BYTES           how big that directory may get
+    IMAGE_PROXY_MAX_AGE             seconds browsers may keep a proxied image
+    IMAGE_PROXY_FAILURE_MAX_AGE     seconds they keep the fallback after a failed fetch
+    IMAGE_PROXY_TIMEOUT             seconds to wait on an origin
+    IMAGE_PROXY_MAX_SOURCE_BYTES    biggest original that will be fetched
+    IMAGE_PROXY_ALLOW_PRIVATE       allow origins on private and loopback addresses
+    """
+
+    app.config.setdefault('IMAGE_PROXY_ENABLED', True)
+    app.config.setdefault('IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'warbler-images'))
+    app.config.setdefault('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+    app.config.setdefault('IMAGE_PROXY_MAX_AGE', 365 * 24 * 3600)
+    app.config.setdefault('IMAGE_PROXY_FAILURE_MAX_AGE', 300)
+    app.config.setdefault('IMAGE_PROXY_TIMEOUT', 5.0)
+    app.config.setdefault('IMAGE_PROXY_MAX_SOURCE_BYTES', 10 * 1024 * 1024)
+    app.config.setdefault('IMAGE_PROXY_ALLOW_PRIVATE', False)
+
+    app.add_template_filter(proxied)
+
+    @app.cli.group()
+    def images():
+        """Manage the image proxy cache."""
+
+    @images.command('prune')
+    def prune_command():
+        """Delete least recently used images until the cache fits IMAGE_CACHE_MAX_BYTES."""
+        left = get_image_cache(app).prune()
+        click.echo(f"Image cache is {left} bytes")
@@ -0,0 +1,424 @@
+"""Database backed job queue for Warbler.
+
+Routes hand their slow follow-up work (recounting profile stats, tearing down
+a deleted account) to `enqueue` and return straight away. The jobs live in the
+`jobs` table so nothing is lost on a restart and no outside broker is needed,
+and a small pool of worker threads inside each app process runs them.
+
+A worker that dies mid job leaves it 'running'. Once that has lasted
+JOBS_LEASE_SECONDS another worker picks it up again, so handlers have to be
+safe to run twice (recounts and set based deletes are).
+"""
+
+import json
+import os
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import func, or_, and_
+
+from models import db, Job, User, Message, MessageArchive, Follows, Likes, LikeBucket, Ranking, MessageTerm, MessageViews
+
+HANDLERS = {} #kind -> function, filled in by the @job decorator below
+
+
+def job(kind):
+    """Register the decorated function as the handler for jobs of `kind`.
+
+    Handlers receive the job payload as keyword arguments. They should only
+    stage their changes on db.session; the runner commits them together with
+    the job's status so a job's work is never half applied.
+    """
+
+    def decorator(fn):
+        HANDLERS[kind] = fn
+        return fn
+
+    return decorator
+
+
+def enqueue(kind, max_attempts=None, **payload):
+    """Queue a job of `kind` and commit it.
+
+    The job is added to the current session, so it is committed in the same
+    transaction as anything the caller has already staged: the job exists if
+    and only if the write that needs it does.
+
+    With JOBS_EAGER set (tests, one-off scripts) the job is run right here
+    instead of waiting for a worker.
+    """
+
+    if kind not in HANDLERS:
+        raise KeyError(f"No job handler registered for {kind!r}")
+
+    new_job = Job(
+        kind=kind,
+        payload=json.dumps(payload),
+        max_attempts=max_attempts or current_app.config['JOBS_MAX_ATTEMPTS'],
+    )
+    db.session.add(new_job)
+    db.session.commit()
+
+    if current_app.config['JOBS_EAGER']:
+        work_once(job_id=new_job.id)
+    elif current_app.config['JOBS_WORKERS'] > 0:
+        start_workers(current_app._get_current_object()).wake()
+
+    return new_job
+
+
+##############################################################################
+# Running jobs
+
+
+def claim(job_id=None):
+    """Mark the next runnable job as running and return it, or None.
+
+    Postgres hands out rows with SKIP LOCKED so workers never queue up behind
+    each other. SQLite ignores FOR UPDATE, so the claim is also a conditional
+    UPDATE on the status and we only keep the job if our UPDATE won.
+
+    A job that has been running for longer than JOBS_LEASE_SECONDS is taken
+    to belong to a worker that died (killed, deployed over) and is claimed
+    again like a queued one. That counts as another attempt, and one that
+    has used up its attempts is marked failed instead.
+    """
+
+    while True:
+        now = datetime.utcnow()
+        lease_expired = now - timedelta(seconds=current_app.config['JOBS_LEASE_SECONDS'])
+        runnable = or_(Job.status == 'queued',
+                       and_(Job.status == 'running', Job.started_at < lease_expired))
+        query = Job.query.filter(runnable)
+        if job_id is None:
+            query = query.filter(Job.run_at <= now).order_by(Job.run_at, Job.id)
+        else:
+            query = query.filter(Job.id == job_id)
+
+        candidate = query.with_for_update(skip_locked=True).first()
+        if candidate is None:
+            db.session.commit()
+            return None
+
+        if candidate.status == 'running' and candidate.attempts >= candidate.max_attempts:
+            (Job.query
+             .filter(Job.id == candidate.id, runnable)
+             .update({Job.status: 'failed',
+                      Job.finished_at: now,
+                      Job.last_error: f"Lease expired on attempt {candidate.attempts}, no attempts left"},
+                     synchronize_session=False))
+            db.session.commit()
+            continue
+
+        #the same condition again, so of two workers reclaiming one expired job only the first one wins
+        won = (Job.query
+               .filter(Job.id == candidate.id, runnable)
+               .update({Job.status: 'running',
+                        Job.started_at: now,
+                        Job.attempts: Job.attempts + 1},
+                       synchronize_session=False))
+        db.session.commit()
+
+        if won:
+            return candidate
+        if job_id is not None:
+            return None
+
+
+def execute(claimed):
+    """Run a claimed job and record how it went.
+
+    A failure rolls back whatever the handler staged and puts the job back in
+    the queue with an exponential backoff until it runs out of attempts.
+    """
+
+    job_id = claimed.id
+    attempts = claimed.attempts
+    max_attempts = claimed.max_attempts
+    handler = HANDLERS.get(claimed.kind)
+
+    try:
+        if handler is None:
+            raise LookupError(f"No job handler registered for {claimed.kind!r}")
+        handler(**json.loads(claimed.payload))
+        Job.query.filter(Job.id == job_id).update(
+            {Job.status: 'done', Job.finished_at: datetime.utcnow(), Job.last_error: None},
+            synchronize_session=False)
+        db.session.commit()
+        return True
+
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("Job #%s (%s) failed", job_id, claimed.kind)
+
+        now = datetime.utcnow()
+        if attempts >= max_attempts:
+            changes = {Job.status: 'failed', Job.finished_at: now}
+        else:
+            delay = current_app.config['JOBS_RETRY_BACKOFF'] * 2 ** (attempts - 1)
+            changes = {Job.status: 'queued', Job.run_at: now + timedelta(seconds=delay)}
+        changes[Job.last_error] = traceback.format_exc()
+
+        Job.query.filter(Job.id == job_id).update(changes, synchronize_session=False)
+        db.session.commit()
+        return False
+
+
+def work_once(job_id=None):
+    """Claim and run a single job. Returns False if there was nothing to do."""
+
+    claimed = claim(job_id)
+    if claimed is None:
+        return False
+    execute(claimed)
+    return True
+
+
+class WorkerPool:
+    """A few daemon threads that keep pulling jobs off the queue for one app."""
+
+    def __init__(self, app, size, poll_interval):
+        self.app = app
+        self.size = size
+        self.poll_interval = poll_interval
+        self.pid = os.getpid()
+        self.threads = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def start(self):
+        for n in range(self.size):
+            thread = threading.Thread(target=self._run, name=f"warbler-jobs-{n}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def wake(self):
+        """Let an idle worker know there is something new instead of waiting out the poll."""
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    ran = work_once()
+            except Exception:
+                #the database went away or similar, dont let the thread die over it
+                self.app.logger.exception("Job worker crashed, retrying")
+                ran = False
+
+            if not ran:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+
+def start_workers(app):
+    """Return this process's worker pool for `app`, starting it on first use.
+
+    The pool is keyed on the pid so a forked worker process starts its own
+    threads rather than trusting ones that only exist in its parent.
+    """
+
+    pool = app.extensions.get('warbler_jobs')
+    if pool is None or pool.pid != os.getpid():
+        pool = WorkerPool(app, app.config['JOBS_WORKERS'], app.config['JOBS_POLL_INTERVAL']).start()
+        app.extensions['warbler_jobs'] = pool
+    return pool
+
+
+##############################################################################
+# Metrics
+
+
+def _summary(seconds):
+    """count / avg / p50 / p95 / max of a list of durations in seconds."""
+
+    if not seconds:
+        return {'count': 0, 'avg': None, 'p50': None, 'p95': None, 'max': None}
+
+    seconds = sorted(seconds)
+    pick = lambda q: seconds[min(len(seconds) - 1, int(q * len(seconds)))]
+    return {
+        'count': len(seconds),
+        'avg': sum(seconds) / len(seconds),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'max': seconds[-1],
+    }
+
+
+def queue_metrics(sample=500):
+    """Queue depth by status plus wait/run latency over the last `sample` finished jobs.
+
+    `wait` is enqueue -> last attempt started, `run` is how long that attempt took.
+    """
+
+    depth = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+    depth.update(db.session.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+
+    oldest = db.session.query(func.min(Job.created_at)).filter(Job.status == 'queued').scalar()
+
+    recent = (db.session.query(Job.created_at, Job.started_at, Job.finished_at)
+              .filter(Job.status == 'done')
+              .order_by(Job.finished_at.desc())
+              .limit(sample)
+              .all())
+
+    now = datetime.utcnow()
+    return {
+        'depth': depth,
+        'oldest_queued_seconds': (now - oldest).total_seconds() if oldest else None,
+        'wait_seconds': _summary([(started - created).total_seconds() for created, started, _ in recent]),
+        'run_seconds': _summary([(finished - started).total_seconds() for _, started, finished in recent]),
+    }
+
+
+##############################################################################
+# Handlers
+
+
+@job('refresh_counts')
+def refresh_counts(user_ids):
+    """Recount the profile stats of `user_ids` straight from the source tables.
+
+    Recounting instead of bumping by one means running the job twice (a retry,
+    or two follows landing together) still ends up with the right numbers.
+    """
+
+    if not user_ids:
+        return
+
+    archived = (db.session.query(func.coalesce(func.sum(MessageArchive.message_count), 0))
+                .filter(MessageArchive.user_id == User.id))
+    counts = {
+        User.following_count: db.session.query(func.count()).select_from(Follows).filter(Follows.user_following_id == User.id),
+        User.followers_count: db.session.query(func.count()).select_from(Follows).filter(Follows.user_being_followed_id == User.id),
+        User.likes_count: db.session.query(func.count(Likes.id)).filter(Likes.user_id == User.id),
+    }
+
+    values = {column: query.correlate(User).as_scalar() for column, query in counts.items()}
+    #archived messages still count towards the total, see messagestore.py
+    values[User.messages_count] = (
+        db.session.query(func.count(Message.id)).filter(Message.user_id == User.id).correlate(User).as_scalar()
+        + archived.correlate(User).as_scalar())
+    values[User.version] = User.version + 1 #cached profiles of these users are stale now, see cache.py
+
+    (User.query
+     .filter(User.id.in_(user_ids))
+     .update(values, synchronize_session=False))
+
+
+@job('delete_user')
+def delete_user(user_id):
+    """Remove a user and everything hanging off them with set based deletes.
+
+    Doing it row by row through the ORM relationships loads every message,
+    like and follow first. Users who followed, were followed by or liked
+    something of this user get their counts refreshed afterwards, and the
+    messages this user liked lose those likes on the trending and top boards.
+    """
+
+    from trending import forget_likes #trending imports this module, so not at the top
+
+    message_ids = db.session.query(Message.id).filter(Message.user_id == user_id).subquery()
+
+    affected = set()
+    affected.update(u for (u,) in db.session.query(Follows.user_following_id)
+                    .filter(Follows.user_being_followed_id == user_id))
+    affected.update(u for (u,) in db.session.query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id))
+    affected.update(u for (u,) in db.session.query(Likes.user_id)
+                    .filter(Likes.message_id.in_(message_ids)))
+    affected.discard(user_id)
+
+    forget_likes(user_id) #has to read their likes, so before they go
+
+    (Likes.query
+     .filter(or_(Likes.user_id == user_id, Likes.message_id.in_(message_ids)))
+     .delete(synchronize_session=False))
+    (Follows.query
+     .filter(or_(Follows.user_following_id == user_id, Follows.user_being_followed_id == user_id))
+     .delete(synchronize_session=False))
+    #their messages come off the trending and top boards too
+    (Ranking.query
+     .filter(or_(Ranking.owner_id == user_id, Ranking.message_id.in_(message_ids)))
+     .delete(synchronize_session=False))
+    LikeBucket.query.filter(LikeBucket.message_id.in_(message_ids)).delete(synchronize_session=False)
+    #and out of the tag index, along with everyone's mentions of them
+    (MessageTerm.query
+     .filter(or_(MessageTerm.term == f'@{user_id}', MessageTerm.message_id.in_(message_ids)))
+     .delete(synchronize_session=False))
+    #their view counts go too, message_views has no foreign key to cascade them
+    MessageViews.query.filter(MessageViews.message_id.in_(message_ids)).delete(synchronize_session=False)
+    Message.query.filter(Message.user_id == user_id).delete(synchronize_session=False)
+    MessageArchive.query.filter(MessageArchive.user_id == user_id).delete(synchronize_session=False)
+    User.query.filter(User.id == user_id).delete(synchronize_session=False)
+
+    refresh_counts(sorted(affected))
+
+
+##############################################################################
+# Setup and CLI
+
+
+def init_jobs(app):
+    """Set the job queue defaults on `app` and add the `flask jobs` commands.
+
+    JOBS_WORKERS        worker threads per process (0 = only `flask jobs work` runs jobs)
+    JOBS_EAGER          run jobs inline inside enqueue(), handy for tests
+    JOBS_MAX_ATTEMPTS   tries before a job is marked failed
+    JOBS_RETRY_BACKOFF  seconds before the first retry, doubled each time after
+    JOBS_POLL_INTERVAL  how long an idle worker sleeps before checking again
+    JOBS_LEASE_SECONDS  a job still running after this long is given to another worker
+    """
+
+    app.config.setdefault('JOBS_WORKERS', 2)
+    app.config.setdefault('JOBS_EAGER', False)
+    app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+    app.config.setdefault('JOBS_RETRY_BACKOFF', 2)
+    app.config.setdefault('JOBS_POLL_INTERVAL', 1.0)
+    app.config.setdefault('JOBS_LEASE_SECONDS', 600)
+
+    @app.cli.group()
+    def jobs():
+        """Manage the background job queue."""
+
+    @jobs.command('work')
+    @click.option('--workers', default=None, type=int, help="Number of worker threads.")
+    def work_command(workers):
+        """Run queued jobs in the foreground until interrupted."""
+        if workers is not None:
+            app.config['JOBS_WORKERS'] = workers
+        pool = start_workers(app)
+        click.echo(f"Running {pool.size} job workers, Ctrl+C to stop")
+        try:
+            for thread in pool.threads:
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            pool.stop()
+
+    @jobs.command('stats')
+    def stats_command():
+        """Print queue depth and latency."""
+        click.echo(json.dumps(queue_metrics(), indent=2))
+
+    @jobs.command('prune')
+    @click.option('--days', default=7, help="Delete finished jobs older than this.")
+    def prune_command(days):
+        """Delete done jobs older than --days."""
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        deleted = (Job.query
+                   .filter(Job.status == 'done', Job.finished_at < cutoff)
+                   .delete(synchronize_session=False))
+        db.session.commit()
+        click.echo(f"Deleted {deleted} jobs")
@@ -0,0 +1,535 @@
+"""Live timeline updates pushed to the browser over Server-Sent Events.
+
+messages_add() publishes every new warble on its author's channel
+(user:<id>) once it is committed. /timeline/stream holds a connection open
+for each home page, subscribed to the channels of everyone the viewer
+follows, and the page's EventSource puts whatever arrives at the top of the
+list. Nobody has to reload / (and rerun the timeline query) to see new
+warbles.
+
+Brokers
+
+    LocalBroker     the default, fans messages out inside one process. Enough
+                    for `flask run` or a single gunicorn worker.
+    RemoteBroker    for several worker processes. Every process publishes and
+                    subscribes through a Redis server at LIVE_BROKER_URL
+                    (redis://host:port). `flask live broker` runs a stand-in
+                    that speaks the same protocol for the few commands used
+                    here, so a local multi-worker setup doesn't need Redis
+                    installed. Point it at a real Redis in production.
+
+Backpressure
+
+    Each connection buffers at most LIVE_QUEUE_SIZE messages and publishing
+    never waits on a reader. A connection that falls that far behind has its
+    buffer thrown away and the browser is told to `resync` (reload once)
+    instead of the server holding an ever growing backlog for it. The
+    stand-in broker likewise drops a subscriber whose socket stops draining.
+
+An open stream holds no database connection, only a thread (or a greenlet
+under gevent) waiting on its buffer. It sends a comment every
+LIVE_HEARTBEAT seconds so dead clients get noticed, and ends after
+LIVE_MAX_SECONDS so EventSource reconnects and picks up follows made since.
+benchmarks/bench_live.py measures how many idle streams one worker can hold.
+"""
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import click
+from flask import Response, current_app
+
+#what Subscription.get() hands back once the reader has fallen too far behind
+RESYNC = object()
+
+_broker_lock = threading.Lock()
+
+
+def channel(user_id):
+    """The channel `user_id`'s new messages are published on."""
+
+    return f"user:{user_id}"
+
+
+class Subscription:
+    """One reader's bounded buffer of messages from a set of channels."""
+
+    def __init__(self, broker, channels, maxsize):
+        self.broker = broker
+        self.channels = set(channels)
+        self.maxsize = maxsize
+        self.overflowed = False
+        self.closed = False
+        self._buffer = deque()
+        self._ready = threading.Condition()
+
+    def put(self, data):
+        """Queue `data` for the reader. Never blocks, an overflow marks the subscription for a resync."""
+
+        with self._ready:
+            if self.overflowed or self.closed:
+                return
+            if len(self._buffer) >= self.maxsize:
+                self.overflowed = True
+                self._buffer.clear()
+            else:
+                self._buffer.append(data)
+            self._ready.notify()
+
+    def resync(self):
+        """Tell the reader it may have missed messages (a broker reconnect, say)."""
+
+        with self._ready:
+            self.overflowed = True
+            self._buffer.clear()
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """The next message, RESYNC after an overflow, or None if `timeout` seconds pass first."""
+
+        with self._ready:
+            if not self._buffer and not self.overflowed:
+                self._ready.wait(timeout)
+            if self.overflowed:
+                return RESYNC
+            if self._buffer:
+                return self._buffer.popleft()
+            return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """Publish/subscribe between the threads of one process."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._channels = {} #channel -> set of Subscriptions
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels, maxsize=100):
+        subscription = Subscription(self, channels, maxsize)
+        self._attach(subscription)
+        return subscription
+
+    def _attach(self, subscription):
+        """Register `subscription`, returning the channels that had no subscribers before."""
+
+        new = []
+        with self._lock:
+            for name in subscription.channels:
+                if name not in self._channels:
+                    self._channels[name] = set()
+                    new.append(name)
+                self._channels[name].add(subscription)
+        return new
+
+    def unsubscribe(self, subscription):
+        """Forget `subscription`, returning the channels left with no subscribers."""
+
+        emptied = []
+        with self._lock:
+            for name in subscription.channels:
+                subscribers = self._channels.get(name)
+                if subscribers is None:
+                    continue
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._channels[name]
+                    emptied.append(name)
+        return emptied
+
+    def publish(self, name, data):
+        """Hand `data` to every subscriber of channel `name`. Returns how many there were."""
+
+        with self._lock:
+            subscribers = list(self._channels.get(name, ()))
+        for subscription in subscribers:
+            subscription.put(data)
+        return len(subscribers)
+
+    def channels(self):
+        with self._lock:
+            return set(self._channels)
+
+    def resync_all(self):
+        with self._lock:
+            subscribers = {s for group in self._channels.values() for s in group}
+        for subscription in subscribers:
+            subscription.resync()
+
+
+##############################################################################
+# Talking to Redis (or the stand-in below)
+
+
+def _bulk(value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def _command(*args):
+    """Encode a command (or a pushed message) as a RESP array of bulk strings."""
+
+    return b'*%d\r\n' % len(args) + b''.join(_bulk(arg) for arg in args)
+
+
+def _read_reply(stream):
+    """Read one RESP value off a binary file object. Bulk strings come back as bytes."""
+
+    line = stream.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError("broker connection closed")
+
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest.decode('utf-8')
+    if kind == b'-':
+        raise ConnectionError(f"broker error: {rest.decode('utf-8')}")
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        return None if length < 0 else stream.read(length + 2)[:-2]
+    if kind == b'*':
+        length = int(rest)
+        return None if length < 0 else [_read_reply(stream) for _ in range(length)]
+    raise ConnectionError(f"broker sent something that isn't RESP: {line!r}")
+
+
+class RemoteBroker:
+    """Publish/subscribe across processes through a Redis server.
+
+    Each process keeps one connection for publishing and one for its
+    subscriptions. Local subscribers are fanned out to from a LocalBroker, so
+    the server only sees one SUBSCRIBE per channel per process however many
+    streams are open on it.
+    """
+
+    def __init__(self, url, reconnect_delay=1.0):
+        parts = urlsplit(url)
+        self.address = (parts.hostname or 'localhost', parts.port or 6379)
+        self.reconnect_delay = reconnect_delay
+        self.pid = os.getpid()
+        self.local = LocalBroker()
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+        self._subscriber = None
+        self._subscriber_lock = threading.Lock() #held while local subscriptions and the server's are changed together
+        self._listener = None
+        self._stopping = threading.Event()
+
+    def _connect(self):
+        sock = socket.create_connection(self.address)
+        return sock, sock.makefile('rb')
+
+    def publish(self, name, data):
+        with self._publish_lock:
+            for attempt in range(2): #once more on a fresh connection if the old one went away
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect()
+                    sock, reader = self._publisher
+                    sock.sendall(_command('PUBLISH', name, data))
+                    return _read_reply(reader)
+                except OSError:
+                    if self._publisher is not None:
+                        self._publisher[0].close()
+                        self._publisher = None
+                    if attempt:
+                        raise
+
+    def subscribe(self, channels, maxsize=100):
+        subscription = Subscription(self, channels, maxsize)
+        with self._subscriber_lock:
+            self._start_listener()
+            new = self.local._attach(subscription)
+            self._send('SUBSCRIBE', new)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._subscriber_lock:
+            self._send('UNSUBSCRIBE', self.local.unsubscribe(subscription))
+
+    def _send(self, command, channels):
+        #without a connection there is nothing to tell, the listener subscribes to everything when it connects
+        if channels and self._subscriber is not None:
+            try:
+                self._subscriber[0].sendall(_command(command, *sorted(channels)))
+            except OSError:
+                pass #the listener notices the broken connection and reconnects
+
+    def _start_listener(self):
+        if self._listener is None or not self._listener.is_alive():
+            self._listener = threading.Thread(target=self._listen, name='warbler-live', daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        connected_before = False
+        while not self._stopping.is_set():
+            try:
+                with self._subscriber_lock:
+                    self._subscriber = self._connect()
+                    channels = self.local.channels()
+                    if channels:
+                        self._subscriber[0].sendall(_command('SUBSCRIBE', *sorted(channels)))
+                if connected_before:
+                    self.local.resync_all() #anything published while we were gone is lost
+                connected_before = True
+
+                reader = self._subscriber[1]
+                while True:
+                    reply = _read_reply(reader)
+                    if isinstance(reply, list) and reply[0] == b'message':
+                        self.local.publish(reply[1].decode('utf-8'), reply[2].decode('utf-8'))
+
+            except OSError:
+                with self._subscriber_lock:
+                    if self._subscriber is not None:
+                        self._subscriber[0].close()
+                        self._subscriber = None
+                self._stopping.wait(self.reconnect_delay)
+
+    def close(self):
+        self._stopping.set()
+        with self._subscriber_lock:
+            if self._subscriber is not None:
+                self._subscriber[0].shutdown(socket.SHUT_RDWR)
+        with self._publish_lock:
+            if self._publisher is not None:
+                self._publisher[0].close()
+                self._publisher = None
+
+
+class _StandInHandler(socketserver.StreamRequestHandler):
+    """One client connection to the stand-in broker."""
+
+    def setup(self):
+        super().setup()
+        self.subscribed = set()
+        #replies and pushed messages go out from their own thread so a slow reader never holds up PUBLISH
+        self.outbox = queue.Queue(maxsize=self.server.outbox_size)
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def _write(self):
+        while True:
+            data = self.outbox.get()
+            if data is None:
+                return
+            try:
+                self.wfile.write(data)
+            except OSError:
+                return
+
+    def send(self, data):
+        try:
+            self.outbox.put_nowait(data)
+            return True
+        except queue.Full:
+            #not draining its socket, cut it off like Redis' client-output-buffer-limit does
+            self.server.forget(self)
+            self.request.shutdown(socket.SHUT_RDWR)
+            return False
+
+    def handle(self):
+        while True:
+            try:
+                command = _read_reply(self.rfile)
+            except (OSError, ValueError):
+                return
+            if not isinstance(command, list) or not command:
+                self.send(b'-ERR expected a command array\r\n')
+                continue
+
+            name, args = command[0].upper(), command[1:]
+            if name == b'PING':
+                self.send(b'+PONG\r\n')
+            elif name == b'PUBLISH' and len(args) == 2:
+                self.send(b':%d\r\n' % self.server.publish(args[0].decode('utf-8'), args[1]))
+            elif name in (b'SUBSCRIBE', b'UNSUBSCRIBE'):
+                for raw in args:
+                    channel_name = raw.decode('utf-8')
+                    if name == b'SUBSCRIBE':
+                        self.server.add(channel_name, self)
+                        self.subscribed.add(channel_name)
+                    else:
+                        self.server.discard(channel_name, self)
+                        self.subscribed.discard(channel_name)
+                    reply = name.lower().decode('ascii')
+                    self.send(b'*3\r\n' + _bulk(reply) + _bulk(channel_name) + b':%d\r\n' % len(self.subscribed))
+            elif name == b'QUIT':
+                self.send(b'+OK\r\n')
+                return
+            else:
+                self.send(b'-ERR unknown command\r\n')
+
+    def finish(self):
+        self.server.forget(self)
+        try:
+            self.outbox.put_nowait(None)
+        except queue.Full:
+            pass
+        super().finish()
+
+
+class StandInBroker(socketserver.ThreadingTCPServer):
+    """Just enough of Redis pub/sub (PING, PUBLISH, SUBSCRIBE, UNSUBSCRIBE) to run several workers locally."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, outbox_size=1000):
+        super().__init__(address, _StandInHandler)
+        self.outbox_size = outbox_size
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, handler):
+        with self._lock:
+            self._channels.setdefault(name, set()).add(handler)
+
+    def discard(self, name, handler):
+        with self._lock:
+            handlers = self._channels.get(name)
+            if handlers is not None:
+                handlers.discard(handler)
+                if not handlers:
+                    del self._channels[name]
+
+    def forget(self, handler):
+        for name in list(handler.subscribed):
+            self.discard(name, handler)
+
+    def publish(self, name, data):
+        with self._lock:
+            handlers = list(self._channels.get(name, ()))
+        message = _command('message', name, data)
+        return sum(handler.send(message) for handler in handlers)
+
+
+##############################################################################
+# The app side
+
+
+def get_broker(app=None):
+    """This process's broker for `app`, created on first use.
+
+    Like the job workers it is keyed on the pid, so a forked worker makes
+    its own connections instead of sharing its parent's.
+    """
+
+    app = app or current_app._get_current_object()
+    with _broker_lock:
+        broker = app.extensions.get('warbler_live')
+        if broker is None or broker.pid != os.getpid():
+            url = app.config['LIVE_BROKER_URL']
+            broker = RemoteBroker(url) if url else LocalBroker()
+            app.extensions['warbler_live'] = broker
+    return broker
+
+
+def publish_message(row):
+    """Push a just committed message (a readmodels.MessageRow) to everyone following its author.
+
+    The message is already saved, so a broker that is down only costs the
+    live update, never the post.
+    """
+
+    data = json.dumps({
+        'id': row.id,
+        'text': row.text,
+        'date': row.timestamp.strftime('%d %B %Y'),
+        'user_id': row.user_id,
+        'username': row.username,
+        'image_url': row.image_url,
+    })
+    try:
+        get_broker().publish(channel(row.user_id), data)
+    except OSError:
+        current_app.logger.warning("Couldn't publish message #%s to the live feed", row.id, exc_info=True)
+
+
+def event_stream(broker, channels, queue_size, heartbeat, max_seconds, retry_ms):
+    """Generate the text/event-stream body for a subscription to `channels`.
+
+    The subscription is made when the body starts and closed however it
+    ends (timeout, resync, or the client going away), so a response that is
+    never iterated never leaves one behind.
+    """
+
+    subscription = broker.subscribe(channels, queue_size)
+    deadline = time.monotonic() + max_seconds
+    try:
+        yield f"retry: {retry_ms}\n\n"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            data = subscription.get(min(heartbeat, remaining))
+            if data is RESYNC:
+                yield "event: resync\ndata: {}\n\n"
+                return
+            if data is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"data: {data}\n\n"
+    finally:
+        subscription.close()
+
+
+def stream_response(channels):
+    """A streamed SSE response for `channels`. Touches no request state once it is returned."""
+
+    config = current_app.config
+    body = event_stream(get_broker(), channels, config['LIVE_QUEUE_SIZE'], config['LIVE_HEARTBEAT'],
+                        config['LIVE_MAX_SECONDS'], config['LIVE_RETRY_MS'])
+    return Response(body, mimetype='text/event-stream', headers={'X-Accel-Buffering': 'no'})
+
+
+##############################################################################
+# Setup and CLI
+
+
+def init_live(app):
+    """Set the live feed defaults on `app` and add the `flask live` commands.
+
+    LIVE_BROKER_URL     redis://host:port to share messages between processes, None for in-process only
+    LIVE_QUEUE_SIZE     messages buffered per connection before it is told to resync
+    LIVE_HEARTBEAT      seconds between keepalive comments on an idle stream
+    LIVE_MAX_SECONDS    how long a stream stays open before the browser reconnects
+    LIVE_RETRY_MS       how long the browser waits before reconnecting
+    """
+
+    app.config.setdefault('LIVE_BROKER_URL', None)
+    app.config.setdefault('LIVE_QUEUE_SIZE', 100)
+    app.config.setdefault('LIVE_HEARTBEAT', 15.0)
+    app.config.setdefault('LIVE_MAX_SECONDS', 300)
+    app.config.setdefault('LIVE_RETRY_MS', 3000)
+
+    @app.cli.group()
+    def live():
+        """Live timeline updates."""
+
+    @live.command('broker')
+    @click.option('--host', default='127.0.0.1')
+    @click.option('--port', default=6379)
+    def broker_command(host, port):
+        """Run the stand-in pub/sub broker for LIVE_BROKER_URL."""
+        server = StandInBroker((host, port))
+        click.echo(f"Stand-in broker listening on redis://{host}:{port}, Ctrl+C to stop")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -0,0 +1,336 @@
+"""Time partitioned storage for messages, with a compressed cold tier.
+
+On Postgres `flask messages partition` turns `messages` into a table range
+partitioned by month on `timestamp` (messages_p202401, messages_p202402, ...
+plus messages_default for anything outside them). Other databases keep the
+single table; the (user_id, timestamp) and (timestamp) indexes give the same
+queries a range to scan instead of partitions to prune.
+
+Reads go newest first: recent_first() runs a query against the hot window
+(the last MESSAGES_HOT_DAYS days) and only touches older data when that
+didn't produce enough rows.
+
+`flask messages archive` moves whole months older than
+MESSAGES_ARCHIVE_AFTER_DAYS into message_archives, one gzipped chunk per
+user per month, and drops (or on SQLite deletes) the originals. Archived
+messages are read-only history: the profile page still lists them, but
+their likes and view counts are removed, they drop off the trending and top
+boards and the tag pages, and they can't be opened or deleted one by one.
+"""
+
+import gzip
+import json
+from datetime import datetime, timedelta
+from itertools import groupby
+
+import click
+from flask import current_app
+from sqlalchemy import func
+
+from models import db, Message, MessageArchive, Likes
+from jobs import refresh_counts
+from trending import forget_messages
+import tagindex
+import viewcounts
+
+PARTITION_PREFIX = 'messages_p'
+
+
+def hot_cutoff():
+    """Messages newer than this live in the hot window."""
+
+    return datetime.utcnow() - timedelta(days=current_app.config['MESSAGES_HOT_DAYS'])
+
+
+def recent_first(query, limit=None, chunk_size=None):
+    """Iterate `query` (ordered newest first) hot window first, older rows only if needed.
+
+    The timestamp bound lets Postgres skip every partition outside the
+    window. With a `limit` the older half never runs if the hot window
+    already filled it; without one it only runs once the hot rows are used
+    up, which for a streamed page is after they've been sent. `chunk_size`
+    reads each half through a server side cursor (Query.yield_per).
+    """
+
+    cutoff = hot_cutoff()
+    taken = 0
+
+    for part in (query.filter(Message.timestamp >= cutoff), query.filter(Message.timestamp < cutoff)):
+        if limit is not None:
+            if taken >= limit:
+                return
+            part = part.limit(limit - taken)
+        if chunk_size is not None:
+            part = part.yield_per(chunk_size)
+        for row in part:
+            taken += 1
+            yield row
+
+
+##############################################################################
+# Cold storage
+
+
+def _month_start(when):
+    return datetime(when.year, when.month, 1)
+
+
+def _next_month(when):
+    return datetime(when.year + when.month // 12, when.month % 12 + 1, 1)
+
+
+def _pack(messages):
+    return gzip.compress(json.dumps(
+        [[m_id, text, timestamp.isoformat()] for m_id, text, timestamp in messages]).encode('utf-8'))
+
+
+def _unpack(data):
+    return [(m_id, text, datetime.fromisoformat(timestamp))
+            for m_id, text, timestamp in json.loads(gzip.decompress(data).decode('utf-8'))]
+
+
+def archived_messages(user_id, limit):
+    """Up to `limit` of `user_id`'s archived messages as (id, text, timestamp), newest first."""
+
+    found = []
+    chunks = (db.session.query(MessageArchive.data)
+              .filter(MessageArchive.user_id == user_id)
+              .order_by(MessageArchive.period_start.desc()))
+    for (data,) in chunks.yield_per(10):
+        found.extend(_unpack(data))
+        if len(found) >= limit:
+            break
+    return found[:limit]
+
+
+def iter_archived(user_id=None):
+    """Every archived message of `user_id` (or of everyone) as (id, text, timestamp, user_id).
+
+    Only one chunk is unpacked at a time, so this is safe to run over the
+    whole archive.
+    """
+
+    chunks = (db.session.query(MessageArchive.user_id, MessageArchive.data)
+              .order_by(MessageArchive.user_id, MessageArchive.period_start))
+    if user_id is not None:
+        chunks = chunks.filter(MessageArchive.user_id == user_id)
+    for owner_id, data in chunks.yield_per(10):
+        for m_id, text, timestamp in _unpack(data):
+            yield m_id, text, timestamp, owner_id
+
+
+def _archive_range(start, end):
+    """Copy every message in [start, end) into per user archive chunks and delete its likes.
+
+    Returns the ids of the users whose counts changed. Rows already archived
+    for the same user and month (an earlier run that was interrupted) are
+    merged in rather than duplicated.
+    """
+
+    rows = (db.session.query(Message.user_id, Message.id, Message.text, Message.timestamp)
+            .filter(Message.timestamp >= start, Message.timestamp < end)
+            .order_by(Message.user_id, Message.timestamp.desc())
+            .yield_per(1000))
+
+    affected = set()
+    archived_ids = []
+    for user_id, messages in groupby(rows, key=lambda row: row[0]):
+        messages = [(m_id, text, timestamp) for _, m_id, text, timestamp in messages]
+        archived_ids.extend(m_id for m_id, _, _ in messages)
+        affected.add(user_id)
+
+        chunk = MessageArchive.query.filter_by(user_id=user_id, period_start=start).first()
+        if chunk is None:
+            chunk = MessageArchive(user_id=user_id, period_start=start, period_end=end)
+            db.session.add(chunk)
+        else:
+            known = {m_id for m_id, _, _ in messages}
+            messages += [m for m in _unpack(chunk.data) if m[0] not in known]
+            messages.sort(key=lambda m: m[2], reverse=True)
+        chunk.message_count = len(messages)
+        chunk.data = _pack(messages)
+
+    for n in range(0, len(archived_ids), 1000):
+        batch = archived_ids[n:n + 1000]
+        affected.update(u for (u,) in db.session.query(Likes.user_id).filter(Likes.message_id.in_(batch)))
+        Likes.query.filter(Likes.message_id.in_(batch)).delete(synchronize_session=False)
+        forget_messages(batch)
+        tagindex.forget_messages(batch)
+        viewcounts.forget_messages(batch)
+
+    return affected
+
+
+def archive_before(cutoff):
+    """Archive every whole month that ended before `cutoff`. Returns (months, affected user ids)."""
+
+    oldest = db.session.query(func.min(Message.timestamp)).scalar()
+    if oldest is None:
+        return 0, set()
+
+    partitioned = is_partitioned()
+    months = 0
+    affected = set()
+    start = _month_start(oldest)
+
+    while _next_month(start) <= cutoff:
+        end = _next_month(start)
+        month_affected = _archive_range(start, end)
+
+        if partitioned and _partition_exists(_partition_name(start)):
+            name = _partition_name(start)
+            db.session.execute(f'ALTER TABLE messages DETACH PARTITION "{name}"')
+            db.session.execute(f'DROP TABLE "{name}"')
+        #rows that landed in messages_default (or the whole table on sqlite)
+        Message.query.filter(Message.timestamp >= start, Message.timestamp < end).delete(synchronize_session=False)
+
+        refresh_counts(sorted(month_affected))
+        db.session.commit()
+        affected |= month_affected
+        months += 1
+        start = end
+
+    return months, affected
+
+
+##############################################################################
+# Postgres partitions
+
+
+def _is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _partition_name(month):
+    return f"{PARTITION_PREFIX}{month:%Y%m}"
+
+
+def _partition_exists(name):
+    return db.session.execute("SELECT to_regclass(:name) IS NOT NULL", {'name': name}).scalar()
+
+
+def is_partitioned():
+    """Is `messages` a partitioned table? Always False off Postgres."""
+
+    if not _is_postgres():
+        return False
+    return bool(db.session.execute(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'messages'::regclass").scalar())
+
+
+def ensure_partitions(months_ahead=2, since=None):
+    """Create the monthly partitions from `since` (default: this month) to `months_ahead` from now.
+
+    Run this ahead of time (a daily cron is plenty): a row for a month with
+    no partition lands in messages_default, and Postgres refuses to create a
+    partition whose range already has rows sitting in the default one.
+    """
+
+    start = _month_start(since or datetime.utcnow())
+    last = _month_start(datetime.utcnow())
+    for _ in range(months_ahead):
+        last = _next_month(last)
+
+    created = []
+    while start <= last:
+        name = _partition_name(start)
+        if not _partition_exists(name):
+            db.session.execute(
+                f"""CREATE TABLE "{name}" PARTITION OF messages
+                    FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{_next_month(start):%Y-%m-%d}')""")
+            created.append(name)
+        start = _next_month(start)
+
+    db.session.execute("CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT")
+    return created
+
+
+def partition_messages(months_ahead=2):
+    """Rebuild a plain `messages` table as a monthly range partitioned one, keeping every row.
+
+    The primary key of a partitioned table has to include the partition
+    key, so it becomes (id, timestamp); ids still come from the same
+    sequence and stay unique. For the same reason likes.message_id can no
+    longer be a foreign key to messages, so the routes and jobs delete likes
+    themselves instead of relying on ON DELETE CASCADE.
+    """
+
+    if is_partitioned():
+        created = ensure_partitions(months_ahead)
+        db.session.commit()
+        return created
+
+    oldest = db.session.query(func.min(Message.timestamp)).scalar()
+
+    statements = [
+        "ALTER TABLE messages RENAME TO messages_unpartitioned",
+        "ALTER SEQUENCE messages_id_seq OWNED BY NONE",
+        """CREATE TABLE messages (LIKE messages_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+           PARTITION BY RANGE (timestamp)""",
+    ]
+    for statement in statements:
+        db.session.execute(statement)
+
+    created = ensure_partitions(months_ahead, since=oldest)
+
+    statements = [
+        "INSERT INTO messages SELECT * FROM messages_unpartitioned",
+        "DROP TABLE messages_unpartitioned CASCADE", #takes the likes -> messages foreign key with it
+        "ALTER SEQUENCE messages_id_seq OWNED BY messages.id",
+        "ALTER TABLE messages ADD PRIMARY KEY (id, timestamp)",
+        """ALTER TABLE messages ADD FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE""",
+        "CREATE INDEX ix_messages_timestamp ON messages (timestamp)",
+        "CREATE INDEX ix_messages_user_id_timestamp ON messages (user_id, timestamp)",
+    ]
+    for statement in statements:
+        db.session.execute(statement)
+    db.session.commit()
+
+    return created
+
+
+##############################################################################
+# Setup and CLI
+
+
+def init_message_store(app):
+    """Set the message store defaults on `app` and add the `flask messages` commands.
+
+    MESSAGES_HOT_DAYS             how far back recent_first() looks before falling back to older rows
+    MESSAGES_ARCHIVE_AFTER_DAYS   months that ended this long ago get archived by `flask messages archive`
+    """
+
+    app.config.setdefault('MESSAGES_HOT_DAYS', 30)
+    app.config.setdefault('MESSAGES_ARCHIVE_AFTER_DAYS', 365)
+
+    @app.cli.group()
+    def messages():
+        """Manage message partitions and the cold archive."""
+
+    @messages.command('partition')
+    @click.option('--months-ahead', default=2, help="Future months to create partitions for.")
+    def partition_command(months_ahead):
+        """Convert messages to a partitioned table (Postgres only)."""
+        if not _is_postgres():
+            click.echo("Partitioning needs Postgres, leaving the single messages table as it is")
+            return
+        created = partition_messages(months_ahead)
+        click.echo(f"Created partitions: {', '.join(created) or 'none'}")
+
+    @messages.command('maintain')
+    @click.option('--months-ahead', default=2, help="Future months to create partitions for.")
+    def maintain_command(months_ahead):
+        """Create upcoming monthly partitions (run daily)."""
+        if is_partitioned():
+            created = ensure_partitions(months_ahead)
+            db.session.commit()
+            click.echo(f"Created partitions: {', '.join(created) or 'none'}")
+
+    @messages.command('archive')
+    @click.option('--older-than-days', default=None, type=int,
+                  help="Archive whole months that ended before this many days ago.")
+    def archive_command(older_than_days):
+        """Move old months into the compressed archive."""
+        days = older_than_days if older_than_days is not None else app.config['MESSAGES_ARCHIVE_AFTER_DAYS']
+        months, affected = archive_before(datetime.utcnow() - timedelta(days=days))
+        click.echo(f"Archived {months} months touching {len(affected)} users")
@@ -4,6 +4,7 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -49,10 +50,20 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+    )
+    #when the like happened, trending.py buckets likes by the hour with this
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
     )
 #on delete just makes it so the value its attached to dissappeares so will it and it wont cause errors 
 
+    #a user can like a message once, but a message can be liked by lots of users
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
+
 class User(db.Model):
     """User in the system."""
 
@@ -104,6 +115,15 @@ class User(db.Model):
         db.Text,
         nullable=False,
     )
+    #denormalized counts shown on the profile cards so the templates dont have to load every related row just to call
+    #| length on it. these are kept up to date by the refresh_counts job in jobs.py
+    messages_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    #goes up by one whenever anything shown on the profile or with their messages changes, the page caches in
+    #cache.py compare it to know when what they kept is out of date
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     #a relationship with messages so that we may call User.messages to get all the messages attached to a user
     messages = db.relationship('Message')
 
@@ -142,7 +162,8 @@ class User(db.Model):
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
+        #by id so cached profile rows from readmodels.py work here as well as Users
+        found_user_list = [user for user in self.following if user.id == other_user.id]
         return len(found_user_list) == 1
 
     @classmethod
@@ -208,7 +229,8 @@ class Message(db.Model): #this class will be similar in function to our tweet on
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow, #no () so every message gets the time it was written, not the time the server started
+        index=True,
     )
     #we need to know who the fuck warbled this crap so gimme a unique primary key senapi 
     user_id = db.Column(
@@ -219,6 +241,162 @@ class Message(db.Model): #this class will be similar in function to our tweet on
     #and well a relationship so we know whichh user warbled 
     user = db.relationship('User')
 
+    #profiles read a user's newest messages first, this lets them do that straight off an index
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+
+class MessageArchive(db.Model):
+    """A compressed chunk of one user's old messages moved out of the messages table.
+
+    messagestore.py archives whole months at a time; each user's messages for
+    that month end up gzipped together in one row so they can still be read
+    back for the profile page.
+    """
+
+    __tablename__ = 'message_archives'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+    #the month this chunk covers, [period_start, period_end)
+    period_start = db.Column(db.DateTime, nullable=False)
+    period_end = db.Column(db.DateTime, nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+    #gzipped json list of [id, text, timestamp] newest first
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'period_start'),
+    )
+
+class LikeBucket(db.Model):
+    """How many likes a message got in one hour, what the trending window slides over."""
+
+    __tablename__ = 'like_buckets'
+
+    #no foreign key, a partitioned messages table can't be the target of one (see messagestore.py)
+    message_id = db.Column(db.Integer, primary_key=True)
+    #the start of the hour these likes fall in
+    bucket = db.Column(db.DateTime, primary_key=True)
+    likes = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_like_buckets_bucket', 'bucket'),
+    )
+
+
+class Ranking(db.Model):
+    """A message's score on one of the boards in trending.py.
+
+    Reading a board is an index scan over (board, owner_id, score) that stops
+    after the first K rows, however many likes went into the scores.
+    """
+
+    __tablename__ = 'rankings'
+
+    #'trending' or 'top'
+    board = db.Column(db.Text, primary_key=True)
+    #whose board this is, the author for 'top' and 0 for boards everyone shares
+    owner_id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_rankings_board_owner_score', 'board', 'owner_id', 'score'),
+    )
+
+
+class MessageTerm(db.Model):
+    """One #tag or @mention found in a message, the inverted index tagindex.py reads timelines from.
+
+    A tag timeline is an index scan over (term, timestamp, message_id) that
+    starts at the page's cursor and stops after one page.
+    """
+
+    __tablename__ = 'message_terms'
+
+    #'#' and the lowercased tag, or '@' and the id of the user mentioned (so renaming them keeps their mentions)
+    term = db.Column(db.Text, primary_key=True)
+    #no foreign key, same as like_buckets
+    message_id = db.Column(db.Integer, primary_key=True)
+    #copied from the message so a page can be read from this table alone, newest first
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_message_terms_term_timestamp', 'term', 'timestamp', 'message_id'),
+        db.Index('ix_message_terms_message_id', 'message_id'),
+    )
+
+
+class MessageViews(db.Model):
+    """How often a message has been opened and shown on timelines, written in batches by viewcounts.py."""
+
+    __tablename__ = 'message_views'
+
+    #no foreign key, same as like_buckets
+    message_id = db.Column(db.Integer, primary_key=True)
+    #times messages_show served it
+    views = db.Column(db.Integer, nullable=False, default=0)
+    #times a timeline listed it
+    impressions = db.Column(db.Integer, nullable=False, default=0)
+    #estimated distinct people behind those, kept next to the sketch so pages never decode it
+    viewers = db.Column(db.Integer, nullable=False, default=0)
+    #the HyperLogLog registers the estimate comes from, one byte each
+    sketch = db.Column(db.LargeBinary)
+
+
+class Job(db.Model):
+    """A unit of deferred work waiting in (or already run from) the job queue."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+    #the name of the handler registered in jobs.py that knows how to run this job
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+    #keyword arguments for the handler stored as a json string
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+    #queued -> running -> done, or back to queued for a retry, or failed once we run out of attempts
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    #a job is not picked up before run_at, this is how retries back off
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.kind} {self.status}>"
+
 #the basic code that lets us connect to the db 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -228,3 +406,20 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+
+
+#bulk writers (write-behind batches, imports) insert many rows at once and let the database drop the ones it already has
+def insert_ignoring_duplicates(table, rows, chunk_size=300):
+    """Multi-row INSERTs of `rows`, `chunk_size` rows a statement, skipping rows that are already there.
+
+    Returns how many rows were actually inserted.
+    """
+
+    inserted = 0
+    for n in range(0, len(rows), chunk_size):
+        if db.engine.dialect.name == 'postgresql':
+            statement = pg_insert(table).on_conflict_do_nothing()
+        else:
+            statement = table.insert().prefix_with('OR IGNORE')
+        inserted += db.session.execute(statement.values(rows[n:n + chunk_size])).rowcount
+    return inserted
@@ -0,0 +1,245 @@
+"""Lightweight read models for rendering timelines.
+
+Timelines only ever show who wrote a warble, their avatar, the text and the
+date. Loading full Message and User objects for that drags every column
+(password hash, bio, header image...) into the identity map and leaves lazy
+loads waiting to fire from inside the template. These helpers select just the
+rendered columns into plain namedtuples instead.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import and_, tuple_
+
+from models import db, Message, User, Likes, Follows, Ranking, MessageTerm, MessageViews
+from cache import get_cache
+from tagindex import encode_cursor
+import messagestore
+
+#how many rows to pull from the server side cursor at a time when streaming
+STREAM_CHUNK_SIZE = 100
+
+#one row of a timeline, shared by home.html, users/show.html and users/show_warbles.html
+MessageRow = namedtuple('MessageRow', ['id', 'text', 'timestamp', 'user_id', 'username', 'image_url'])
+
+#what users/detail.html shows about a user, cached by profile()
+ProfileRow = namedtuple('ProfileRow', ['id', 'username', 'image_url', 'header_image_url', 'bio', 'location',
+                                       'messages_count', 'following_count', 'followers_count', 'likes_count',
+                                       'version'])
+
+#a message's counters from viewcounts.py, as of the last flush
+ViewCounts = namedtuple('ViewCounts', ['views', 'impressions', 'viewers'])
+
+#how many messages a profile page lists
+PROFILE_MESSAGES = 100
+
+
+def message_rows_query():
+    """Query for MessageRow columns of every message joined to its author."""
+
+    return (db.session
+            .query(Message.id, Message.text, Message.timestamp,
+                   Message.user_id, User.username, User.image_url)
+            .join(User, Message.user_id == User.id))
+
+
+def to_rows(query):
+    """Run a message_rows_query() based query and pack the results into MessageRows."""
+
+    return [MessageRow._make(row) for row in query]
+
+
+def stream_rows(query, chunk_size=STREAM_CHUNK_SIZE):
+    """Like to_rows() but lazily, fetching `chunk_size` rows at a time.
+
+    yield_per() turns on stream_results, so on Postgres this reads from a
+    server side cursor instead of buffering the whole result in the driver.
+    """
+
+    for row in query.yield_per(chunk_size):
+        yield MessageRow._make(row)
+
+
+def _rows(query, stream):
+    return stream_rows(query) if stream else to_rows(query)
+
+
+def timeline(user_ids, limit=None, stream=False):
+    """Newest first messages written by any of `user_ids`.
+
+    The hot window is read first and older messages only if it falls short,
+    see messagestore.recent_first(). With `stream` the rows come back as a
+    generator for streamed rendering.
+    """
+
+    query = (message_rows_query()
+             .filter(Message.user_id.in_(user_ids))
+             .order_by(Message.timestamp.desc()))
+
+    if stream:
+        return (MessageRow._make(row) for row in
+                messagestore.recent_first(query, limit, chunk_size=STREAM_CHUNK_SIZE))
+    return to_rows(messagestore.recent_first(query, limit))
+
+
+def user_timeline(user_id, limit=100):
+    """Newest first messages written by `user_id`, topped up from the archive if there aren't `limit` live ones."""
+
+    rows = timeline([user_id], limit)
+    if len(rows) >= limit:
+        return rows
+
+    archived = messagestore.archived_messages(user_id, limit - len(rows))
+    if archived:
+        if rows:
+            username, image_url = rows[0].username, rows[0].image_url
+        else:
+            username, image_url = (db.session.query(User.username, User.image_url)
+                                   .filter(User.id == user_id).one())
+        rows += [MessageRow(m_id, text, timestamp, user_id, username, image_url)
+                 for m_id, text, timestamp in archived]
+    return rows
+
+
+def liked_timeline(user_id, stream=False):
+    """Messages `user_id` has liked, most recently posted first."""
+
+    return _rows(message_rows_query()
+                 .join(Likes, Likes.message_id == Message.id)
+                 .filter(Likes.user_id == user_id)
+                 .order_by(Message.id.desc()), stream)
+
+
+def ranked_timeline(board, owner_id, limit):
+    """The first `limit` messages on one of trending.py's boards, highest score first.
+
+    Only ever walks `limit` rows of the rankings index, and the join drops
+    any message that has been deleted since it was scored.
+    """
+
+    return to_rows(message_rows_query()
+                   .join(Ranking, and_(Ranking.message_id == Message.id,
+                                       Ranking.board == board,
+                                       Ranking.owner_id == owner_id))
+                   .order_by(Ranking.score.desc(), Message.id.desc())
+                   .limit(limit))
+
+
+def trending_timeline(limit):
+    """What's trending right now."""
+
+    return ranked_timeline('trending', 0, limit)
+
+
+def top_timeline(user_id, limit):
+    """`user_id`'s most liked messages."""
+
+    return ranked_timeline('top', user_id, limit)
+
+
+def term_page(term, limit, before=None):
+    """One page of the messages tagindex.py filed under `term`, newest first.
+
+    Returns (MessageRows, cursor for the next page or None on the last one).
+    `before` is a decoded cursor from the previous page; the page starts
+    right after it in the (term, timestamp, message_id) index.
+    """
+
+    query = (message_rows_query()
+             .join(MessageTerm, MessageTerm.message_id == Message.id)
+             .filter(MessageTerm.term == term))
+    if before is not None:
+        query = query.filter(tuple_(MessageTerm.timestamp, MessageTerm.message_id) < tuple_(*before))
+
+    rows = to_rows(query
+                   .order_by(MessageTerm.timestamp.desc(), MessageTerm.message_id.desc())
+                   .limit(limit + 1)) #one extra to know whether there is a next page
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1])
+    return rows, None
+
+
+def _cached(key, load, version):
+    cache = get_cache()
+    return load() if cache is None else cache.get(key, load, version)
+
+
+def _user_version(user_id):
+    return db.session.query(User.version).filter(User.id == user_id).scalar()
+
+
+def _load_profile(user_id):
+    row = (db.session.query(*(getattr(User, column) for column in ProfileRow._fields))
+           .filter(User.id == user_id)
+           .first())
+    return row and ProfileRow._make(row)
+
+
+def profile(user_id):
+    """`user_id`'s ProfileRow, or None if there is no such user.
+
+    Costs one version lookup while the cached copy is current, see cache.py.
+    """
+
+    cache = get_cache()
+    if cache is None:
+        return _load_profile(user_id)
+
+    version = _user_version(user_id)
+    if version is None:
+        return None
+    return cache.get(('profile', user_id), lambda: _load_profile(user_id), version)
+
+
+def profile_messages(profile):
+    """The messages listed on `profile`'s page, cached until their author's version moves on."""
+
+    return _cached(('profile_messages', profile.id),
+                   lambda: user_timeline(profile.id, PROFILE_MESSAGES), profile.version)
+
+
+def _load_message(message_id):
+    row = (message_rows_query()
+           .add_columns(User.version, MessageViews.views, MessageViews.impressions, MessageViews.viewers)
+           .outerjoin(MessageViews, MessageViews.message_id == Message.id) #same query, no row until its first flush
+           .filter(Message.id == message_id)
+           .first())
+    return row and (MessageRow._make(row[:6]), row[6], ViewCounts._make(count or 0 for count in row[7:]))
+
+
+def message_with_author(message_id):
+    """(MessageRow, author's ProfileRow, ViewCounts) for `message_id`, or None if it doesn't exist.
+
+    A cached message is only trusted while its author's version is the one
+    it was loaded with, so deleting it (or the author changing their name or
+    avatar) shows on the next request. Its view counts are only as fresh as
+    the cached copy.
+    """
+
+    key, load = ('message', message_id), lambda: _load_message(message_id)
+    cache = get_cache()
+    loaded = load() if cache is None else cache.get(key, load)
+    if loaded is None:
+        return None
+
+    author = profile(loaded[0].user_id)
+    if cache is not None and author is not None and loaded[1] != author.version:
+        cache.discard(key)
+        loaded = cache.get(key, load)
+        if loaded is None:
+            return None
+    return author and (loaded[0], author, loaded[2])
+
+
+def liked_ids(user_id):
+    """Set of message ids `user_id` has liked, for lighting up the like buttons."""
+
+    return {message_id for (message_id,) in
+            db.session.query(Likes.message_id).filter(Likes.user_id == user_id)}
+
+
+def following_ids(user_id):
+    """Ids of the users `user_id` follows."""
+
+    return [followed_id for (followed_id,) in
+            db.session.query(Follows.user_being_followed_id).filter(Follows.user_following_id == user_id)]
@@ -1,9 +1,13 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from app import create_app
+from models import db, User, Message, Follows
+from jobs import refresh_counts
+from trending import rebuild
+from tagindex import backfill
 
+app = create_app()
 
 db.drop_all()
 db.create_all()
@@ -17,4 +21,13 @@ with open('generator/messages.csv') as messages:
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+# bulk inserts skip the routes, so fill in the profile counts by hand
+refresh_counts([user_id for (user_id,) in db.session.query(User.id)])
+
 db.session.commit()
+
+# and the trending / top boards from whatever likes there are
+rebuild()
+
+# and file the #tags and @mentions of the seeded messages
+backfill(app=app)
@@ -0,0 +1,186 @@
+"""#hashtag and @mention index.
+
+Message text is tokenized once, when the message is written, and every
+#tag and @mention in it becomes a row of message_terms:
+
+    #tag        '#' + the tag lowercased, so #Flask and #flask are one tag
+    @username   '@' + the id of the user, looked up when the message is
+                written. Names that aren't a user are skipped, and renaming
+                a user keeps the mentions they already had.
+
+A tag page or the "mentions of me" page then reads one index range instead
+of scanning every message's text with LIKE. Pages use keyset pagination:
+the cursor is the (timestamp, message_id) of the last row shown, so page 50
+costs the same as page 1 and rows arriving in between don't shift anything.
+
+Rows go away with their message (messages_destroy, the delete_user job,
+archiving), and the timelines join messages anyway so nothing deleted can
+show up.
+
+`flask tags backfill` indexes messages written before the index existed. It
+splits the messages table into id ranges and indexes TAGS_BACKFILL_WORKERS
+ranges at once, each in its own session and transaction. It can be run
+again or resumed: rows that are already there are skipped.
+"""
+
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import click
+from flask import current_app
+from markupsafe import Markup, escape
+from sqlalchemy import func
+
+from models import db, User, Message, MessageTerm, insert_ignoring_duplicates
+
+#a # or @ at the start of the text or after something that isn't part of a word, so emails and anchors don't count
+TAG_RE = re.compile(r'(?<![\w#@&])#(\w{1,64})')
+MENTION_RE = re.compile(r'(?<![\w@])@(\w[\w.]*)')
+
+
+def tags_in(text):
+    """The lowercased tags in `text`, without the #."""
+
+    return {tag.lower() for tag in TAG_RE.findall(text)}
+
+
+def mentions_in(text):
+    """The usernames `text` mentions, without the @ (a trailing full stop isn't part of the name)."""
+
+    return {name.rstrip('.') for name in MENTION_RE.findall(text)}
+
+
+def tag_term(tag):
+    return '#' + tag.lower()
+
+
+def mention_term(user_id):
+    return f'@{user_id}'
+
+
+def _term_rows(messages):
+    """message_terms rows for (id, text, timestamp) `messages`, with one query to resolve every mention."""
+
+    found = [(m_id, timestamp, tags_in(text), mentions_in(text)) for m_id, text, timestamp in messages]
+
+    names = set().union(*(mentions for _, _, _, mentions in found))
+    user_ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(names))) if names else {}
+
+    return [{'term': term, 'message_id': m_id, 'timestamp': timestamp}
+            for m_id, timestamp, tags, mentions in found
+            for term in sorted({tag_term(tag) for tag in tags} |
+                               {mention_term(user_ids[name]) for name in mentions if name in user_ids})]
+
+
+def index_messages(messages):
+    """Stage the index rows for (id, text, timestamp) `messages`. Returns how many there were."""
+
+    rows = _term_rows(messages)
+    if rows:
+        insert_ignoring_duplicates(MessageTerm.__table__, rows)
+    return len(rows)
+
+
+def forget_messages(message_ids):
+    """Stage taking deleted (or archived) messages out of the index."""
+
+    MessageTerm.query.filter(MessageTerm.message_id.in_(message_ids)).delete(synchronize_session=False)
+
+
+##############################################################################
+# Pages
+
+
+def encode_cursor(row):
+    """The cursor for the page after the one ending in `row` (a MessageRow), see readmodels.term_page()."""
+
+    return f"{row.timestamp.isoformat()}_{row.id}"
+
+
+def decode_cursor(cursor):
+    """(timestamp, message_id) from encode_cursor(). Raises ValueError if it isn't one."""
+
+    timestamp, message_id = cursor.rsplit('_', 1)
+    return datetime.fromisoformat(timestamp), int(message_id)
+
+
+def link_tags(text):
+    """Jinja filter: `text` escaped, with every #tag linked to its page."""
+
+    return Markup(TAG_RE.sub(lambda match: Markup('<a href="/tags/{}">#{}</a>').format(match[1].lower(), match[1]),
+                             str(escape(text))))
+
+
+##############################################################################
+# Backfill
+
+
+def _id_ranges(chunk_size):
+    low, high = db.session.query(func.min(Message.id), func.max(Message.id)).one()
+    if low is None:
+        return []
+    return [(start, min(start + chunk_size, high + 1)) for start in range(low, high + 1, chunk_size)]
+
+
+def index_range(start, end):
+    """Index the messages with ids in [start, end) and commit. Returns how many terms were found."""
+
+    messages = (db.session.query(Message.id, Message.text, Message.timestamp)
+                .filter(Message.id >= start, Message.id < end))
+    found = index_messages(messages.all())
+    db.session.commit()
+    return found
+
+
+def backfill(chunk_size=None, workers=None, app=None):
+    """Index every message already written, `workers` id ranges at a time. Returns (ranges, terms)."""
+
+    app = app or current_app._get_current_object()
+    chunk_size = chunk_size or app.config['TAGS_BACKFILL_CHUNK']
+    workers = workers or app.config['TAGS_BACKFILL_WORKERS']
+    ranges = _id_ranges(chunk_size)
+
+    if workers <= 1:
+        return len(ranges), sum(index_range(start, end) for start, end in ranges)
+
+    def run(id_range):
+        with app.app_context():
+            try:
+                return index_range(*id_range)
+            finally:
+                db.session.remove() #each worker thread has its own session, give its connection back
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='warbler-tags') as pool:
+        return len(ranges), sum(pool.map(run, ranges))
+
+
+##############################################################################
+# Setup and CLI
+
+
+def init_tags(app):
+    """Set the tag index defaults on `app`, add the link_tags filter and the `flask tags` commands.
+
+    TAGS_PAGE_SIZE          messages per tag or mentions page
+    TAGS_BACKFILL_CHUNK     message ids per backfill range
+    TAGS_BACKFILL_WORKERS   ranges indexed at once by the backfill
+    """
+
+    app.config.setdefault('TAGS_PAGE_SIZE', 20)
+    app.config.setdefault('TAGS_BACKFILL_CHUNK', 5000)
+    app.config.setdefault('TAGS_BACKFILL_WORKERS', 4)
+
+    app.add_template_filter(link_tags)
+
+    @app.cli.group()
+    def tags():
+        """Manage the hashtag and mention index."""
+
+    @tags.command('backfill')
+    @click.option('--chunk-size', default=None, type=int, help="Message ids per range.")
+    @click.option('--workers', default=None, type=int, help="Ranges indexed at once.")
+    def backfill_command(chunk_size, workers):
+        """Index the tags and mentions of messages written before the index existed."""
+        ranges, found = backfill(chunk_size, workers, app)
+        click.echo(f"Indexed {found} tags and mentions across {ranges} id ranges")
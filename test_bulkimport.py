@@ -0,0 +1,133 @@
+"""Bulk import tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulkimport.py
+
+
+import io
+import os
+import tempfile
+from datetime import datetime
+
+from models import db, User, Message, Follows
+from testing import app, DatabaseTestCase
+import bulkimport
+
+
+class BulkImportTestCase(DatabaseTestCase):
+    """Test importing follows and messages in batches, skipping what is already there."""
+
+    def setUp(self):
+        super().setUp()
+
+        users = [User.signup(f"u{n}", f"u{n}@test.com", "password", None) for n in range(1, 5)]
+        db.session.commit()
+        self.u1_id, self.u2_id, self.u3_id, self.u4_id = [u.id for u in users]
+
+        db.session.add(Follows(user_being_followed_id=self.u2_id, user_following_id=self.u1_id))
+        db.session.add(Message(text="already here", user_id=self.u1_id, timestamp=datetime(2017, 1, 21, 11, 4, 53)))
+        db.session.commit()
+
+    def write_csv(self, text):
+        path = os.path.join(tempfile.mkdtemp(), 'import.csv')
+        with open(path, 'w') as csv_file:
+            csv_file.write(text)
+        return path
+
+    def test_import_follows(self):
+        records = [
+            {'user_being_followed_id': self.u2_id, 'user_following_id': self.u1_id}, #already following
+            {'user_being_followed_id': self.u3_id, 'user_following_id': self.u1_id},
+            {'user_being_followed_id': self.u3_id, 'user_following_id': self.u1_id}, #twice in the file
+            {'user_being_followed_id': self.u1_id, 'user_following_id': self.u4_id},
+            {'user_being_followed_id': 99999, 'user_following_id': self.u1_id},
+            {'user_being_followed_id': self.u1_id, 'user_following_id': self.u1_id},
+            {'user_being_followed_id': 'abc', 'user_following_id': self.u1_id},
+        ]
+        report = bulkimport.import_rows('follows', records, batch_size=3)
+
+        self.assertEqual((report.inserted, report.duplicates, report.failed), (2, 2, 3))
+        self.assertEqual(sorted(row for row, _ in report.errors), [5, 6, 7])
+        self.assertEqual(Follows.query.count(), 3)
+        self.assertEqual(User.query.get(self.u1_id).following_count, 2)
+        self.assertEqual(User.query.get(self.u1_id).followers_count, 1)
+
+    def test_import_messages(self):
+        records = [
+            {'text': "already here", 'timestamp': "2017-01-21 11:04:53", 'user_id': str(self.u1_id)},
+            {'text': "new", 'timestamp': "2017-10-21 07:01:06.023966", 'user_id': str(self.u1_id)},
+            {'text': "no time given", 'timestamp': "", 'user_id': str(self.u2_id)},
+            {'text': "x" * 141, 'timestamp': "", 'user_id': str(self.u2_id)},
+            {'text': "when?", 'timestamp': "yesterday", 'user_id': str(self.u2_id)},
+            {'text': "", 'timestamp': "", 'user_id': str(self.u2_id)},
+        ]
+        report = bulkimport.import_rows('messages', records)
+
+        self.assertEqual((report.inserted, report.duplicates, report.failed), (2, 1, 3))
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(), 2)
+        self.assertEqual(User.query.get(self.u2_id).messages_count, 1)
+
+        again = bulkimport.import_rows('messages', records)
+        self.assertEqual((again.inserted, again.duplicates), (1, 2)) #only the one without a timestamp is new again
+
+    def test_errors_are_capped(self):
+        records = [{'user_being_followed_id': 'bad'}] * 10
+        report = bulkimport.import_rows('follows', records, max_errors=3)
+
+        self.assertEqual(report.failed, 10)
+        self.assertEqual(len(report.errors), 3)
+
+    def test_upload_for_logged_in_user(self):
+        csv_text = (f"user_being_followed_id,user_following_id\n"
+                    f"{self.u3_id},\n"
+                    f"{self.u4_id},{self.u1_id}\n"
+                    f"{self.u4_id},{self.u2_id}\n") #somebody else's follow
+        with self.client as c:
+            self.login(c, self.u1_id)
+            resp = c.post("/users/import/follows", content_type='multipart/form-data',
+                          data={'file': (io.BytesIO(csv_text.encode()), 'follows.csv')})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['inserted'], 2)
+        self.assertEqual(resp.json['errors'], [{'row': 3, 'error': "user_following_id must be your own id"}])
+        self.assertEqual(Follows.query.filter_by(user_following_id=self.u1_id).count(), 3)
+
+    def test_json_upload(self):
+        with self.client as c:
+            self.login(c, self.u2_id)
+            resp = c.post("/users/import/messages", json=[{'text': "hi", 'timestamp': "2020-05-01T10:00:00"}])
+
+        self.assertEqual(resp.json['inserted'], 1)
+        self.assertEqual(Message.query.filter_by(user_id=self.u2_id).one().text, "hi")
+
+    def test_json_upload_with_wrong_types(self):
+        with self.client as c:
+            self.login(c, self.u2_id)
+            resp = c.post("/users/import/messages", json=[{'text': 5}, {'text': ["hi"]}, {'text': "fine"}])
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual((resp.json['inserted'], resp.json['failed']), (1, 2))
+        self.assertEqual(resp.json['errors'][0], {'row': 1, 'error': "text must be a string, got 5"})
+
+    def test_bad_uploads(self):
+        with self.client as c:
+            self.assertEqual(c.post("/users/import/follows", json=[]).status_code, 401)
+            self.login(c, self.u1_id)
+            self.assertEqual(c.post("/users/import/likes", json=[]).status_code, 404)
+            self.assertEqual(c.post("/users/import/follows", json={'not': 'a list'}).status_code, 400)
+            resp = c.post("/users/import/messages", content_type='multipart/form-data',
+                          data={'file': (io.BytesIO(b"words,when\nhi,now\n"), 'messages.csv')})
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("missing text", resp.json['error'])
+
+    def test_cli_reads_generator_csv(self):
+        path = self.write_csv(f"text,timestamp,user_id\n"
+                              f"\"Hello, world.\",2017-01-21 11:04:53.522807,{self.u3_id}\n"
+                              f"Orphan.,2017-01-21 11:04:53.522807,99999\n")
+        result = app.test_cli_runner().invoke(args=['import', 'messages', path])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Inserted 1, already there 0, failed 1", result.output)
+        self.assertIn("row 2: no user with id 99999", result.output)
+        self.assertEqual(Message.query.filter_by(user_id=self.u3_id).one().text, "Hello, world.")
@@ -0,0 +1,191 @@
+"""Profile and message page cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import threading
+from unittest import TestCase
+
+from models import db, User, Message
+from testing import app, DatabaseTestCase
+from cache import SingleFlightCache, get_cache
+
+
+class SingleFlightCacheTestCase(TestCase):
+    """Test the cache on its own, no database involved."""
+
+    def test_lru_eviction(self):
+        cache = SingleFlightCache(maxsize=2)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.get('a', lambda: 'reloaded') #a is now the most recently used
+        cache.get('c', lambda: 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a', lambda: 'reloaded'), 1)
+        self.assertEqual(cache.get('b', lambda: 'reloaded'), 'reloaded')
+        self.assertEqual(cache.stats['evictions'], 2)
+
+    def test_new_version_is_a_miss(self):
+        cache = SingleFlightCache()
+        self.assertEqual(cache.get('a', lambda: 'old', version=1), 'old')
+        self.assertEqual(cache.get('a', lambda: 'new', version=1), 'old')
+        self.assertEqual(cache.get('a', lambda: 'new', version=2), 'new')
+
+    def test_none_and_errors_are_not_cached(self):
+        cache = SingleFlightCache()
+        self.assertIsNone(cache.get('a', lambda: None))
+
+        def fail():
+            raise ValueError("database went away")
+
+        with self.assertRaises(ValueError):
+            cache.get('a', fail)
+        self.assertEqual(cache.get('a', lambda: 1), 1)
+        self.assertEqual(cache.stats['misses'], 3)
+
+    def test_concurrent_misses_load_once(self):
+        cache = SingleFlightCache()
+        release = threading.Event()
+        calls = []
+
+        def load():
+            calls.append(1)
+            release.wait(5)
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('a', load))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        while cache.stats['misses'] + cache.stats['coalesced'] < 8: #everyone is waiting on the one load
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 8)
+        self.assertEqual(cache.stats['coalesced'], 7)
+
+    def test_waiters_see_the_leaders_error(self):
+        cache = SingleFlightCache()
+        release = threading.Event()
+        errors = []
+
+        def load():
+            release.wait(5)
+            raise ValueError("boom")
+
+        def get():
+            try:
+                cache.get('a', load)
+            except ValueError as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=get) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while cache.stats['misses'] + cache.stats['coalesced'] < 3:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 3)
+
+    def test_early_refresh(self):
+        #past its expiry every read refreshes, with beta 0 and a long ttl none does
+        expired = SingleFlightCache(ttl=0)
+        expired.get('a', lambda: 1)
+        self.assertEqual(expired.get('a', lambda: 2), 2)
+        self.assertEqual(expired.stats['early_refreshes'], 1)
+
+        fresh = SingleFlightCache(ttl=3600, beta=0)
+        fresh.get('a', lambda: 1)
+        for _ in range(100):
+            self.assertEqual(fresh.get('a', lambda: 2), 1)
+        self.assertEqual(fresh.stats['early_refreshes'], 0)
+
+    def test_stale_value_served_during_refresh(self):
+        cache = SingleFlightCache(ttl=0)
+        cache.get('a', lambda: 'old')
+        release = threading.Event()
+
+        def slow_load():
+            release.wait(5)
+            return 'new'
+
+        refresher = threading.Thread(target=lambda: cache.get('a', slow_load))
+        refresher.start()
+        while cache.stats['early_refreshes'] < 1:
+            threading.Event().wait(0.01)
+
+        self.assertEqual(cache.get('a', lambda: 'not me'), 'old')
+        release.set()
+        refresher.join()
+
+
+class CachedPagesTestCase(DatabaseTestCase):
+    """Test that the pages read through the cache and never show stale data."""
+
+    def setUp(self):
+        super().setUp()
+
+        self._enabled = app.config['CACHE_ENABLED']
+        app.config['CACHE_ENABLED'] = True
+        app.extensions.pop('warbler_cache', None)
+
+        u1 = User.signup("author", "author@test.com", "password", None)
+        u2 = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+        self.u1_id, self.u2_id = u1.id, u2.id
+
+        message = Message(text="first!", user_id=self.u1_id)
+        db.session.add(message)
+        db.session.commit()
+        self.message_id = message.id
+
+    def tearDown(self):
+        app.extensions.pop('warbler_cache', None)
+        app.config['CACHE_ENABLED'] = self._enabled
+        super().tearDown()
+
+    def test_profile_is_cached(self):
+        with self.client as c:
+            self.login(c, self.u2_id)
+            c.get(f"/users/{self.u1_id}")
+            with self.assertMaxQueries(3): #the viewer, the author's version, the like buttons
+                resp = c.get(f"/users/{self.u1_id}")
+
+        self.assertIn("first!", resp.get_data(as_text=True))
+        self.assertGreaterEqual(get_cache(app).stats['hits'], 2)
+
+    def test_new_message_shows_straight_away(self):
+        with self.client as c:
+            self.login(c, self.u1_id)
+            c.get(f"/users/{self.u1_id}")
+            c.post("/messages/new", data={"text": "second!"})
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+
+        self.assertIn("second!", html)
+
+    def test_profile_edit_shows_straight_away(self):
+        with self.client as c:
+            self.login(c, self.u1_id)
+            c.get(f"/messages/{self.message_id}")
+            c.post("/users/profile", data={"password": "password", "new_username": "renamed",
+                                           "email": "author@test.com", "bio": "", "loc": "",
+                                           "backimg": "", "pfp": ""})
+            html = c.get(f"/messages/{self.message_id}").get_data(as_text=True)
+
+        self.assertIn("@renamed", html)
+
+    def test_deleted_message_is_gone(self):
+        with self.client as c:
+            self.login(c, self.u1_id)
+            self.assertEqual(c.get(f"/messages/{self.message_id}").status_code, 200)
+            c.post(f"/messages/{self.message_id}/delete")
+            self.assertEqual(c.get(f"/messages/{self.message_id}").status_code, 404)
@@ -0,0 +1,125 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+from datetime import datetime
+
+from models import db, User, Message, Follows, Likes
+from testing import app, DatabaseTestCase
+import export
+import messagestore
+
+
+class ExportTestCase(DatabaseTestCase):
+    """Test streaming a user's data (or everyone's) out as NDJSON and CSV."""
+
+    def setUp(self):
+        super().setUp()
+
+        users = [User.signup(f"u{n}", f"u{n}@test.com", "password", None) for n in range(1, 4)]
+        db.session.commit()
+        self.u1_id, self.u2_id, self.u3_id = [u.id for u in users]
+
+        mine = Message(text="mine, with a \"quote\", a comma\nand a newline", user_id=self.u1_id)
+        theirs = Message(text="theirs", user_id=self.u2_id)
+        old = Message(text="from long ago", user_id=self.u1_id, timestamp=datetime(2015, 3, 10))
+        db.session.add_all([mine, theirs, old])
+        db.session.commit()
+        self.mine_id, self.theirs_id = mine.id, theirs.id
+
+        db.session.add(Likes(user_id=self.u1_id, message_id=self.theirs_id))
+        db.session.add(Likes(user_id=self.u2_id, message_id=self.mine_id))
+        db.session.add(Follows(user_being_followed_id=self.u2_id, user_following_id=self.u1_id))
+        db.session.add(Follows(user_being_followed_id=self.u1_id, user_following_id=self.u3_id))
+        db.session.add(Follows(user_being_followed_id=self.u3_id, user_following_id=self.u2_id))
+        db.session.commit()
+
+        messagestore.archive_before(datetime(2016, 1, 1))
+        db.session.commit()
+
+    def download(self, query=''):
+        with self.client as c:
+            self.login(c, self.u1_id)
+            return c.get(f"/users/export{query}")
+
+    def records(self, body):
+        return [json.loads(line) for line in body.decode('utf-8').splitlines()]
+
+    def test_ndjson_has_only_my_data(self):
+        resp = self.download()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertIn('attachment', resp.headers['Content-Disposition'])
+
+        records = self.records(resp.get_data())
+        by_type = {}
+        for record in records:
+            by_type.setdefault(record['type'], []).append(record)
+
+        self.assertEqual([u['username'] for u in by_type['users']], ["u1"])
+        self.assertNotIn('password', by_type['users'][0])
+        self.assertEqual(sorted(m['text'] for m in by_type['messages']),
+                         ["from long ago", "mine, with a \"quote\", a comma\nand a newline"]) #live and archived
+        self.assertEqual([(l['user_id'], l['message_id']) for l in by_type['likes']], [(self.u1_id, self.theirs_id)])
+        self.assertEqual(len(by_type['follows']), 2) #who they follow and who follows them
+
+    def test_csv_of_one_kind(self):
+        resp = self.download("?format=csv&kind=messages")
+
+        self.assertEqual(resp.mimetype, 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['text'], "mine, with a \"quote\", a comma\nand a newline")
+        self.assertEqual(rows[0]['user_id'], str(self.u1_id))
+
+    def test_csv_needs_one_kind(self):
+        self.assertEqual(self.download("?format=csv").status_code, 400)
+        self.assertEqual(self.download("?kind=passwords").status_code, 400)
+
+    def test_gzip(self):
+        plain = self.download().get_data()
+        resp = self.download("?gzip=1")
+
+        self.assertEqual(resp.mimetype, 'application/gzip')
+        self.assertIn('.ndjson.gz', resp.headers['Content-Disposition'])
+        self.assertEqual(gzip.decompress(resp.get_data()), plain)
+
+    def test_login_required(self):
+        resp = self.client.get("/users/export")
+        self.assertEqual(resp.status_code, 302)
+
+    def test_small_chunks(self):
+        app.config['EXPORT_CHUNK_ROWS'], app.config['EXPORT_CHUNK_BYTES'] = 1, 1
+        try:
+            chunks = list(export.export('ndjson', ['follows']))
+        finally:
+            app.config['EXPORT_CHUNK_ROWS'], app.config['EXPORT_CHUNK_BYTES'] = 1000, 64 * 1024
+
+        self.assertEqual(len(chunks), 3) #one per line
+        self.assertTrue(all(chunk.endswith(b'\n') for chunk in chunks))
+
+    def test_cli_dump(self):
+        path = os.path.join(tempfile.mkdtemp(), 'follows.csv.gz')
+        result = app.test_cli_runner().invoke(args=['export', 'dump', '--format', 'csv', '--kind', 'follows',
+                                                    '--gzip', '-o', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        with gzip.open(path, 'rt') as dump:
+            rows = list(csv.DictReader(dump))
+        self.assertEqual(list(rows[0]), export.FOLLOWS_HEADERS)
+        self.assertEqual(len(rows), 3)
+
+    def test_cli_rejects_bad_options(self):
+        result = app.test_cli_runner().invoke(args=['export', 'user', str(self.u1_id), '--format', 'csv'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("one kind", result.output)
@@ -0,0 +1,266 @@
+"""Image proxy and thumbnail cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_imageproxy.py
+
+
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+import zlib
+from io import BytesIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase, mock
+
+from models import db, User
+from testing import app, DatabaseTestCase
+import imageproxy
+
+try:
+    import PIL
+except ImportError:
+    PIL = None
+
+
+def png(width=1, height=1):
+    """A valid all black RGB png, made without Pillow."""
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    rows = b''.join(b'\x00' + b'\x00\x00\x00' * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def png_claiming(width, height):
+    """A png whose header says `width` x `height`, with (far) fewer pixels behind it."""
+
+    image = png()
+    ihdr = b'IHDR' + struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return image[:8] + struct.pack('>I', 13) + ihdr + struct.pack('>I', zlib.crc32(ihdr)) + image[33:]
+
+
+class Origin(BaseHTTPRequestHandler):
+    """The stub image host: path -> (status, headers, body), and how often each path was asked for."""
+
+    routes = {}
+    hits = {}
+    hosts = []
+
+    def do_GET(self):
+        self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        self.hosts.append(self.headers['Host'])
+        status, headers, body = self.routes.get(self.path, (404, {}, b'not here'))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTestCase(TestCase):
+    """Test the /images route against a local origin."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Origin)
+        cls.origin = f"http://127.0.0.1:{cls.server.server_port}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self._config = {key: app.config[key] for key in
+                        ('IMAGE_CACHE_DIR', 'IMAGE_PROXY_ALLOW_PRIVATE', 'IMAGE_PROXY_MAX_SOURCE_BYTES')}
+        app.config['IMAGE_CACHE_DIR'] = self.directory
+        app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = True #the origin is on localhost
+        app.extensions.pop('warbler_image_cache', None)
+
+        self.image = png(4, 3)
+        Origin.routes = {
+            '/pic.png': (200, {'Content-Type': 'image/png'}, self.image),
+            '/moved': (302, {'Location': '/pic.png'}, b''),
+            '/page.html': (200, {'Content-Type': 'image/png'}, b'<html>not an image</html>'),
+        }
+        Origin.hits = {}
+        Origin.hosts = []
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config.update(self._config)
+        app.extensions.pop('warbler_image_cache', None)
+        shutil.rmtree(self.directory)
+
+    def url_for(self, path, size='thumb'):
+        with app.test_request_context():
+            return imageproxy.proxied(self.origin + path, size)
+
+    def test_fetches_once(self):
+        url = self.url_for('/pic.png')
+        first = self.client.get(url)
+        second = self.client.get(url)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.mimetype, 'image/jpeg' if PIL else 'image/png') #resized, an opaque picture comes back a jpeg
+        self.assertEqual(second.get_data(), first.get_data())
+        self.assertEqual(Origin.hits, {'/pic.png': 1})
+
+        cache_control = second.headers['Cache-Control']
+        self.assertIn('max-age=31536000', cache_control)
+        self.assertIn('immutable', cache_control)
+        self.assertIn('public', cache_control)
+        self.assertNotIn('Pragma', second.headers)
+
+        revalidated = self.client.get(url, headers={'If-None-Match': second.headers['ETag']})
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_sizes_are_cached_separately(self):
+        self.client.get(self.url_for('/pic.png', 'thumb'))
+        self.client.get(self.url_for('/pic.png', 'header'))
+        self.assertEqual(Origin.hits, {'/pic.png': 2})
+
+    def test_follows_redirects(self):
+        resp = self.client.get(self.url_for('/moved'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Origin.hits, {'/moved': 1, '/pic.png': 1})
+
+    def test_connects_to_the_checked_address(self):
+        real_getaddrinfo = socket.getaddrinfo
+        lookups = []
+
+        def rebinding(host, *args, **kwargs):
+            if host != 'rebind.test':
+                return real_getaddrinfo(host, *args, **kwargs)
+            lookups.append(host)
+            #checked once, then pointed somewhere else for anyone who asks again
+            address = '127.0.0.1' if len(lookups) == 1 else '192.0.2.1'
+            return real_getaddrinfo(address, *args, **kwargs)
+
+        port = self.server.server_port
+        with mock.patch('socket.getaddrinfo', rebinding):
+            data = imageproxy.fetch(f"http://rebind.test:{port}/pic.png", app.config)
+
+        self.assertEqual(data, self.image)
+        self.assertEqual(lookups, ['rebind.test'])
+        self.assertEqual(Origin.hosts, [f"rebind.test:{port}"])
+
+    def test_unsigned_urls_404(self):
+        self.assertEqual(self.client.get("/images/thumb/not-a-token").status_code, 404)
+        self.assertEqual(self.client.get(self.url_for('/pic.png').replace('/thumb/', '/huge/')).status_code, 404)
+        self.assertEqual(Origin.hits, {})
+
+    def test_failures_fall_back(self):
+        app.config['IMAGE_PROXY_MAX_SOURCE_BYTES'] = 10
+
+        for path in ('/missing.png', '/page.html', '/pic.png'):
+            resp = self.client.get(self.url_for(path, 'header'))
+            self.assertEqual(resp.status_code, 302, path)
+            self.assertTrue(resp.location.endswith('/static/images/warbler-hero.jpg'))
+            self.assertIn('max-age=300', resp.headers['Cache-Control'])
+
+        self.assertEqual(os.listdir(self.directory), []) #nothing cached, the next request tries again
+
+    def test_proxied_filter(self):
+        with app.test_request_context():
+            self.assertEqual(imageproxy.proxied(None, 'avatar'), '/static/images/default-pic.png')
+            self.assertEqual(imageproxy.proxied('/static/images/default-pic.png'), '/static/images/default-pic.png')
+            self.assertTrue(imageproxy.proxied('https://example.com/a.jpg').startswith('/images/thumb/'))
+
+    @unittest.skipUnless(PIL, "resizing needs Pillow")
+    def test_resizes(self):
+        from PIL import Image
+
+        Origin.routes['/big.png'] = (200, {}, png(1000, 500))
+        resp = self.client.get(self.url_for('/big.png', 'avatar'))
+        with Image.open(BytesIO(resp.get_data())) as image:
+            self.assertEqual(image.size, (400, 400))
+
+    @unittest.skipUnless(PIL, "resizing needs Pillow")
+    def test_refuses_huge_images(self):
+        #over our limit, and over twice it where Pillow refuses to open them itself
+        for path, size in (('/huge.png', (6000, 6000)), ('/bomb.png', (20000, 20000))):
+            Origin.routes[path] = (200, {}, png_claiming(*size))
+            resp = self.client.get(self.url_for(path, 'avatar'))
+            self.assertEqual(resp.status_code, 302, path)
+            self.assertTrue(resp.location.endswith('/static/images/default-pic.png'))
+
+
+class CheckUrlTestCase(TestCase):
+    """Test which origins the proxy will talk to."""
+
+    def test_refuses_internal_addresses(self):
+        for url in ('http://127.0.0.1/a.png', 'http://10.0.0.1/a.png', 'http://169.254.169.254/latest/meta-data',
+                    'http://[::1]/a.png', 'file:///etc/passwd', 'ftp://example.com/a.png'):
+            with self.assertRaises(ValueError, msg=url):
+                imageproxy.check_url(url)
+
+    def test_allow_private(self):
+        imageproxy.check_url('http://127.0.0.1/a.png', allow_private=True)
+
+
+class ImageCacheTestCase(TestCase):
+    """Test the size bound of the disk cache."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_evicts_least_recently_used(self):
+        cache = imageproxy.ImageCache(self.directory, max_bytes=250)
+        keys = [imageproxy.cache_key(f'http://example.com/{n}', 'thumb') for n in range(3)]
+
+        for n, key in enumerate(keys[:2]):
+            os.utime(cache.put(key, b'x' * 100), (1000 + n, 1000 + n))
+        cache.get(keys[0]) #used just now, so keys[1] is the oldest
+        cache.put(keys[2], b'x' * 100)
+
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertIsNotNone(cache.get(keys[2]))
+
+    def test_prune_command(self):
+        cache = imageproxy.ImageCache(self.directory, max_bytes=10 ** 6)
+        for n in range(3):
+            cache.put(imageproxy.cache_key(f'http://example.com/{n}', 'thumb'), b'x' * 100)
+
+        with app.app_context():
+            _config = app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES']
+            app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'] = self.directory, 150
+            app.extensions.pop('warbler_image_cache', None)
+            try:
+                result = app.test_cli_runner().invoke(args=['images', 'prune'])
+            finally:
+                app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'] = _config
+                app.extensions.pop('warbler_image_cache', None)
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Image cache is 100 bytes", result.output)
+
+
+class ProxiedPagesTestCase(DatabaseTestCase):
+    """Test that pages point their images at the proxy."""
+
+    def test_profile_page(self):
+        user = User.signup("alice", "alice@test.com", "password", "https://example.com/alice.jpg")
+        db.session.commit()
+
+        html = self.client.get(f"/users/{user.id}").get_data(as_text=True)
+
+        self.assertNotIn("https://example.com/alice.jpg", html)
+        self.assertIn('src="/images/avatar/', html)
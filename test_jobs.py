@@ -0,0 +1,139 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import json
+from datetime import datetime, timedelta
+
+from models import db, User, Message, Follows, Job
+from testing import app, DatabaseTestCase
+import jobs
+
+
+@jobs.job('test_flaky')
+def flaky(fail_times):
+    """Fails until it has been attempted more than `fail_times` times."""
+
+    current = Job.query.filter(Job.kind == 'test_flaky').order_by(Job.id.desc()).first()
+    if current.attempts <= fail_times:
+        raise RuntimeError("not yet")
+
+
+class JobsTestCase(DatabaseTestCase):
+    """Test the job queue and the handlers the routes use."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.u1 = User.signup("u1", "u1@test.com", "password", None)
+        self.u2 = User.signup("u2", "u2@test.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = self.u1.id
+        self.u2_id = self.u2.id
+
+    def test_message_add_refreshes_count(self):
+        with self.client as c:
+            self.login(c, self.u1_id)
+            c.post("/messages/new", data={"text": "Hello"})
+
+        self.assertEqual(User.query.get(self.u1_id).messages_count, 1)
+        self.assertEqual(Job.query.one().status, 'done')
+
+    def test_follow_refreshes_both_users(self):
+        with self.client as c:
+            self.login(c, self.u1_id)
+            c.post(f"/users/follow/{self.u2_id}")
+
+        self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+
+    def test_delete_user_job(self):
+        db.session.add(Follows(user_being_followed_id=self.u1_id, user_following_id=self.u2_id))
+        db.session.add(Message(text="bye", user_id=self.u1_id))
+        db.session.commit()
+        jobs.refresh_counts([self.u1_id, self.u2_id])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertIsNone(User.query.get(self.u1_id))
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(User.query.get(self.u2_id).following_count, 0)
+
+    def test_retry_then_fail(self):
+        with app.test_request_context():
+            app.config['JOBS_RETRY_BACKOFF'] = 0
+            try:
+                queued = jobs.enqueue('test_flaky', max_attempts=2, fail_times=5)
+                job_id = queued.id
+
+                self.assertEqual(Job.query.get(job_id).status, 'queued')
+                self.assertEqual(Job.query.get(job_id).attempts, 1)
+
+                self.assertTrue(jobs.work_once())
+                failed = Job.query.get(job_id)
+                self.assertEqual(failed.status, 'failed')
+                self.assertIn("not yet", failed.last_error)
+                self.assertFalse(jobs.work_once())
+            finally:
+                app.config['JOBS_RETRY_BACKOFF'] = 2
+
+    def test_retry_succeeds(self):
+        with app.test_request_context():
+            app.config['JOBS_RETRY_BACKOFF'] = 0
+            try:
+                job_id = jobs.enqueue('test_flaky', fail_times=1).id
+                self.assertTrue(jobs.work_once())
+                self.assertEqual(Job.query.get(job_id).status, 'done')
+            finally:
+                app.config['JOBS_RETRY_BACKOFF'] = 2
+
+    def test_expired_lease_is_reclaimed(self):
+        with app.test_request_context():
+            stuck = Job(kind='refresh_counts', payload=f'{{"user_ids": [{self.u1_id}]}}', status='running',
+                        attempts=1, started_at=datetime.utcnow() - timedelta(seconds=app.config['JOBS_LEASE_SECONDS'] + 1))
+            running = Job(kind='refresh_counts', payload='{"user_ids": []}', status='running',
+                          attempts=1, started_at=datetime.utcnow())
+            db.session.add_all([stuck, running])
+            db.session.commit()
+            stuck_id, running_id = stuck.id, running.id
+
+            self.assertTrue(jobs.work_once())
+            self.assertFalse(jobs.work_once()) #the other one is still within its lease
+
+        self.assertEqual((Job.query.get(stuck_id).status, Job.query.get(stuck_id).attempts), ('done', 2))
+        self.assertEqual(Job.query.get(running_id).status, 'running')
+
+    def test_expired_lease_without_attempts_left_fails(self):
+        with app.test_request_context():
+            stuck = Job(kind='refresh_counts', payload='{"user_ids": []}', status='running', attempts=5,
+                        max_attempts=5, started_at=datetime.utcnow() - timedelta(days=1))
+            db.session.add(stuck)
+            db.session.commit()
+            stuck_id = stuck.id
+
+            self.assertFalse(jobs.work_once())
+
+        self.assertEqual(Job.query.get(stuck_id).status, 'failed')
+        self.assertIn("Lease expired", Job.query.get(stuck_id).last_error)
+
+    def test_metrics(self):
+        with app.test_request_context():
+            jobs.enqueue('refresh_counts', user_ids=[self.u1_id])
+            metrics = jobs.queue_metrics()
+
+        self.assertEqual(metrics['depth']['done'], 1)
+        self.assertEqual(metrics['depth']['queued'], 0)
+        self.assertEqual(metrics['wait_seconds']['count'], 1)
+
+        result = app.test_cli_runner().invoke(args=['jobs', 'stats'])
+        self.assertEqual(json.loads(result.output)['depth']['done'], 1)
+        self.assertEqual(self.client.get("/jobs/metrics").status_code, 404) #operators only, not a public page
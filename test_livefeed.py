@@ -0,0 +1,128 @@
+"""Live timeline (Server-Sent Events) tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_livefeed.py
+
+
+import json
+import threading
+from unittest import TestCase
+
+from models import db, User, Follows
+from testing import app, DatabaseTestCase
+import livefeed
+
+
+class BrokerTestCase(TestCase):
+    """Test the in-process broker and the stand-in for Redis."""
+
+    def test_local_fan_out(self):
+        broker = livefeed.LocalBroker()
+        first = broker.subscribe(['user:1', 'user:2'])
+        second = broker.subscribe(['user:2'])
+
+        self.assertEqual(broker.publish('user:2', 'hi'), 2)
+        self.assertEqual(broker.publish('user:3', 'nobody'), 0)
+        self.assertEqual(first.get(0), 'hi')
+        self.assertEqual(second.get(0), 'hi')
+        self.assertIsNone(first.get(0))
+
+        first.close()
+        second.close()
+        self.assertEqual(broker.channels(), set())
+
+    def test_backpressure(self):
+        broker = livefeed.LocalBroker()
+        slow = broker.subscribe(['user:1'], maxsize=2)
+
+        for n in range(5):
+            broker.publish('user:1', str(n)) #never waits on the reader
+
+        self.assertIs(slow.get(0), livefeed.RESYNC)
+        self.assertEqual(len(slow._buffer), 0)
+
+    def test_remote_broker_through_stand_in(self):
+        server = livefeed.StandInBroker(('127.0.0.1', 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"redis://127.0.0.1:{server.server_address[1]}"
+        publisher, subscriber = livefeed.RemoteBroker(url), livefeed.RemoteBroker(url)
+        try:
+            subscription = subscriber.subscribe(['user:1'])
+
+            #the subscribe races the listener's connection, publish until it is through
+            for _ in range(50):
+                publisher.publish('user:1', 'hello')
+                received = subscription.get(0.1)
+                if received is not None:
+                    break
+            self.assertEqual(received, 'hello')
+
+            subscription.close()
+        finally:
+            publisher.close()
+            subscriber.close()
+            server.shutdown()
+            server.server_close()
+
+
+class TimelineStreamTestCase(DatabaseTestCase):
+    """Test /timeline/stream."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.u1 = User.signup("u1", "u1@test.com", "password", None)
+        self.u2 = User.signup("u2", "u2@test.com", "password", None)
+        self.u3 = User.signup("u3", "u3@test.com", "password", None)
+        db.session.commit()
+        self.u1_id, self.u2_id, self.u3_id = self.u1.id, self.u2.id, self.u3.id
+
+        db.session.add(Follows(user_being_followed_id=self.u2_id, user_following_id=self.u1_id))
+        db.session.commit()
+
+    def post_as(self, user_id, text):
+        client = app.test_client()
+        self.login(client, user_id)
+        client.post("/messages/new", data={"text": text})
+
+    def test_requires_login(self):
+        self.assertEqual(self.client.get("/timeline/stream").status_code, 401)
+
+    def test_pushes_followed_messages(self):
+        self.login(self.client, self.u1_id)
+        resp = self.client.get("/timeline/stream", buffered=False)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+
+        body = iter(resp.response)
+        self.assertTrue(next(body).startswith(b"retry:"))
+
+        self.post_as(self.u3_id, "not followed")
+        self.post_as(self.u2_id, "followed")
+
+        event = next(body).decode()
+        self.assertTrue(event.startswith("data: "))
+        pushed = json.loads(event[len("data: "):])
+        self.assertEqual(pushed['text'], "followed")
+        self.assertEqual(pushed['username'], "u2")
+
+        resp.close()
+        self.assertEqual(livefeed.get_broker(app).channels(), set())
+
+    def test_heartbeat_and_resync(self):
+        app.config['LIVE_HEARTBEAT'] = 0
+        app.config['LIVE_QUEUE_SIZE'] = 1
+        try:
+            self.login(self.client, self.u1_id)
+            resp = self.client.get("/timeline/stream", buffered=False)
+            body = iter(resp.response)
+            next(body)
+            self.assertEqual(next(body), b": keepalive\n\n")
+
+            self.post_as(self.u2_id, "one")
+            self.post_as(self.u2_id, "two")
+            self.assertIn(b"event: resync", next(body))
+            self.assertEqual(list(body), [])
+        finally:
+            app.config['LIVE_HEARTBEAT'] = 15.0
+            app.config['LIVE_QUEUE_SIZE'] = 100
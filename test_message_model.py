@@ -0,0 +1,60 @@
+"""Message model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_message_model.py
+
+
+from datetime import datetime, timedelta
+
+from models import db, User, Message, Follows, Likes
+from testing import DatabaseTestCase
+import readmodels
+
+
+class MessageModelTestCase(DatabaseTestCase):
+    """Test messages and the timeline read models."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.u1 = User.signup("u1", "u1@test.com", "password", None)
+        self.u2 = User.signup("u2", "u2@test.com", "password", None)
+        db.session.commit()
+
+        now = datetime.utcnow()
+        self.old = Message(text="old", user_id=self.u1.id, timestamp=now - timedelta(days=1))
+        self.new = Message(text="new", user_id=self.u2.id, timestamp=now)
+        db.session.add_all([self.old, self.new])
+        db.session.commit()
+
+    def test_message_model(self):
+        """Does basic model work?"""
+
+        self.assertEqual(self.old.user, self.u1)
+        self.assertEqual(len(self.u1.messages), 1)
+
+    def test_timeline_rows(self):
+        rows = readmodels.timeline([self.u1.id, self.u2.id])
+
+        self.assertEqual([r.text for r in rows], ["new", "old"])
+        self.assertIsInstance(rows[0], readmodels.MessageRow)
+        self.assertEqual(rows[0].username, "u2")
+        self.assertEqual(rows[0].image_url, self.u2.image_url)
+
+    def test_user_timeline_limit(self):
+        db.session.add(Message(text="another", user_id=self.u1.id))
+        db.session.commit()
+
+        self.assertEqual(len(readmodels.user_timeline(self.u1.id)), 2)
+        self.assertEqual(len(readmodels.user_timeline(self.u1.id, limit=1)), 1)
+
+    def test_likes_and_following(self):
+        db.session.add(Likes(user_id=self.u1.id, message_id=self.new.id))
+        db.session.add(Follows(user_being_followed_id=self.u2.id, user_following_id=self.u1.id))
+        db.session.commit()
+
+        self.assertEqual(readmodels.liked_ids(self.u1.id), {self.new.id})
+        self.assertEqual([r.id for r in readmodels.liked_timeline(self.u1.id)], [self.new.id])
+        self.assertEqual(readmodels.following_ids(self.u1.id), [self.u2.id])
+        self.assertEqual(readmodels.following_ids(self.u2.id), [])
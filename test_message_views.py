@@ -2,47 +2,25 @@
 
 # run these tests like:
 #
-#    FLASK_ENV=production python -m unittest test_message_views.py
+#    python -m unittest test_message_views.py
 
 
-import os
-from unittest import TestCase
+from models import db, Message, User
+from testing import DatabaseTestCase
 
-from models import db, connect_db, Message, User
+# testing.py builds the app and a fresh test database for us and wraps
+# each test in a transaction that gets rolled back afterwards. The
+# testing profile turns off CSRF (a pain to test) and runs background
+# jobs inline so their effects are visible as soon as the request returns
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
-
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-
-        self.client = app.test_client()
+        super().setUp()
 
         self.testuser = User.signup(username="testuser",
                                     email="test@test.com",
@@ -50,6 +28,7 @@ class MessageViewTestCase(TestCase):
                                     image_url=None)
 
         db.session.commit()
+        self.testuser_id = self.testuser.id
 
     def test_add_message(self):
         """Can use add a message?"""
@@ -58,8 +37,7 @@ class MessageViewTestCase(TestCase):
         # we need to use the changing-session trick:
 
         with self.client as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.testuser.id
+            self.login(c, self.testuser_id)
 
             # Now, that session setting is saved, so we can have
             # the rest of ours test
@@ -71,3 +49,17 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
+
+    def test_cant_delete_someone_elses_message(self):
+        other = User.signup(username="other", email="other@test.com", password="other", image_url=None)
+        msg = Message(text="mine", user_id=self.testuser_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id, other_id = msg.id, other.id
+
+        with self.client as c:
+            self.login(c, other_id)
+            resp = c.post(f"/messages/{msg_id}/delete")
+
+        self.assertEqual(resp.status_code, 403)
+        self.assertIsNotNone(Message.query.get(msg_id))
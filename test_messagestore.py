@@ -0,0 +1,106 @@
+"""Message store (hot window, archive) tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_messagestore.py
+
+
+from datetime import datetime, timedelta
+
+from models import db, User, Message, MessageArchive, Likes
+from testing import app, DatabaseTestCase
+import jobs
+import messagestore
+import readmodels
+
+
+class MessageStoreTestCase(DatabaseTestCase):
+    """Test reading recent messages first and archiving old months."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.u1 = User.signup("u1", "u1@test.com", "password", None)
+        self.u2 = User.signup("u2", "u2@test.com", "password", None)
+        db.session.commit()
+        self.u1_id = self.u1.id
+        self.u2_id = self.u2.id
+
+        now = datetime.utcnow()
+        self.recent = Message(text="recent", user_id=self.u1_id, timestamp=now)
+        self.month_ago = Message(text="last month", user_id=self.u1_id, timestamp=now - timedelta(days=45))
+        self.ancient = Message(text="ancient", user_id=self.u1_id, timestamp=datetime(2015, 3, 10))
+        self.ancient_2 = Message(text="ancient too", user_id=self.u1_id, timestamp=datetime(2015, 3, 20))
+        db.session.add_all([self.recent, self.month_ago, self.ancient, self.ancient_2])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.u2_id, message_id=self.ancient.id))
+        db.session.commit()
+        jobs.refresh_counts([self.u1_id, self.u2_id])
+        db.session.commit()
+
+    def test_new_messages_get_their_own_timestamp(self):
+        first = Message(text="a", user_id=self.u1_id)
+        db.session.add(first)
+        db.session.commit()
+        self.assertGreater(first.timestamp, datetime.utcnow() - timedelta(minutes=1))
+
+    def test_recent_first_order(self):
+        texts = [r.text for r in readmodels.timeline([self.u1_id])]
+        self.assertEqual(texts, ["recent", "last month", "ancient too", "ancient"])
+
+    def test_recent_first_skips_older_rows_when_hot_window_is_enough(self):
+        with self.assertMaxQueries(1):
+            rows = readmodels.timeline([self.u1_id], limit=1)
+        self.assertEqual([r.text for r in rows], ["recent"])
+
+    def test_archive_old_months(self):
+        months, affected = messagestore.archive_before(datetime(2015, 5, 1))
+
+        self.assertEqual(months, 2) #march and april 2015
+        self.assertEqual(affected, {self.u1_id, self.u2_id})
+
+        self.assertEqual(Message.query.filter(Message.timestamp < datetime(2016, 1, 1)).count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+
+        chunk = MessageArchive.query.one()
+        self.assertEqual(chunk.message_count, 2)
+        self.assertEqual(chunk.period_start, datetime(2015, 3, 1))
+
+        #still counted and still on the profile, newest first after the live ones
+        self.assertEqual(User.query.get(self.u1_id).messages_count, 4)
+        self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+        texts = [r.text for r in readmodels.user_timeline(self.u1_id)]
+        self.assertEqual(texts, ["recent", "last month", "ancient too", "ancient"])
+        self.assertEqual([r.text for r in readmodels.user_timeline(self.u1_id, limit=3)],
+                         ["recent", "last month", "ancient too"])
+
+    def test_archive_is_idempotent(self):
+        db.session.add(Message(text="late arrival", user_id=self.u1_id, timestamp=datetime(2015, 3, 15)))
+        db.session.commit()
+        #as if a run had died after writing the chunk but before deleting the rows
+        messagestore._archive_range(datetime(2015, 3, 1), datetime(2015, 4, 1))
+        messagestore.archive_before(datetime(2015, 5, 1))
+
+        chunk = MessageArchive.query.one()
+        self.assertEqual(chunk.message_count, 3)
+        self.assertEqual([m[1] for m in messagestore.archived_messages(self.u1_id, 10)],
+                         ["ancient too", "late arrival", "ancient"])
+
+    def test_profile_lists_archived_messages(self):
+        messagestore.archive_before(datetime(2015, 5, 1))
+
+        with self.client as c:
+            self.login(c, self.u2_id)
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+
+        self.assertIn("ancient too", html)
+        self.assertIn("recent", html)
+
+    def test_delete_user_drops_archive(self):
+        messagestore.archive_before(datetime(2015, 5, 1))
+
+        with app.test_request_context():
+            jobs.enqueue('delete_user', user_id=self.u1_id)
+
+        self.assertEqual(MessageArchive.query.count(), 0)
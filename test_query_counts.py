@@ -0,0 +1,131 @@
+"""Query budget tests for every route."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_counts.py
+#
+# Each route gets a fixed number of queries it may send. The fixture data
+# has several users, messages, follows and likes so a query per row (N+1)
+# blows the budget. If a change legitimately needs another query, raise
+# the budget in the same commit and say why.
+
+
+from models import db, User, Message, Follows, Likes
+from testing import DatabaseTestCase
+
+NUM_OTHERS = 5
+MESSAGES_EACH = 4
+
+
+class QueryCountTestCase(DatabaseTestCase):
+    """How many queries each page costs."""
+
+    def setUp(self):
+        super().setUp()
+
+        users = [User.signup(f"user{n}", f"user{n}@test.com", "password", None)
+                 for n in range(NUM_OTHERS + 1)]
+        db.session.commit()
+
+        self.user_id = users[0].id
+        self.other_ids = [u.id for u in users[1:]]
+
+        for other_id in self.other_ids:
+            db.session.add(Follows(user_being_followed_id=other_id, user_following_id=self.user_id))
+            db.session.add(Follows(user_being_followed_id=self.user_id, user_following_id=other_id))
+            for n in range(MESSAGES_EACH):
+                db.session.add(Message(text=f"message {n}", user_id=other_id))
+        db.session.add(Message(text="mine", user_id=self.user_id))
+        db.session.commit()
+
+        self.message_ids = [m.id for m in Message.query.filter(Message.user_id != self.user_id)]
+        self.own_message_id = Message.query.filter(Message.user_id == self.user_id).one().id
+        for message_id in self.message_ids[:3]:
+            db.session.add(Likes(user_id=self.user_id, message_id=message_id))
+        db.session.commit()
+
+    def assertRouteQueries(self, limit, path, method='get', data=None):
+        with self.client as c:
+            self.login(c, self.user_id)
+            with self.assertMaxQueries(limit):
+                resp = getattr(c, method)(path, data=data)
+                resp.get_data() #streamed pages only query while the body is read
+        return resp
+
+    def test_homepage(self):
+        resp = self.assertRouteQueries(5, "/") #hot window, then everything older
+        self.assertEqual(resp.status_code, 200)
+
+    def test_list_users(self):
+        self.assertRouteQueries(4, "/users")
+
+    def test_search_users(self):
+        self.assertRouteQueries(4, "/users?q=user1")
+
+    def test_users_show(self):
+        self.assertRouteQueries(7, f"/users/{self.other_ids[0]}") #hot window, older, then the archive
+
+    def test_show_following(self):
+        self.assertRouteQueries(2, f"/users/{self.user_id}/following")
+
+    def test_users_followers(self):
+        self.assertRouteQueries(3, f"/users/{self.user_id}/followers")
+
+    def test_show_warbles(self):
+        self.assertRouteQueries(3, f"/users/{self.user_id}/Likes")
+
+    def test_messages_show(self):
+        self.assertRouteQueries(5, f"/messages/{self.message_ids[0]}")
+
+    def test_messages_new_form(self):
+        self.assertRouteQueries(1, "/messages/new")
+
+    def test_messages_add(self):
+        self.assertRouteQueries(11, "/messages/new", 'post', {"text": "hello"}) #+1 bumps their cache version
+
+    def test_messages_destroy(self):
+        #+1 deleting its likes by hand, a partitioned messages table can't have the foreign key that cascaded them
+        #+2 taking it off the trending and top boards (rankings, like_buckets), +1 cache version, +1 tag index,
+        #+1 view counts
+        self.assertRouteQueries(18, f"/messages/{self.own_message_id}/delete", 'post')
+
+    def test_add_follow(self):
+        new = User.signup("newbie", "newbie@test.com", "password", None)
+        db.session.commit()
+        self.assertRouteQueries(11, f"/users/follow/{new.id}", 'post')
+
+    def test_stop_following(self):
+        self.assertRouteQueries(12, f"/users/stop-following/{self.other_ids[0]}", 'post')
+
+    def test_add_like(self):
+        #the eager record_like job recounts the liker like refresh_counts did, then +6 for the boards: top board
+        #UPDATE and INSERT, like bucket UPDATE and INSERT, trending row SELECT FOR UPDATE and INSERT. This is the
+        #message's first like, a message already on the boards skips the INSERTs.
+        self.assertRouteQueries(18, f"/users/add_like/{self.message_ids[-1]}", 'post')
+
+    def test_delete_user(self):
+        #+1 deleting their archived message chunks, +2 their rankings and like_buckets rows, +1 tag index,
+        #+1 view counts, +6 taking their likes off the boards: top board update and cleanup, their recent likes,
+        #one executemany for those hours' buckets, and rescoring them (the same 6 however many likes they gave)
+        self.assertRouteQueries(26, "/users/delete", 'post')
+
+    def test_profile_form(self):
+        self.assertRouteQueries(2, "/users/profile")
+
+    def test_login_form(self):
+        self.assertRouteQueries(1, "/login")
+
+    def test_trending(self):
+        self.assertRouteQueries(3, "/trending")
+
+    def test_users_top(self):
+        self.assertRouteQueries(5, f"/users/{self.other_ids[0]}/top")
+
+    def test_export(self):
+        self.assertRouteQueries(6, "/users/export") #the user, then one cursor per section plus the archive
+
+    def test_tag_timeline(self):
+        self.assertRouteQueries(3, "/tags/python")
+
+    def test_mentions(self):
+        self.assertRouteQueries(3, "/mentions")
@@ -0,0 +1,143 @@
+"""Hashtag and mention index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tagindex.py
+
+
+import re
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, MessageTerm
+from testing import app, DatabaseTestCase
+import bulkimport
+import jobs
+import readmodels
+import tagindex
+
+
+class TokenizerTestCase(TestCase):
+    """Test picking tags and mentions out of message text."""
+
+    def test_tags(self):
+        self.assertEqual(tagindex.tags_in("Loving #Flask and #flask, #SQL_alchemy!"), {'flask', 'sql_alchemy'})
+        self.assertEqual(tagindex.tags_in("issue#12 and &#39; aren't tags, ## neither"), set())
+
+    def test_mentions(self):
+        self.assertEqual(tagindex.mentions_in("hi @alice and @bob.smith."), {'alice', 'bob.smith'})
+        self.assertEqual(tagindex.mentions_in("mail me at me@example.com"), set())
+
+    def test_link_tags_escapes(self):
+        html = tagindex.link_tags("<b>bold</b> #Tag")
+        self.assertEqual(str(html), '&lt;b&gt;bold&lt;/b&gt; <a href="/tags/tag">#Tag</a>')
+
+
+class TagIndexTestCase(DatabaseTestCase):
+    """Test indexing messages as they are written and reading tag timelines back."""
+
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("alice", "alice@test.com", "password", None)
+        u2 = User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+        self.u1_id, self.u2_id = u1.id, u2.id
+
+    def post(self, user_id, text):
+        with self.client as c:
+            self.login(c, user_id)
+            c.post("/messages/new", data={"text": text})
+        return Message.query.filter_by(text=text).one().id
+
+    def terms(self, message_id):
+        return sorted(term for (term,) in db.session.query(MessageTerm.term).filter_by(message_id=message_id))
+
+    def test_posting_indexes(self):
+        message_id = self.post(self.u1_id, "#Python with @bob and @nobody")
+        self.assertEqual(self.terms(message_id), ['#python', f'@{self.u2_id}'])
+
+    def test_tag_pages(self):
+        app.config['TAGS_PAGE_SIZE'] = 2
+        try:
+            start = datetime(2021, 1, 1)
+            for n in range(5):
+                db.session.add(Message(text=f"number {n} #count", user_id=self.u1_id,
+                                       timestamp=start + timedelta(minutes=n)))
+            db.session.add(Message(text="same time #count", user_id=self.u2_id, timestamp=start))
+            db.session.commit()
+            tagindex.backfill(workers=1)
+
+            seen, url = [], "/tags/COUNT"
+            with self.client as c:
+                while url:
+                    resp = c.get(url)
+                    self.assertEqual(resp.status_code, 200)
+                    page = resp.get_data(as_text=True)
+                    seen += re.findall(r'<p>(.*) <a href="/tags/count">#count</a></p>', page)
+                    older = re.search(r'<a href="(/tags/COUNT\?before=[^"]+)"', page)
+                    url = older and older[1]
+        finally:
+            app.config['TAGS_PAGE_SIZE'] = 20
+
+        self.assertEqual(len(seen), 6) #every message once, even the two with the same timestamp
+        self.assertEqual(seen[0], "number 4")
+
+    def test_term_page_cursor(self):
+        for n in range(3):
+            db.session.add(Message(text=f"#a {n}", user_id=self.u1_id, timestamp=datetime(2021, 1, 1, n)))
+        db.session.commit()
+        tagindex.backfill(workers=1)
+
+        first, cursor = readmodels.term_page('#a', 2)
+        second, last = readmodels.term_page('#a', 2, tagindex.decode_cursor(cursor))
+
+        self.assertEqual([m.text for m in first + second], ["#a 2", "#a 1", "#a 0"])
+        self.assertIsNone(last)
+
+    def test_bad_cursor(self):
+        self.assertEqual(self.client.get("/tags/a?before=yesterday").status_code, 400)
+
+    def test_mentions_page(self):
+        self.post(self.u2_id, "hey @alice")
+        self.post(self.u2_id, "hey @bob")
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+            html = c.get("/mentions").get_data(as_text=True)
+
+        self.assertIn("hey @alice", html)
+        self.assertNotIn("hey @bob", html)
+
+    def test_deletes_clean_up(self):
+        message_id = self.post(self.u1_id, "#gone soon")
+        with self.client as c:
+            self.login(c, self.u1_id)
+            c.post(f"/messages/{message_id}/delete")
+        self.assertEqual(self.terms(message_id), [])
+
+        self.post(self.u1_id, "bye @bob #farewell")
+        jobs.delete_user(self.u2_id)
+        db.session.commit()
+        self.assertEqual([term for (term,) in db.session.query(MessageTerm.term)], ['#farewell'])
+
+    def test_backfill_is_idempotent(self):
+        for n in range(7):
+            db.session.add(Message(text=f"#old {n} @bob", user_id=self.u1_id))
+        db.session.commit()
+
+        self.assertEqual(tagindex.backfill(chunk_size=3, workers=1)[1], 14)
+        tagindex.backfill(chunk_size=3, workers=1)
+        self.assertEqual(MessageTerm.query.count(), 14)
+
+    def test_backfill_command(self):
+        db.session.add(Message(text="#cli", user_id=self.u1_id))
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['tags', 'backfill', '--workers', '1'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Indexed 1 tags and mentions", result.output)
+
+    def test_imported_messages_are_indexed(self):
+        bulkimport.import_rows('messages', [{'text': "#imported", 'timestamp': "", 'user_id': str(self.u1_id)}])
+        self.assertEqual(readmodels.term_page('#imported', 10)[0][0].text, "#imported")
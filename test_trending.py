@@ -0,0 +1,163 @@
+"""Trending and top warbles tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+from datetime import datetime, timedelta
+
+from models import db, User, Message, Likes, LikeBucket, Ranking
+from testing import app, DatabaseTestCase
+import readmodels
+import trending
+
+
+class TrendingTestCase(DatabaseTestCase):
+    """Test the like counters, the boards and rebuilding them."""
+
+    def setUp(self):
+        super().setUp()
+
+        users = [User.signup(f"u{n}", f"u{n}@test.com", "password", None) for n in range(4)]
+        db.session.commit()
+        self.user_ids = [u.id for u in users]
+
+        author = self.user_ids[0]
+        messages = [Message(text=f"m{n}", user_id=author) for n in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.message_ids = [m.id for m in messages]
+
+    def like(self, user_id, message_id):
+        with self.client as c:
+            self.login(c, user_id)
+            c.post(f"/users/add_like/{message_id}")
+
+    def board(self, timeline):
+        return [row.id for row in timeline]
+
+    def test_likes_rank_messages(self):
+        m0, m1, m2 = self.message_ids
+        for user_id in self.user_ids[1:]:
+            self.like(user_id, m1)
+        self.like(self.user_ids[1], m2)
+
+        self.assertEqual(self.board(readmodels.trending_timeline(10)), [m1, m2])
+        self.assertEqual(self.board(readmodels.top_timeline(self.user_ids[0], 10)), [m1, m2])
+        self.assertEqual(User.query.get(self.user_ids[1]).likes_count, 2)
+        self.assertEqual(db.session.query(LikeBucket.likes).filter_by(message_id=m1).scalar(), 3)
+
+        html = self.client.get("/trending").get_data(as_text=True)
+        self.assertLess(html.index("m1"), html.index("m2"))
+
+    def test_unlike(self):
+        m0, m1, m2 = self.message_ids
+        self.like(self.user_ids[1], m1)
+        self.like(self.user_ids[2], m1)
+        self.like(self.user_ids[1], m2)
+
+        self.like(self.user_ids[1], m1) #second time takes it back
+        self.like(self.user_ids[2], m1)
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(self.board(readmodels.trending_timeline(10)), [m2])
+        self.assertEqual(self.board(readmodels.top_timeline(self.user_ids[0], 10)), [m2])
+
+    def test_newer_likes_outrank_older_ones(self):
+        m0, m1, m2 = self.message_ids
+        now = datetime.utcnow()
+        with app.test_request_context():
+            #two likes 12 hours ago are worth half of one like now with a 6 hour half life
+            for user_id in self.user_ids[1:3]:
+                trending.record_like(user_id, m1, self.user_ids[0], (now - timedelta(hours=12)).isoformat())
+            trending.record_like(self.user_ids[3], m2, self.user_ids[0], now.isoformat())
+            db.session.commit()
+
+        self.assertEqual(self.board(readmodels.trending_timeline(10)), [m2, m1])
+        self.assertEqual(self.board(readmodels.top_timeline(self.user_ids[0], 10)), [m1, m2])
+
+    def test_window_slides(self):
+        m0, m1, m2 = self.message_ids
+        self.like(self.user_ids[1], m1)
+        self.like(self.user_ids[2], m2)
+
+        later = datetime.utcnow() + timedelta(hours=app.config['TRENDING_WINDOW_HOURS'] + 1)
+        self.assertEqual(trending.slide_window(later), 2)
+
+        self.assertEqual(readmodels.trending_timeline(10), [])
+        self.assertEqual(LikeBucket.query.count(), 0)
+        #all time counts don't slide
+        self.assertEqual(len(readmodels.top_timeline(self.user_ids[0], 10)), 2)
+
+    def test_rebuild_matches_incremental(self):
+        m0, m1, m2 = self.message_ids
+        for user_id in self.user_ids[1:]:
+            self.like(user_id, m0)
+        self.like(self.user_ids[1], m2)
+        self.like(self.user_ids[1], m2)
+        self.like(self.user_ids[2], m2)
+
+        incremental = sorted((r.board, r.owner_id, r.message_id, round(r.score, 6)) for r in Ranking.query)
+        trending.rebuild()
+        rebuilt = sorted((r.board, r.owner_id, r.message_id, round(r.score, 6)) for r in Ranking.query)
+
+        #likes land in hour buckets on a rebuild, so only the top board matches exactly
+        self.assertEqual([r for r in rebuilt if r[0] == 'top'], [r for r in incremental if r[0] == 'top'])
+        self.assertEqual(self.board(readmodels.trending_timeline(10)), [m0, m2])
+
+    def test_deleted_message_drops_off(self):
+        m0, m1, m2 = self.message_ids
+        self.like(self.user_ids[1], m0)
+
+        with self.client as c:
+            self.login(c, self.user_ids[0])
+            c.post(f"/messages/{m0}/delete")
+
+        self.assertEqual(Ranking.query.count(), 0)
+        self.assertEqual(self.client.get(f"/users/{self.user_ids[0]}/top").status_code, 200)
+
+    def test_deleted_account_takes_its_likes_back(self):
+        m0, m1, m2 = self.message_ids
+        self.like(self.user_ids[1], m0)
+        self.like(self.user_ids[1], m1)
+        self.like(self.user_ids[2], m1)
+
+        with self.client as c:
+            self.login(c, self.user_ids[1])
+            c.post("/users/delete")
+
+        self.assertEqual(self.board(readmodels.trending_timeline(10)), [m1])
+        self.assertEqual(self.board(readmodels.top_timeline(self.user_ids[0], 10)), [m1])
+        self.assertEqual(db.session.query(Ranking.score).filter_by(board='top', message_id=m1).scalar(), 1)
+        self.assertEqual(db.session.query(LikeBucket.likes).filter_by(message_id=m1).scalar(), 1)
+
+        incremental = sorted((r.board, r.message_id, round(r.score, 6)) for r in Ranking.query)
+        trending.rebuild()
+        self.assertEqual(sorted((r.board, r.message_id, round(r.score, 6)) for r in Ranking.query), incremental)
+
+    def test_jobs_on_the_same_message_add_up(self):
+        m0, m1, m2 = self.message_ids
+        author, now = self.user_ids[0], datetime.utcnow()
+        top = Ranking.query.filter_by(board='top', owner_id=author, message_id=m1)
+        hot = Ranking.query.filter_by(board='trending', owner_id=0, message_id=m1)
+
+        with app.test_request_context():
+            trending.record_like(self.user_ids[1], m1, author, now.isoformat())
+            db.session.commit()
+            #this worker has both rows loaded when another worker's job for the same message commits its like
+            stale_top, stale_hot = top.one(), hot.one()
+            db.session.execute(Ranking.__table__.update()
+                               .where(Ranking.__table__.c.message_id == m1)
+                               .where(Ranking.__table__.c.board == 'top')
+                               .values(score=stale_top.score + 1))
+            db.session.execute(Ranking.__table__.update()
+                               .where(Ranking.__table__.c.message_id == m1)
+                               .where(Ranking.__table__.c.board == 'trending')
+                               .values(score=trending._log_add(stale_hot.score, trending._log_weight(now))))
+            trending.record_like(self.user_ids[3], m1, author, now.isoformat())
+            db.session.commit()
+
+            self.assertEqual(db.session.query(Ranking.score).filter_by(board='top', message_id=m1).scalar(), 3)
+            self.assertAlmostEqual(db.session.query(Ranking.score).filter_by(board='trending', message_id=m1).scalar(),
+                                   trending._log_weight(now, 3))
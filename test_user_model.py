@@ -5,42 +5,17 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
+from models import db, User
+from testing import DatabaseTestCase
 
-from models import db, User, Message, Follows
+# testing.py builds the app and a fresh test database for us and wraps
+# each test in a transaction that gets rolled back afterwards, so there
+# is nothing to clean up between tests
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
-
-from app import app
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Test views for messages."""
 
-    def setUp(self):
-        """Create test client, add sample data."""
-
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
-        self.client = app.test_client()
-
     def test_user_model(self):
         """Does basic model work?"""
 
@@ -55,4 +30,4 @@ class UserModelTestCase(TestCase):
 
         # User should have no messages & no followers
         self.assertEqual(len(u.messages), 0)
-        self.assertEqual(len(u.followers), 0)
\ No newline at end of file
+        self.assertEqual(len(u.followers), 0)
@@ -0,0 +1,82 @@
+"""User View tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_user_views.py
+
+
+from models import db, User, Message, Follows, Likes
+from testing import app, DatabaseTestCase
+
+
+class UserViewTestCase(DatabaseTestCase):
+    """Test views for users."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.u1 = User.signup("alice", "alice@test.com", "password", None)
+        self.u2 = User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = self.u1.id
+        self.u2_id = self.u2.id
+
+        db.session.add(Follows(user_being_followed_id=self.u2_id, user_following_id=self.u1_id))
+        db.session.add(Message(text="bob says hi", user_id=self.u2_id))
+        db.session.commit()
+
+    def test_home_streams_timeline(self):
+        with self.client as c:
+            self.login(c, self.u1_id)
+            resp = c.get("/")
+
+            self.assertNotIn('Content-Length', resp.headers) #streamed, so no length up front
+            html = resp.get_data(as_text=True)
+            self.assertIn("@alice", html)
+            self.assertIn("bob says hi", html)
+
+    def test_list_users_streams(self):
+        with self.client as c:
+            self.login(c, self.u1_id)
+            resp = c.get("/users")
+
+            self.assertNotIn('Content-Length', resp.headers) #streamed, so no length up front
+            html = resp.get_data(as_text=True)
+            self.assertIn("@alice", html)
+            self.assertIn("@bob", html)
+
+            resp = c.get("/users?q=nobody")
+            self.assertIn("Sorry, no users found", resp.get_data(as_text=True))
+
+    def test_flash_is_consumed_when_streaming(self):
+        with self.client as c:
+            self.login(c, self.u1_id)
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [("info", "only once")]
+
+            self.assertIn("only once", c.get("/").get_data(as_text=True))
+            self.assertNotIn("only once", c.get("/").get_data(as_text=True))
+
+    def test_rendered_when_streaming_off(self):
+        app.config['STREAM_TEMPLATES'] = False
+        try:
+            with self.client as c:
+                self.login(c, self.u1_id)
+                resp = c.get("/")
+                self.assertIn('Content-Length', resp.headers)
+                self.assertIn("bob says hi", resp.get_data(as_text=True))
+        finally:
+            app.config['STREAM_TEMPLATES'] = True
+
+    def test_show_liked_warbles(self):
+        message_id = Message.query.one().id
+        db.session.add(Likes(user_id=self.u1_id, message_id=message_id))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+            resp = c.get(f"/users/{self.u1_id}/Likes")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("bob says hi", resp.get_data(as_text=True))
@@ -0,0 +1,178 @@
+"""Message view counter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_viewcounts.py
+
+
+from unittest import TestCase
+
+from models import db, User, Message, Follows, MessageViews
+from testing import app, DatabaseTestCase
+import viewcounts
+from viewcounts import view_buffer
+
+
+class SketchTestCase(TestCase):
+    """Test the HyperLogLog estimate on its own."""
+
+    def sketch_of(self, viewers):
+        registers = {}
+        for viewer in viewers:
+            index, rank = viewcounts.register(viewer)
+            registers[index] = max(rank, registers.get(index, 0))
+        return viewcounts.merge(None, registers)
+
+    def test_empty(self):
+        self.assertEqual(viewcounts.estimate(None), 0)
+
+    def test_repeats_count_once(self):
+        self.assertEqual(viewcounts.estimate(self.sketch_of(["user:1"] * 50 + ["user:2"] * 50)), 2)
+
+    def test_estimates_within_a_few_percent(self):
+        for n in (100, 5000, 50000):
+            guess = viewcounts.estimate(self.sketch_of(f"user:{i}" for i in range(n)))
+            self.assertLess(abs(guess - n) / n, 0.1, (n, guess))
+
+    def test_merging_is_a_union(self):
+        halves = self.sketch_of(f"user:{i}" for i in range(600)), self.sketch_of(f"user:{i}" for i in range(400, 1000))
+        merged = viewcounts.merge(halves[0], dict(enumerate(halves[1])))
+        self.assertEqual(merged, self.sketch_of(f"user:{i}" for i in range(1000)))
+
+
+class ViewCountsTestCase(DatabaseTestCase):
+    """Test counting views in the buffer and flushing them in batches."""
+
+    def setUp(self):
+        super().setUp()
+
+        self._config = {key: app.config[key] for key in ('VIEWS_ENABLED', 'VIEWS_FLUSH_INTERVAL', 'VIEWS_BATCH')}
+        app.config.update(VIEWS_ENABLED=True, VIEWS_FLUSH_INTERVAL=0, VIEWS_BATCH=100)
+        app.extensions.pop('warbler_views', None)
+
+        users = [User.signup(f"u{n}", f"u{n}@test.com", "password", None) for n in range(3)]
+        db.session.commit()
+        self.user_ids = [u.id for u in users]
+
+        message = Message(text="look at me", user_id=self.user_ids[0])
+        db.session.add(message)
+        db.session.commit()
+        self.message_id = message.id
+
+    def tearDown(self):
+        buffer = app.extensions.pop('warbler_views', None)
+        if buffer is not None:
+            buffer.close() #flushed inside the test's transaction, not at exit
+        app.config.update(self._config)
+        super().tearDown()
+
+    def view(self, user_id=None, path=None):
+        client = app.test_client()
+        if user_id is not None:
+            self.login(client, user_id)
+        resp = client.get(path or f"/messages/{self.message_id}")
+        resp.get_data() #streamed pages count rows as they go out
+        return resp
+
+    def counts(self):
+        row = MessageViews.query.get(self.message_id)
+        return row and (row.views, row.impressions, row.viewers)
+
+    def test_views_are_buffered_until_flush(self):
+        self.view(self.user_ids[1])
+        self.view(self.user_ids[1])
+        self.view(self.user_ids[2])
+
+        self.assertIsNone(self.counts())
+        self.assertEqual(view_buffer(app).flush(), 1)
+        self.assertEqual(self.counts(), (3, 0, 2))
+
+        self.view(self.user_ids[1])
+        view_buffer(app).flush()
+        self.assertEqual(self.counts(), (4, 0, 2)) #merged into the stored sketch, still two people
+
+    def test_page_shows_flushed_counts(self):
+        for user_id in self.user_ids:
+            self.view(user_id)
+        view_buffer(app).flush()
+
+        html = self.view().get_data(as_text=True)
+        self.assertIn("3 views", html)
+        self.assertIn("by about 3 people", html)
+
+    def test_show_costs_no_extra_queries(self):
+        client = app.test_client()
+        with self.assertMaxQueries(2): #the message with its counts, and its author
+            client.get(f"/messages/{self.message_id}")
+
+    def test_timeline_impressions(self):
+        self.view(self.user_ids[0], f"/users/{self.user_ids[0]}")
+        self.view(self.user_ids[1], "/tags/none") #lists nothing
+        db.session.add(Follows(user_following_id=self.user_ids[1], user_being_followed_id=self.user_ids[0]))
+        db.session.commit()
+        self.view(self.user_ids[1], "/") #streamed
+
+        view_buffer(app).flush()
+        self.assertEqual(self.counts(), (0, 2, 2))
+
+    def test_full_batch_flushes(self):
+        app.config['VIEWS_BATCH'] = 2
+        other = Message(text="me too", user_id=self.user_ids[0])
+        db.session.add(other)
+        db.session.commit()
+
+        self.view(self.user_ids[1])
+        self.assertIsNone(self.counts())
+        self.view(self.user_ids[1], f"/messages/{other.id}")
+
+        self.assertEqual(len(view_buffer(app)), 0)
+        self.assertEqual(self.counts(), (1, 0, 1))
+
+    def test_failed_flush_doesnt_break_the_page(self):
+        app.config['VIEWS_BATCH'] = 1
+        buffer = view_buffer(app)
+        write = buffer._write
+
+        def fail(pending):
+            raise RuntimeError("database went away")
+
+        buffer._write = fail
+        resp = self.view(self.user_ids[1])
+        buffer._write = write
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(buffer), 1) #kept for the next flush
+
+    def test_deleted_messages_are_skipped(self):
+        self.view(self.user_ids[1])
+        Message.query.filter_by(id=self.message_id).delete()
+        db.session.commit()
+
+        self.assertEqual(view_buffer(app).flush(), 0)
+        self.assertEqual(MessageViews.query.count(), 0)
+
+    def test_failed_flush_keeps_counts(self):
+        self.view(self.user_ids[1])
+        buffer = view_buffer(app)
+        write = buffer._write
+
+        def fail(pending):
+            raise RuntimeError("database went away")
+
+        buffer._write = fail
+        with self.assertRaises(RuntimeError):
+            buffer.flush()
+        self.view(self.user_ids[2])
+        buffer._write = write
+
+        buffer.flush()
+        self.assertEqual(self.counts(), (2, 0, 2))
+
+    def test_counts_go_with_the_message(self):
+        self.view(self.user_ids[1])
+        view_buffer(app).flush()
+
+        client = app.test_client()
+        self.login(client, self.user_ids[0])
+        client.post(f"/messages/{self.message_id}/delete")
+        self.assertIsNone(self.counts())
@@ -0,0 +1,148 @@
+"""Write-behind batching tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_writebehind.py
+
+
+from models import db, User, Message, Follows, Likes, Job, Ranking
+from testing import app, DatabaseTestCase
+import jobs
+from writebehind import write_buffer
+
+
+class WriteBehindTestCase(DatabaseTestCase):
+    """Test buffering likes and follows and flushing them in batches."""
+
+    def setUp(self):
+        super().setUp()
+
+        self._config = {key: app.config[key] for key in ('WRITE_BEHIND', 'WRITE_BEHIND_INTERVAL', 'WRITE_BEHIND_BATCH')}
+        app.config.update(WRITE_BEHIND=True, WRITE_BEHIND_INTERVAL=0, WRITE_BEHIND_BATCH=100)
+        app.extensions.pop('warbler_write_behind', None)
+
+        users = [User.signup(f"u{n}", f"u{n}@test.com", "password", None) for n in range(3)]
+        db.session.commit()
+        self.u1_id, self.u2_id, self.u3_id = [u.id for u in users]
+
+        message = Message(text="hello", user_id=self.u1_id)
+        db.session.add(message)
+        db.session.commit()
+        self.message_id = message.id
+
+    def tearDown(self):
+        buffer = app.extensions.pop('warbler_write_behind', None)
+        if buffer is not None:
+            buffer.close() #flushed inside the test's transaction, not at exit
+        app.config.update(self._config)
+        super().tearDown()
+
+    def post_as(self, user_id, url):
+        client = app.test_client()
+        self.login(client, user_id)
+        return client.post(url)
+
+    def test_like_is_buffered_until_flush(self):
+        resp = self.post_as(self.u2_id, f"/users/add_like/{self.message_id}")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(len(write_buffer(app)), 1)
+
+        self.assertEqual(write_buffer(app).flush(), 1)
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+        self.assertEqual(Ranking.query.filter_by(board='top', owner_id=self.u1_id).one().score, 1)
+
+    def test_clicks_coalesce(self):
+        for _ in range(3): #like, unlike, like
+            self.post_as(self.u2_id, f"/users/add_like/{self.message_id}")
+        for _ in range(2): #like, unlike
+            self.post_as(self.u3_id, f"/users/add_like/{self.message_id}")
+
+        write_buffer(app).flush()
+
+        self.assertEqual([like.user_id for like in Likes.query], [self.u2_id])
+        self.assertEqual(User.query.get(self.u3_id).likes_count, 0)
+
+    def test_unlike_after_flush(self):
+        self.post_as(self.u2_id, f"/users/add_like/{self.message_id}")
+        write_buffer(app).flush()
+        self.post_as(self.u2_id, f"/users/add_like/{self.message_id}")
+        write_buffer(app).flush()
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+        self.assertEqual(Ranking.query.count(), 0)
+
+    def test_no_op_batch_touches_nothing(self):
+        self.post_as(self.u2_id, f"/users/stop-following/{self.u3_id}") #wasn't following anyway
+        self.assertEqual(write_buffer(app).flush(), 0)
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_follows(self):
+        self.post_as(self.u1_id, f"/users/follow/{self.u2_id}")
+        self.post_as(self.u1_id, f"/users/follow/{self.u3_id}")
+        self.post_as(self.u1_id, f"/users/stop-following/{self.u3_id}")
+        self.assertEqual(Follows.query.count(), 0)
+
+        write_buffer(app).flush()
+
+        self.assertEqual([f.user_being_followed_id for f in Follows.query], [self.u2_id])
+        self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+        self.assertEqual(User.query.get(self.u3_id).followers_count, 0)
+
+    def test_full_batch_flushes(self):
+        app.config['WRITE_BEHIND_BATCH'] = 2
+        app.extensions.pop('warbler_write_behind', None)
+
+        self.post_as(self.u2_id, f"/users/add_like/{self.message_id}")
+        self.assertEqual(Likes.query.count(), 0)
+        self.post_as(self.u3_id, f"/users/add_like/{self.message_id}")
+        self.assertEqual(Likes.query.count(), 2)
+
+    def test_failed_flush_doesnt_break_the_click(self):
+        app.config['WRITE_BEHIND_BATCH'] = 1
+        buffer = write_buffer(app)
+
+        def fail(likes):
+            raise RuntimeError("database went away")
+
+        buffer._write_likes = fail
+        resp = self.post_as(self.u2_id, f"/users/add_like/{self.message_id}")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertTrue(buffer.pending_like(self.u2_id, self.message_id)) #kept for the next flush
+        buffer._likes.clear()
+
+    def test_deleted_user_is_skipped(self):
+        write_buffer(app).follow(self.u2_id, 999999)
+        write_buffer(app).like(999999, self.message_id, Message.query.get(self.message_id).timestamp)
+
+        self.assertEqual(write_buffer(app).flush(), 0)
+        self.assertEqual(len(write_buffer(app)), 0)
+
+    def test_like_storm_is_one_batch(self):
+        fans = [User(username=f"fan{n}", email=f"fan{n}@test.com", password="x") for n in range(60)]
+        db.session.add_all(fans)
+        db.session.commit()
+        fan_ids = [fan.id for fan in fans]
+
+        buffer = write_buffer(app)
+        for fan_id in fan_ids:
+            with app.test_request_context():
+                buffer.toggle_like(fan_id, self.message_id)
+
+        app.config['JOBS_EAGER'] = False
+        try:
+            with app.test_request_context(), self.assertMaxQueries(6):
+                self.assertEqual(buffer.flush(), 60)
+        finally:
+            app.config['JOBS_EAGER'] = True
+
+        self.assertEqual(Likes.query.count(), 60)
+        with app.test_request_context():
+            self.assertTrue(jobs.work_once())
+        self.assertEqual(Ranking.query.filter_by(board='top').one().score, 60)
+        self.assertEqual(User.query.get(fan_ids[-1]).likes_count, 1)
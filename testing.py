@@ -0,0 +1,176 @@
+"""Shared harness for the Warbler test suite.
+
+Every test module imports the app from here instead of building its own, so
+a test process creates the app and the schema exactly once.
+
+    python -m unittest test_user_views.py     # one module
+    python -m pytest -n auto                   # everything, one process per core
+
+By default each process runs against its own in-memory SQLite database, so
+nothing needs to be running and parallel workers cannot see each other. Set
+TEST_DATABASE_URL to run against Postgres instead; under pytest-xdist each
+worker then gets its own throwaway database named after it
+(warbler-test-gw0, warbler-test-gw1, ...), created on first use.
+
+DatabaseTestCase wraps every test in a transaction that is rolled back
+afterwards. The app's own commits only release a SAVEPOINT inside it, so no
+test has to delete rows and no test can leak rows into the next one.
+"""
+
+import os
+from contextlib import contextmanager
+from copy import copy
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session
+
+from app import create_app, CURR_USER_KEY
+from models import db
+
+#statements the harness itself issues around each test, not counted against a route's query budget
+HARNESS_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT', 'BEGIN')
+
+
+def worker_database_url():
+    """The database this test process should use."""
+
+    url = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+
+    if worker and url != 'sqlite://': #in-memory sqlite is already private to the process
+        url = f"{url}-{worker}"
+    return url
+
+
+def _create_postgres_database(url):
+    """CREATE DATABASE for `url` unless it already exists."""
+
+    url = make_url(url)
+    admin_url = copy(url)
+    admin_url.database = 'postgres'
+
+    engine = create_engine(admin_url, isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as conn:
+            exists = conn.execute("SELECT 1 FROM pg_database WHERE datname = %s", url.database).scalar()
+            if not exists:
+                conn.execute(f'CREATE DATABASE "{url.database}"')
+    finally:
+        engine.dispose()
+
+
+def _enable_sqlite_savepoints(engine):
+    """pysqlite handles BEGIN itself and gets SAVEPOINT wrong, so take over.
+
+    This is the recipe from the SQLAlchemy docs for "Serializable isolation /
+    Savepoints / Transactional DDL" with pysqlite.
+    """
+
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(conn):
+        conn.execute('BEGIN')
+
+
+def setup_database(app):
+    """Point `app` at this process's test database and build a fresh schema in it."""
+
+    url = worker_database_url()
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+
+    if url.startswith('postgres'):
+        _create_postgres_database(url)
+
+    with app.app_context():
+        if url.startswith('sqlite'):
+            _enable_sqlite_savepoints(db.engine)
+        db.drop_all()
+        db.create_all()
+
+
+app = create_app('testing')
+setup_database(app)
+
+
+class DatabaseTestCase(TestCase):
+    """TestCase whose database changes are all rolled back after each test.
+
+    db.session is swapped for one bound to a single connection with an open
+    outer transaction. Sessions made from it start inside a SAVEPOINT, so
+    the commits (and rollbacks) the app does only ever touch the savepoint.
+    Keep ids rather than model instances across requests: the request
+    teardown removes the session and detaches anything loaded in it.
+    """
+
+    def setUp(self):
+        self._app_context = app.app_context()
+        self._app_context.push()
+
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+
+        factory = db.create_session({'bind': self.connection, 'binds': {}})
+        self._finished = False
+
+        @event.listens_for(factory, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            #when the app commits (releasing our SAVEPOINT) open a new one straight away
+            if transaction.nested and not transaction._parent.nested and not self._finished:
+                session.expire_all()
+                session.begin_nested()
+
+        def make_session():
+            session = factory()
+            session.begin_nested()
+            return session
+
+        self._real_session = db.session
+        db.session = scoped_session(make_session)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        #roll the last savepoint back properly first, so the outer transaction
+        #is the connection's current one again when we roll it back
+        self._finished = True
+        db.session.rollback()
+        db.session.remove()
+        db.session = self._real_session
+
+        self.transaction.rollback()
+        self.connection.close()
+        self._app_context.pop()
+
+    def login(self, client, user_id):
+        """Mimic logging in by putting `user_id` in the client's session."""
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    @contextmanager
+    def assertMaxQueries(self, limit):
+        """Fail if the block sends more than `limit` SQL statements.
+
+        Used to pin each route to a query budget, so an N+1 slipping into
+        app.py shows up as a failing test instead of a slow page.
+        """
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if not statement.lstrip().upper().startswith(HARNESS_STATEMENTS):
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        if len(statements) > limit:
+            self.fail(f"{len(statements)} queries, expected at most {limit}:\n" + "\n\n".join(statements))
@@ -0,0 +1,305 @@
+"""Trending and most liked warbles, kept up to date one like at a time.
+
+Two boards live in the rankings table:
+
+    trending   every message liked in the last TRENDING_WINDOW_HOURS, scored
+               by its likes with each like worth half as much for every
+               TRENDING_HALF_LIFE_HOURS that has passed since
+    top        one board per author (owner_id), their messages by total likes
+
+Likes are also counted per message per hour in like_buckets. That is what
+lets the trending window slide: slide_window() drops the buckets that have
+fallen out of it and rescores only the messages they belonged to.
+
+Trending scores use forward decay. Instead of every score shrinking as the
+clock moves, a like at time t adds 2 ** (t / half life), which ranks messages
+exactly the same way. A new like then only touches its own message's row and
+nothing has to be recomputed just because time passed. Scores are stored as
+log2 of that sum so they don't overflow.
+
+Pages read the first K rows of a board off its index (see readmodels), so they
+cost the same however many likes there are. None of this is the source of
+truth: rebuild() throws it away and recomputes it from the likes table, for
+when the boards ever drift from it. Anything that removes likes has to take
+them off the boards too (unlikes, deleted messages and accounts all do).
+"""
+
+import math
+from collections import Counter
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import func, and_, bindparam
+
+from models import db, Message, Likes, LikeBucket, Ranking
+from jobs import job, refresh_counts
+
+TRENDING = 'trending'
+TOP = 'top'
+EVERYONE = 0 #owner_id of the boards that aren't anyone's in particular
+
+#forward decay weights are relative to this, any fixed moment works
+EPOCH = datetime(2020, 1, 1)
+
+
+def _bucket(when):
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+def _window_start(now=None):
+    hours = current_app.config['TRENDING_WINDOW_HOURS']
+    return _bucket(now or datetime.utcnow()) - timedelta(hours=hours - 1)
+
+
+def _log_weight(when, likes=1):
+    """log2 of what `likes` likes at `when` add to a trending score."""
+
+    half_lives = (when - EPOCH).total_seconds() / 3600 / current_app.config['TRENDING_HALF_LIFE_HOURS']
+    return half_lives + math.log2(likes)
+
+
+def _log_add(a, b):
+    """log2(2 ** a + 2 ** b) without leaving log space. Either side can be None (nothing)."""
+
+    if a is None:
+        return b
+    if b is None:
+        return a
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def _insert_in_batches(model, rows, size=1000):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            db.session.bulk_insert_mappings(model, batch)
+            batch = []
+    if batch:
+        db.session.bulk_insert_mappings(model, batch)
+
+
+##############################################################################
+# Keeping the boards up to date
+
+
+@job('record_like')
+def record_like(user_id, message_id, author_id, liked_at, delta=1):
+    """Apply one like (delta=1) or unlike (delta=-1) to the counters and boards.
+
+    Also recounts the liker's likes_count, so the like route only has to
+    queue this one job.
+    """
+
+    record_likes([[user_id, message_id, author_id, liked_at, delta]])
+
+
+@job('record_likes')
+def record_likes(changes):
+    """record_like() for a whole batch of [user_id, message_id, author_id, liked_at, delta] changes.
+
+    Changes are added up per message and per bucket first, so a like storm
+    on one message costs a handful of statements rather than a few per like.
+    Every liker is recounted once and every message that lost a like is
+    rescored once.
+    """
+
+    refresh_counts(sorted({user_id for user_id, _, _, _, _ in changes}))
+
+    window_start = _window_start()
+    top = Counter() #(author_id, message_id) -> change in total likes
+    buckets = Counter() #(message_id, bucket) -> change in that hour's likes
+    added = {} #message_id -> log weight of its new likes
+    unliked = set()
+
+    for _, message_id, author_id, liked_at, delta in changes:
+        liked_at = datetime.fromisoformat(liked_at)
+        top[author_id, message_id] += delta
+        if _bucket(liked_at) < window_start:
+            continue #too old to trend
+        buckets[message_id, _bucket(liked_at)] += delta
+        if delta < 0:
+            unliked.add(message_id)
+        else:
+            added[message_id] = _log_add(added.get(message_id), _log_weight(liked_at))
+
+    for (author_id, message_id), delta in top.items():
+        if not delta:
+            continue
+        key = (Ranking.board == TOP, Ranking.owner_id == author_id, Ranking.message_id == message_id)
+        #added up in the database, so two workers liking the same message can't both write back the same total
+        counted = (Ranking.query
+                   .filter(*key)
+                   .update({Ranking.score: Ranking.score + delta}, synchronize_session=False))
+        if not counted and delta > 0:
+            #same as the buckets below, a race to create the row fails one worker and its retry adds to the row
+            db.session.add(Ranking(board=TOP, owner_id=author_id, message_id=message_id, score=delta))
+        elif counted and delta < 0:
+            Ranking.query.filter(*key, Ranking.score <= 0).delete(synchronize_session=False)
+
+    for (message_id, bucket), delta in buckets.items():
+        counted = (LikeBucket.query
+                   .filter(LikeBucket.message_id == message_id, LikeBucket.bucket == bucket)
+                   .update({LikeBucket.likes: LikeBucket.likes + delta}, synchronize_session=False))
+        if not counted and delta > 0:
+            #two workers racing to create the same bucket make one of them fail, its retry then finds the row
+            db.session.add(LikeBucket(message_id=message_id, bucket=bucket, likes=delta))
+
+    for message_id, weight in added.items():
+        if message_id in unliked:
+            continue #rescored below
+        #log space adds can't be done in SQL, so lock the row until commit to keep other workers' adds from being lost
+        row = (Ranking.query
+               .filter(Ranking.board == TRENDING, Ranking.owner_id == EVERYONE, Ranking.message_id == message_id)
+               .with_for_update()
+               .populate_existing()
+               .first())
+        if row is None:
+            db.session.add(Ranking(board=TRENDING, owner_id=EVERYONE, message_id=message_id, score=weight))
+        else:
+            row.score = _log_add(row.score, weight)
+
+    #taking a like back out of a log space sum loses precision, recount those from the buckets instead
+    db.session.flush()
+    rescore(sorted(unliked))
+
+
+def rescore(message_ids):
+    """Recompute the trending scores of `message_ids` from their like buckets."""
+
+    if not message_ids:
+        return
+
+    (Ranking.query
+     .filter(Ranking.board == TRENDING, Ranking.message_id.in_(message_ids))
+     .delete(synchronize_session=False))
+
+    scores = {}
+    buckets = (db.session.query(LikeBucket.message_id, LikeBucket.bucket, LikeBucket.likes)
+               .filter(LikeBucket.message_id.in_(message_ids), LikeBucket.likes > 0))
+    for message_id, bucket, likes in buckets:
+        scores[message_id] = _log_add(scores.get(message_id), _log_weight(bucket, likes))
+
+    _insert_in_batches(Ranking, (
+        {'board': TRENDING, 'owner_id': EVERYONE, 'message_id': message_id, 'score': score}
+        for message_id, score in scores.items()))
+
+
+def slide_window(now=None):
+    """Drop the like buckets that have left the trending window and rescore their messages.
+
+    Until this runs, likes older than the window still count for a little
+    (they have decayed by then), so running it hourly is plenty. Returns the
+    number of messages rescored.
+    """
+
+    start = _window_start(now)
+    expired = [message_id for (message_id,) in
+               db.session.query(LikeBucket.message_id).filter(LikeBucket.bucket < start).distinct()]
+
+    LikeBucket.query.filter(LikeBucket.bucket < start).delete(synchronize_session=False)
+    LikeBucket.query.filter(LikeBucket.likes <= 0).delete(synchronize_session=False)
+    for n in range(0, len(expired), 1000):
+        rescore(expired[n:n + 1000])
+
+    db.session.commit()
+    return len(expired)
+
+
+def forget_messages(message_ids):
+    """Stage taking deleted (or archived) messages off every board."""
+
+    Ranking.query.filter(Ranking.message_id.in_(message_ids)).delete(synchronize_session=False)
+    LikeBucket.query.filter(LikeBucket.message_id.in_(message_ids)).delete(synchronize_session=False)
+
+
+def forget_likes(user_id):
+    """Stage taking every like of `user_id` off the boards, for deleting their account.
+
+    Set based like the rest of the account teardown, however many likes they
+    gave. Call it before their likes are deleted.
+    """
+
+    liked = db.session.query(Likes.message_id).filter(Likes.user_id == user_id).subquery()
+    #a user likes a message once, so every message they liked is one like down
+    (Ranking.query
+     .filter(Ranking.board == TOP, Ranking.message_id.in_(liked))
+     .update({Ranking.score: Ranking.score - 1}, synchronize_session=False))
+    (Ranking.query
+     .filter(Ranking.board == TOP, Ranking.message_id.in_(liked), Ranking.score <= 0)
+     .delete(synchronize_session=False))
+
+    #the ones still in the trending window come out of their hours too, then those messages are rescored
+    recent = (db.session.query(Likes.message_id, Likes.timestamp)
+              .filter(Likes.user_id == user_id, Likes.timestamp >= _window_start()))
+    hours = [{'b_id': message_id, 'b_bucket': _bucket(liked_at)} for message_id, liked_at in recent]
+    if hours:
+        table = LikeBucket.__table__
+        db.session.execute(
+            table.update()
+            .where(and_(table.c.message_id == bindparam('b_id'), table.c.bucket == bindparam('b_bucket')))
+            .values(likes=table.c.likes - 1),
+            hours)
+        rescore(sorted(hour['b_id'] for hour in hours))
+
+
+def rebuild(now=None):
+    """Recompute both boards and the like buckets from scratch out of the likes table."""
+
+    Ranking.query.delete(synchronize_session=False)
+    LikeBucket.query.delete(synchronize_session=False)
+
+    totals = (db.session.query(Message.user_id, Likes.message_id, func.count(Likes.id))
+              .join(Message, Message.id == Likes.message_id)
+              .group_by(Message.user_id, Likes.message_id))
+    _insert_in_batches(Ranking, (
+        {'board': TOP, 'owner_id': author_id, 'message_id': message_id, 'score': likes}
+        for author_id, message_id, likes in totals.yield_per(1000)))
+
+    counts = Counter()
+    recent = (db.session.query(Likes.message_id, Likes.timestamp)
+              .join(Message, Message.id == Likes.message_id)
+              .filter(Likes.timestamp >= _window_start(now)))
+    for message_id, liked_at in recent.yield_per(1000):
+        counts[message_id, _bucket(liked_at)] += 1
+
+    _insert_in_batches(LikeBucket, (
+        {'message_id': message_id, 'bucket': bucket, 'likes': likes}
+        for (message_id, bucket), likes in counts.items()))
+    rescore(sorted({message_id for message_id, _ in counts}))
+
+    db.session.commit()
+
+
+##############################################################################
+# Setup and CLI
+
+
+def init_trending(app):
+    """Set the trending defaults on `app` and add the `flask trending` commands.
+
+    TRENDING_WINDOW_HOURS      how many hours of likes the trending board looks at
+    TRENDING_HALF_LIFE_HOURS   a like counts half as much after this long
+    TRENDING_SIZE              how many messages the trending and top pages show
+    """
+
+    app.config.setdefault('TRENDING_WINDOW_HOURS', 48)
+    app.config.setdefault('TRENDING_HALF_LIFE_HOURS', 6)
+    app.config.setdefault('TRENDING_SIZE', 50)
+
+    @app.cli.group()
+    def trending():
+        """Manage the trending and top warbles boards."""
+
+    @trending.command('maintain')
+    def maintain_command():
+        """Slide the trending window forward (run hourly)."""
+        click.echo(f"Rescored {slide_window()} messages")
+
+    @trending.command('rebuild')
+    def rebuild_command():
+        """Recompute every board from the likes table."""
+        rebuild()
+        click.echo("Rebuilt the trending and top boards")
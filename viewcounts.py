@@ -0,0 +1,319 @@
+"""Message view counters, counted in memory and written behind in batches.
+
+Every time messages_show serves a warble it counts a view, and every time a
+timeline (home, profiles, trending, top, tag pages) lists one it counts an
+impression. Doing that with `UPDATE messages SET views = views + 1` would
+turn every page view into a write, and a popular warble into one row every
+worker queues up to lock. Instead each process keeps a ViewBuffer:
+
+    message id -> [views, impressions, viewer registers]
+
+and a background thread writes it out every VIEWS_FLUSH_INTERVAL seconds
+(sooner once VIEWS_BATCH messages are waiting). A flush is the same four
+statements however many views it carries: which messages still exist,
+create their message_views rows if they are new, lock and read those rows,
+and one executemany UPDATE adding the batch's counts.
+
+Unique viewers
+    Counting distinct viewers exactly would mean keeping every viewer of
+    every message. Each message_views row holds a HyperLogLog sketch instead:
+    2 ** VIEWER_PRECISION one byte registers (1 KB) that estimate how many
+    distinct viewers went into them to within about 3%, however many there
+    were. A viewer is their user id, or for logged out visitors their
+    address and browser. The buffer only keeps the registers a batch
+    touched, and a flush merges them into the stored sketch (the larger
+    value wins per register) and saves the new estimate next to it, so
+    pages read a plain integer.
+
+Accuracy
+    Counts are durable once their batch commits. A clean shutdown flushes
+    what is left, but a killed process loses up to one interval of counts,
+    and a batch that keeps failing is dropped after VIEWS_RETRIES tries.
+    Pages show what has been flushed, so a view turns up a flush later, and
+    the message page can be another CACHE_TTL behind on top (see cache.py).
+"""
+
+import atexit
+import hashlib
+import math
+import os
+import threading
+
+from flask import current_app, request, g
+from sqlalchemy import bindparam
+
+from models import db, Message, MessageViews, insert_ignoring_duplicates
+
+_buffer_lock = threading.Lock()
+
+#registers per sketch = 2 ** VIEWER_PRECISION, standard error 1.04 / sqrt(registers)
+VIEWER_PRECISION = 10
+REGISTERS = 1 << VIEWER_PRECISION
+
+
+##############################################################################
+# HyperLogLog
+
+
+def register(viewer):
+    """(register index, rank) `viewer` (a string) sets in a sketch."""
+
+    h = int.from_bytes(hashlib.blake2b(viewer.encode('utf-8'), digest_size=8).digest(), 'big')
+    rest_bits = 64 - VIEWER_PRECISION
+    rest = h & ((1 << rest_bits) - 1)
+    #the first bits pick the register, the rank is where the first 1 is in what is left
+    return h >> rest_bits, rest_bits - rest.bit_length() + 1
+
+
+def merge(sketch, registers):
+    """`sketch` (bytes or None) with the {index: rank} `registers` folded in, as bytes."""
+
+    merged = bytearray(sketch or bytes(REGISTERS))
+    for index, rank in registers.items():
+        if rank > merged[index]:
+            merged[index] = rank
+    return bytes(merged)
+
+
+def estimate(sketch):
+    """How many distinct viewers went into `sketch`."""
+
+    if not sketch:
+        return 0
+    raw = (0.7213 / (1 + 1.079 / REGISTERS)) * REGISTERS ** 2 / sum(2.0 ** -rank for rank in sketch)
+    zeros = sketch.count(0)
+    if raw <= 2.5 * REGISTERS and zeros:
+        return round(REGISTERS * math.log(REGISTERS / zeros)) #small counts: linear counting is the better guess
+    return round(raw)
+
+
+##############################################################################
+# The buffer
+
+
+class ViewBuffer:
+    """The views and impressions one process has counted but not yet written."""
+
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self.interval = app.config['VIEWS_FLUSH_INTERVAL']
+        self.batch_size = app.config['VIEWS_BATCH']
+        self.retries = app.config['VIEWS_RETRIES']
+        self._failures = 0
+        self._pending = {} #message_id -> [views, impressions, {register index: rank}]
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._full = threading.Event()
+        self._stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        #with no interval nothing flushes in the background, only full batches and explicit flush() calls
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self._run, name='warbler-views', daemon=True)
+            self.thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def record(self, message_ids, viewer, views=0, impressions=0):
+        """Count `views` and `impressions` of each of `message_ids` by `viewer`."""
+
+        index, rank = register(viewer)
+        with self._lock:
+            for message_id in message_ids:
+                counts = self._pending.get(message_id)
+                if counts is None:
+                    counts = self._pending[message_id] = [0, 0, {}]
+                counts[0] += views
+                counts[1] += impressions
+                if rank > counts[2].get(index, 0):
+                    counts[2][index] = rank
+            full = len(self._pending) >= self.batch_size
+        if full:
+            if self.thread is None:
+                self._flush_quietly() #we are on a page's request, counting must never break it
+            else:
+                self._full.set()
+
+    def _flush_quietly(self):
+        #a failed flush keeps its counts (see flush()), so logging it is enough
+        try:
+            self.flush()
+        except Exception:
+            self.app.logger.exception("View count flush failed, will retry")
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._full.wait(self.interval)
+            self._full.clear()
+            with self.app.app_context():
+                self._flush_quietly()
+
+    def stop(self):
+        """Stop the flusher and write whatever is left."""
+
+        self._stopping.set()
+        self._full.set()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            with self.app.app_context():
+                self.flush()
+        except Exception:
+            self.app.logger.exception("Lost the last batch of view counts on shutdown")
+
+    def close(self):
+        """stop() now rather than at exit, for a buffer that is being thrown away."""
+
+        atexit.unregister(self.stop)
+        self.stop()
+
+    def flush(self):
+        """Add everything counted so far to message_views in one transaction. Returns how many messages it touched."""
+
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            try:
+                written = self._write(pending)
+                db.session.commit()
+                self._failures = 0
+                return written
+
+            except Exception:
+                db.session.rollback()
+                self._failures += 1
+                if self._failures > self.retries:
+                    self._failures = 0
+                    self.app.logger.error("Dropping view counts for %s messages after %s failed flushes",
+                                          len(pending), self.retries + 1)
+                    raise
+                with self._lock:
+                    #add back what was counted since
+                    for message_id, (views, impressions, registers) in self._pending.items():
+                        counts = pending.setdefault(message_id, [0, 0, {}])
+                        counts[0] += views
+                        counts[1] += impressions
+                        for index, rank in registers.items():
+                            counts[2][index] = max(rank, counts[2].get(index, 0))
+                    self._pending = pending
+                raise
+
+    def _write(self, pending):
+        #messages deleted since they were seen are skipped
+        message_ids = [m_id for (m_id,) in db.session.query(Message.id).filter(Message.id.in_(list(pending)))]
+        if not message_ids:
+            return 0
+
+        insert_ignoring_duplicates(MessageViews.__table__, [
+            {'message_id': m_id, 'views': 0, 'impressions': 0, 'viewers': 0} for m_id in message_ids])
+        #locked until the commit, so two processes flushing the same message merge their sketches in turn
+        sketches = dict(db.session.query(MessageViews.message_id, MessageViews.sketch)
+                        .filter(MessageViews.message_id.in_(message_ids))
+                        .with_for_update())
+
+        table = MessageViews.__table__
+        updates = []
+        for m_id in message_ids:
+            views, impressions, registers = pending[m_id]
+            sketch = merge(sketches.get(m_id), registers)
+            updates.append({'b_id': m_id, 'b_views': views, 'b_impressions': impressions,
+                            'b_viewers': estimate(sketch), 'b_sketch': sketch})
+        db.session.execute(
+            table.update()
+            .where(table.c.message_id == bindparam('b_id'))
+            .values(views=table.c.views + bindparam('b_views'),
+                    impressions=table.c.impressions + bindparam('b_impressions'),
+                    viewers=bindparam('b_viewers'),
+                    sketch=bindparam('b_sketch')),
+            updates)
+        return len(message_ids)
+
+
+def view_buffer(app=None):
+    """This process's ViewBuffer for `app`, started on first use (and again after a fork)."""
+
+    app = app or current_app._get_current_object()
+    with _buffer_lock:
+        buffer = app.extensions.get('warbler_views')
+        if buffer is None or buffer.pid != os.getpid():
+            buffer = ViewBuffer(app).start()
+            app.extensions['warbler_views'] = buffer
+    return buffer
+
+
+##############################################################################
+# Counting from the routes
+
+
+def viewer():
+    """Who is looking, as far as unique viewers go."""
+
+    if g.user:
+        return f"user:{g.user.id}"
+    return f"anon:{request.remote_addr}:{request.user_agent.string}"
+
+
+def count_view(message_id):
+    """Count the current request as a view of `message_id`."""
+
+    if current_app.config['VIEWS_ENABLED']:
+        view_buffer().record([message_id], viewer(), views=1)
+
+
+def count_impressions(rows):
+    """Count an impression of every MessageRow in `rows` and hand them back for the template.
+
+    A list is counted straight away. A generator (a streamed timeline) is
+    counted as the template takes each row, so only the rows that actually
+    went out count, and nothing here needs the request once streaming has
+    started.
+    """
+
+    if not current_app.config['VIEWS_ENABLED']:
+        return rows
+
+    buffer, who = view_buffer(), viewer()
+    if isinstance(rows, (list, tuple)):
+        if rows:
+            buffer.record([row.id for row in rows], who, impressions=1)
+        return rows
+
+    def counted():
+        for row in rows:
+            buffer.record([row.id], who, impressions=1)
+            yield row
+    return counted()
+
+
+def forget_messages(message_ids):
+    """Stage taking deleted (or archived) messages' counts away."""
+
+    MessageViews.query.filter(MessageViews.message_id.in_(message_ids)).delete(synchronize_session=False)
+
+
+##############################################################################
+# Setup
+
+
+def init_views(app):
+    """Set the view counter defaults on `app`.
+
+    VIEWS_ENABLED           count views and impressions at all
+    VIEWS_FLUSH_INTERVAL    seconds between background flushes, 0 for none
+    VIEWS_BATCH             flush as soon as this many messages have counts waiting
+    VIEWS_RETRIES           failed flushes of the same counts before they are dropped
+    """
+
+    app.config.setdefault('VIEWS_ENABLED', True)
+    app.config.setdefault('VIEWS_FLUSH_INTERVAL', 5.0)
+    app.config.setdefault('VIEWS_BATCH', 1000)
+    app.config.setdefault('VIEWS_RETRIES', 5)
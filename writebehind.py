@@ -0,0 +1,283 @@
+"""Optional write-behind batching for likes and follows.
+
+With WRITE_BEHIND on, add_like, add_follow and stop_following don't write
+anything themselves. They record what the user asked for in this process's
+WriteBuffer and redirect straight away. The buffer is flushed in a single
+transaction every WRITE_BEHIND_INTERVAL seconds, or as soon as it holds
+WRITE_BEHIND_BATCH changes, so a like storm on a popular warble costs one
+commit per batch instead of one per click.
+
+Flushing works out the end state of every (user, message) like and
+(follower, followed) follow in the batch, so like -> unlike -> like is one
+like and like -> unlike is nothing. It compares that with what is in the
+database and writes the difference with multi-row statements (INSERT ... ON
+CONFLICT DO NOTHING / INSERT OR IGNORE, and DELETE ... WHERE (a, b) IN ...).
+
+Durability
+    A change is durable once its batch commits, up to WRITE_BEHIND_INTERVAL
+    after the user got their redirect. A clean shutdown flushes what is left
+    (atexit), but a process that is killed or crashes loses its unflushed
+    changes. If a flush fails the changes go back into the buffer and are
+    retried with the next one, up to WRITE_BEHIND_RETRIES times before the
+    batch is logged and dropped so one bad batch can't wedge the buffer.
+    Changes whose user or message was deleted in the meantime are skipped.
+    Leave WRITE_BEHIND off wherever that window isn't acceptable.
+
+Counter consistency
+    The profile counters are recounted from the likes and follows tables
+    (refresh_counts) for every user a batch actually changed, in the same
+    transaction as the batch for follows and by the record_likes job it
+    queues for likes. They can lag a flush behind but never drift, and a
+    change that turned out to be a no-op doesn't touch them.
+
+Reads don't look into the buffer, so until the next flush the pages a user is
+redirected to can still show the old state, and other worker processes never
+see another process's buffer.
+"""
+
+import atexit
+import os
+import threading
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import tuple_
+
+from models import db, Likes, Follows, Message, User, insert_ignoring_duplicates
+from jobs import enqueue, refresh_counts
+
+_buffer_lock = threading.Lock()
+
+
+class WriteBuffer:
+    """The like and follow changes one process has promised but not yet written."""
+
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self.interval = app.config['WRITE_BEHIND_INTERVAL']
+        self.batch_size = app.config['WRITE_BEHIND_BATCH']
+        self.retries = app.config['WRITE_BEHIND_RETRIES']
+        self._failures = 0
+        self._likes = {} #(user_id, message_id) -> (liked, liked_at) for the latest click
+        self._follows = {} #(follower_id, followed_id) -> following
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() #one flush at a time, the flusher thread or a caller
+        self._full = threading.Event()
+        self._stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        #with no interval nothing flushes in the background, only full batches and explicit flush() calls
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self._run, name='warbler-write-behind', daemon=True)
+            self.thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def __len__(self):
+        with self._lock:
+            return len(self._likes) + len(self._follows)
+
+    def like(self, user_id, message_id, liked_at):
+        self._record(self._likes, (user_id, message_id), (True, liked_at))
+
+    def unlike(self, user_id, message_id):
+        self._record(self._likes, (user_id, message_id), (False, None))
+
+    def follow(self, follower_id, followed_id):
+        self._record(self._follows, (follower_id, followed_id), True)
+
+    def unfollow(self, follower_id, followed_id):
+        self._record(self._follows, (follower_id, followed_id), False)
+
+    def pending_like(self, user_id, message_id):
+        """True/False if this process has an unflushed like/unlike for the pair, None if not."""
+
+        with self._lock:
+            state = self._likes.get((user_id, message_id))
+        return None if state is None else state[0]
+
+    def toggle_like(self, user_id, message_id):
+        """Flip whether `user_id` likes `message_id`, going by this buffer first and the database second.
+
+        Returns True if it is now a like.
+        """
+
+        liked = self.pending_like(user_id, message_id)
+        if liked is None:
+            liked = (db.session.query(Likes.id)
+                     .filter(Likes.user_id == user_id, Likes.message_id == message_id)
+                     .first()) is not None
+        if liked:
+            self.unlike(user_id, message_id)
+        else:
+            self.like(user_id, message_id, datetime.utcnow())
+        return not liked
+
+    def _record(self, changes, key, value):
+        with self._lock:
+            changes[key] = value
+            full = len(self._likes) + len(self._follows) >= self.batch_size
+        if full:
+            if self.thread is None:
+                self._flush_quietly() #we are on the like or follow request, the click is buffered either way
+            else:
+                self._full.set()
+
+    def _flush_quietly(self):
+        #a failed flush puts its changes back (see flush()), so logging it is enough
+        try:
+            self.flush()
+        except Exception:
+            self.app.logger.exception("Write-behind flush failed, will retry")
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._full.wait(self.interval)
+            self._full.clear()
+            with self.app.app_context():
+                self._flush_quietly()
+
+    def stop(self):
+        """Stop the flusher and write whatever is left."""
+
+        self._stopping.set()
+        self._full.set()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            with self.app.app_context():
+                self.flush()
+        except Exception:
+            self.app.logger.exception("Write-behind lost its last batch on shutdown")
+
+    def close(self):
+        """stop() now rather than at exit, for a buffer that is being thrown away."""
+
+        atexit.unregister(self.stop)
+        self.stop()
+
+    def flush(self):
+        """Write everything buffered so far in one transaction. Returns how many changes were applied."""
+
+        with self._flush_lock:
+            with self._lock:
+                likes, self._likes = self._likes, {}
+                follows, self._follows = self._follows, {}
+            if not likes and not follows:
+                return 0
+
+            try:
+                users = {user_id for user_id, _ in likes} | {user_id for pair in follows for user_id in pair}
+                users = {user_id for (user_id,) in db.session.query(User.id).filter(User.id.in_(users))}
+
+                changes = self._write_likes({k: v for k, v in likes.items() if k[0] in users})
+                applied = len(changes) + self._write_follows(
+                    {k: v for k, v in follows.items() if k[0] in users and k[1] in users})
+                if changes:
+                    enqueue('record_likes', changes=changes) #commits the batch together with the job that counts it
+                else:
+                    db.session.commit()
+                self._failures = 0
+                return applied
+
+            except Exception:
+                db.session.rollback()
+                self._failures += 1
+                if self._failures > self.retries:
+                    self._failures = 0
+                    self.app.logger.error("Dropping a write-behind batch after %s failed flushes: likes=%r follows=%r",
+                                          self.retries + 1, likes, follows)
+                    raise
+                with self._lock:
+                    #put them back under anything clicked since, the newer click wins
+                    likes.update(self._likes)
+                    follows.update(self._follows)
+                    self._likes, self._follows = likes, follows
+                raise
+
+    def _write_likes(self, likes):
+        """Stage the likes that change something, returning them as record_likes changes."""
+
+        if not likes:
+            return []
+
+        existing = {(user_id, message_id): (like_id, timestamp) for user_id, message_id, like_id, timestamp in
+                    db.session.query(Likes.user_id, Likes.message_id, Likes.id, Likes.timestamp)
+                    .filter(tuple_(Likes.user_id, Likes.message_id).in_(list(likes)))}
+
+        added = [(key, liked_at) for key, (liked, liked_at) in likes.items() if liked and key not in existing]
+        removed = [(key, existing[key]) for key, (liked, _) in likes.items() if not liked and key in existing]
+        if not added and not removed:
+            return []
+
+        #messages deleted since the click are skipped, and we need the authors for the top boards
+        message_ids = {message_id for (_, message_id), _ in added + removed}
+        authors = dict(db.session.query(Message.id, Message.user_id).filter(Message.id.in_(message_ids)))
+        added = [(key, liked_at) for key, liked_at in added if key[1] in authors]
+
+        if added:
+            insert_ignoring_duplicates(Likes.__table__, [
+                {'user_id': user_id, 'message_id': message_id, 'timestamp': liked_at}
+                for (user_id, message_id), liked_at in added])
+        if removed:
+            (Likes.query
+             .filter(Likes.id.in_([like_id for _, (like_id, _) in removed]))
+             .delete(synchronize_session=False))
+
+        return ([[user_id, message_id, authors[message_id], liked_at.isoformat(), 1]
+                 for (user_id, message_id), liked_at in added] +
+                [[user_id, message_id, authors[message_id], liked_at.isoformat(), -1]
+                 for (user_id, message_id), (_, liked_at) in removed if message_id in authors])
+
+    def _write_follows(self, follows):
+        """Stage the follow changes and recount whoever they touch. Returns how many rows changed."""
+
+        if not follows:
+            return 0
+
+        pair = tuple_(Follows.user_following_id, Follows.user_being_followed_id)
+        existing = {tuple(row) for row in
+                    db.session.query(Follows.user_following_id, Follows.user_being_followed_id)
+                    .filter(pair.in_(list(follows)))}
+
+        added = [key for key, following in follows.items() if following and key not in existing]
+        removed = [key for key, following in follows.items() if not following and key in existing]
+
+        if added:
+            insert_ignoring_duplicates(Follows.__table__, [
+                {'user_following_id': follower_id, 'user_being_followed_id': followed_id}
+                for follower_id, followed_id in added])
+        if removed:
+            Follows.query.filter(pair.in_(removed)).delete(synchronize_session=False)
+
+        refresh_counts(sorted({user_id for pair in added + removed for user_id in pair}))
+        return len(added) + len(removed)
+
+
+def write_buffer(app=None):
+    """This process's WriteBuffer for `app`, started on first use (and again after a fork)."""
+
+    app = app or current_app._get_current_object()
+    with _buffer_lock:
+        buffer = app.extensions.get('warbler_write_behind')
+        if buffer is None or buffer.pid != os.getpid():
+            buffer = WriteBuffer(app).start()
+            app.extensions['warbler_write_behind'] = buffer
+    return buffer
+
+
+def init_write_behind(app):
+    """Set the write-behind defaults on `app`.
+
+    WRITE_BEHIND            buffer likes and follows and write them in batches
+    WRITE_BEHIND_INTERVAL   seconds between background flushes, 0 for none
+    WRITE_BEHIND_BATCH      flush as soon as this many changes are waiting
+    WRITE_BEHIND_RETRIES    failed flushes of the same changes before they are dropped
+    """
+
+    app.config.setdefault('WRITE_BEHIND', False)
+    app.config.setdefault('WRITE_BEHIND_INTERVAL', 0.2)
+    app.config.setdefault('WRITE_BEHIND_BATCH', 500)
+    app.config.setdefault('WRITE_BEHIND_RETRIES', 5)
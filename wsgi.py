@@ -0,0 +1,19 @@
+"""WSGI entry point for running Warbler under a real server.
+
+    gunicorn --preload -w 4 wsgi:app
+
+This is the production entry point, so it builds the production profile
+unless FLASK_ENV names another one (create_app() on its own falls back to
+development, debug toolbar and all).
+
+With --preload the master builds the app (and compiles every template, see
+PRELOAD_TEMPLATES) once before forking, so workers start warm and share those
+pages of memory. Nothing here opens a database connection or starts job
+threads; both happen lazily inside each worker after the fork.
+"""
+
+import os
+
+from app import create_app
+
+app = create_app(os.environ.get('FLASK_ENV') or 'production')